@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: UTF8 -*-
+
+"""
+
+benchmark.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Build the test books and some synthetic large books several times,
+collect the per-stage metrics ebookmaker writes with --metrics and
+compare them against a baseline.
+
+run this with
+python benchmarks/benchmark.py --repeat 3 --baseline benchmarks/baseline.json
+
+Timings depend on the machine, so make a baseline on the machine you
+compare on:
+python benchmarks/benchmark.py --repeat 3 --save-baseline benchmarks/baseline.json
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+TESTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests', 'files')
+
+# name: (path relative to tests/files, extra ebookmaker args)
+CORPUS = {
+    '43172': ('43172/43172-h/43172-h.htm', []),
+    '33968': ('33968/33968-rst/33968-rst.rst', []),
+    '69030': ('69030/69030-0.txt', ['--ebook=69030']),
+}
+
+# name: (size at scale 1, description)
+SYNTHETIC = {
+    'big-html': (20 * 1024 * 1024, '20 MB single-file html'),
+    'many-images': (2000, 'html with 2000 images'),
+    'big-txt': (5 * 1024 * 1024, '5 MB plain text'),
+}
+
+PG_HEADER = """The Project Gutenberg eBook of {title}
+
+Title: {title}
+
+Author: Ebookmaker Benchmark
+
+Release Date: January 1, 2026 [eBook #{ebook}]
+
+Language: English
+
+*** START OF THE PROJECT GUTENBERG EBOOK {upper} ***
+
+"""
+
+PG_FOOTER = """
+
+*** END OF THE PROJECT GUTENBERG EBOOK {upper} ***
+"""
+
+WORDS = ('the of and to in that was he it his with as for had you not be her on at by '
+         'which have or from this him but all she they were my are me one their so an '
+         'said them we who would been will no when there if more out up into do any '
+         'your what has man could other than our some very time upon about may its '
+         'only now like little then can should made did us such great before must two '
+         'these see know over much down after first mr good men own never most old '
+         'shall day where those came come himself way work life without go make well '
+         'through being long say might how am too even under new same last '
+         'while here though again place young house world still').split()
+
+
+def sentence(rnd, n_words):
+    """ Make a random sentence. """
+    words = [rnd.choice(WORDS) for dummy in range(n_words)]
+    return ' '.join(words).capitalize() + '.'
+
+
+def paragraph(rnd):
+    """ Make a random paragraph. """
+    return ' '.join(sentence(rnd, rnd.randint(6, 20)) for dummy in range(rnd.randint(3, 8)))
+
+
+def html_page(title, body):
+    """ Wrap body in a html document with PG boilerplate markers. """
+    upper = title.upper()
+    return (
+        '<!DOCTYPE html>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" lang="en">\n'
+        '<head>\n<meta charset="utf-8"/>\n<title>%s</title>\n'
+        '<meta name="DC.Creator" content="Ebookmaker Benchmark"/>\n'
+        '<style>p {text-indent: 1em} .fig {text-align: center}</style>\n'
+        '</head>\n<body>\n'
+        '<div>*** START OF THE PROJECT GUTENBERG EBOOK %s ***</div>\n'
+        '<h1>%s</h1>\n%s\n'
+        '<div>*** END OF THE PROJECT GUTENBERG EBOOK %s ***</div>\n'
+        '</body>\n</html>\n') % (title, upper, title, body, upper)
+
+
+def make_big_html(dirname, size):
+    """ A single html file of about size bytes with chapters and footnotes. """
+
+    rnd = random.Random(1)
+    parts = []
+    length = 0
+    chapter = 0
+    while length < size:
+        chapter += 1
+        chunk = ['<h2 id="chapter%d">Chapter %d</h2>' % (chapter, chapter)]
+        for i in range(40):
+            text = paragraph(rnd)
+            if i % 10 == 0:
+                fn = '%d_%d' % (chapter, i)
+                text += ' <a id="fnref%s" href="#fn%s">[%d]</a>' % (fn, fn, i)
+                chunk.append('<p>%s</p>' % text)
+                chunk.append('<div class="footnote" id="fn%s"><p><a href="#fnref%s">[%d]</a> %s'
+                             '</p></div>' % (fn, fn, i, sentence(rnd, 12)))
+            else:
+                chunk.append('<p>%s</p>' % text)
+        chunk = '\n'.join(chunk) + '\n'
+        parts.append(chunk)
+        length += len(chunk)
+    path = os.path.join(dirname, 'big-html.html')
+    with open(path, 'w', encoding='utf-8') as fp:
+        fp.write(html_page('Big Html', ''.join(parts)))
+    return path
+
+
+def make_many_images(dirname, count):
+    """ A html file with count distinct small images. """
+
+    from PIL import Image, ImageDraw
+
+    rnd = random.Random(2)
+    images_dir = os.path.join(dirname, 'images')
+    os.makedirs(images_dir, exist_ok=True)
+    parts = []
+    for i in range(count):
+        if i % 20 == 0:
+            parts.append('<h2>Plate Group %d</h2>' % (i // 20 + 1))
+        size = (rnd.randint(200, 1600), rnd.randint(200, 1600))
+        if i % 4 == 0:
+            # line art
+            fn = 'img%04d.png' % i
+            image = Image.new('L', size, 255)
+            draw = ImageDraw.Draw(image)
+            for dummy in range(50):
+                draw.line([(rnd.randrange(size[0]), rnd.randrange(size[1])),
+                           (rnd.randrange(size[0]), rnd.randrange(size[1]))], fill=0, width=2)
+        else:
+            # photo
+            fn = 'img%04d.jpg' % i
+            x, y = rnd.uniform(-2, 0.5), rnd.uniform(-1, 1)
+            image = Image.effect_mandelbrot(size, (x, y, x + 0.5, y + 0.5), 100).convert('RGB')
+        image.save(os.path.join(images_dir, fn))
+        parts.append('<div class="fig"><img src="images/%s" alt="Plate %d" '
+                     'width="%d" height="%d"/></div>' % (fn, i, size[0], size[1]))
+        parts.append('<p>%s</p>' % paragraph(rnd))
+    path = os.path.join(dirname, 'many-images.html')
+    with open(path, 'w', encoding='utf-8') as fp:
+        fp.write(html_page('Many Images', '\n'.join(parts)))
+    return path
+
+
+def make_big_txt(dirname, size):
+    """ A PG plain text file of about size bytes. """
+
+    rnd = random.Random(3)
+    title = 'Big Text'
+    parts = [PG_HEADER.format(title=title, upper=title.upper(), ebook=90003)]
+    length = 0
+    chapter = 0
+    while length < size:
+        chapter += 1
+        chunk = ['\n\n\nCHAPTER %d.\n' % chapter]
+        for dummy in range(30):
+            # wrap at 70 columns like PG texts
+            words = paragraph(rnd).split()
+            line, lines = '', []
+            for word in words:
+                if len(line) + len(word) >= 70:
+                    lines.append(line)
+                    line = word
+                else:
+                    line = (line + ' ' + word).strip()
+            lines.append(line)
+            chunk.append('\n'.join(lines) + '\n')
+        chunk = '\n'.join(chunk)
+        parts.append(chunk)
+        length += len(chunk)
+    parts.append(PG_FOOTER.format(upper=title.upper()))
+    path = os.path.join(dirname, 'big-txt.txt')
+    with open(path, 'w', encoding='utf-8') as fp:
+        fp.write(''.join(parts))
+    return path
+
+
+MAKERS = {
+    'big-html': make_big_html,
+    'many-images': make_many_images,
+    'big-txt': make_big_txt,
+}
+
+
+def make_books(args, workdir):
+    """ Return {name: (path, extra args)} of the books to build. """
+
+    books = {}
+    if not args.no_corpus:
+        for name, (path, extra) in CORPUS.items():
+            books[name] = (os.path.normpath(os.path.join(TESTS_DIR, path)), extra)
+    if not args.no_synthetic:
+        for name, (size, description) in SYNTHETIC.items():
+            dirname = os.path.join(workdir, 'books', name)
+            os.makedirs(dirname, exist_ok=True)
+            print('generating %s (%s, scale %s)' % (name, description, args.scale))
+            books[name] = (MAKERS[name](dirname, max(1, int(size * args.scale))), [])
+    if args.books:
+        books = {name: book for name, book in books.items() if name in args.books}
+    return books
+
+
+def build(args, name, path, extra, outputdir):
+    """ Build one book, return the metrics ebookmaker wrote. """
+
+    os.makedirs(outputdir)
+    cmd = [sys.executable]
+    if args.tracemalloc:
+        cmd += ['-X', 'tracemalloc']
+    cmd += ['-m', 'ebookmaker.EbookMaker', '--metrics', '--output-dir', outputdir]
+    cmd += ['--make=%s' % type_ for type_ in args.make]
+    cmd += extra + [path]
+
+    start = time.perf_counter()
+    with open(os.path.join(outputdir, 'ebookmaker.log'), 'w') as log:
+        subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT, check=False)
+    elapsed = time.perf_counter() - start
+
+    metrics = [{'type': 'all', 'stage': 'process', 'wall_s': elapsed}]
+    metrics_file = os.path.join(outputdir, 'ebookmaker.metrics.jsonl')
+    if os.path.exists(metrics_file):
+        with open(metrics_file, encoding='utf-8') as fp:
+            metrics += [json.loads(line) for line in fp]
+    else:
+        print('  no metrics from %s, see %s' % (name, log.name))
+    return metrics
+
+
+def run(args, books, workdir):
+    """ Build all books args.repeat times, return the summarized results. """
+
+    samples = {}
+    for name, (path, extra) in books.items():
+        for i in range(args.repeat):
+            print('building %s (%d/%d)' % (name, i + 1, args.repeat))
+            outputdir = os.path.join(workdir, 'out', name, str(i))
+            for m in build(args, name, path, extra, outputdir):
+                key = '%s/%s/%s' % (name, m['type'], m['stage'])
+                samples.setdefault(key, []).append(m)
+
+    results = {}
+    for key, ms in sorted(samples.items()):
+        result = {'wall_s': round(statistics.median(m['wall_s'] for m in ms), 6)}
+        if 'cpu_s' in ms[0]:
+            result['cpu_s'] = round(statistics.median(m['cpu_s'] for m in ms), 6)
+            result['maxrss_kb'] = max(m['maxrss_kb'] for m in ms)
+        if 'tracemalloc_peak_kb' in ms[0]:
+            result['tracemalloc_peak_kb'] = max(m['tracemalloc_peak_kb'] for m in ms)
+        results[key] = result
+    return results
+
+
+def compare(args, results, baseline):
+    """ Print the results next to the baseline. Return the regressions. """
+
+    # measure: minimum absolute change that counts
+    measures = {
+        'wall_s': args.min_seconds,
+        'maxrss_kb': args.min_kb,
+        'tracemalloc_peak_kb': args.min_kb,
+    }
+    regressions = []
+    print('%-50s %12s %12s %8s' % ('stage', 'baseline', 'now', 'change'))
+    for key, result in sorted(results.items()):
+        base = baseline.get(key)
+        for measure, min_change in measures.items():
+            if measure not in result:
+                continue
+            now = result[measure]
+            if base is None or measure not in base:
+                if measure == 'wall_s':
+                    print('%-50s %12s %12.3f %8s' % (key, '-', now, 'new'))
+                continue
+            was = base[measure]
+            change = (now - was) / was if was else 0.0
+            flag = ''
+            if now - was > min_change and now > was * (1 + args.threshold):
+                flag = ' REGRESSION'
+                regressions.append((key, measure, was, now))
+            if measure == 'wall_s' or flag:
+                print('%-50s %12.3f %12.3f %+7.0f%%%s' % (
+                    key if measure == 'wall_s' else '%s [%s]' % (key, measure),
+                    was, now, change * 100, flag))
+    return regressions
+
+
+def main():
+    """ Main program. """
+
+    ap = argparse.ArgumentParser(prog='benchmark')
+    ap.add_argument('--repeat', '-n', type=int, default=3,
+                    help='build each book N times and use the median (default: %(default)s)')
+    ap.add_argument('--make', action='append', default=[],
+                    help='output type, repeat for more (default: all)')
+    ap.add_argument('--book', dest='books', action='append', default=[],
+                    help='only build this book, repeat for more (default: all books)')
+    ap.add_argument('--no-corpus', action='store_true', help="don't build the test books")
+    ap.add_argument('--no-synthetic', action='store_true',
+                    help="don't build the synthetic books")
+    ap.add_argument('--scale', type=float, default=1.0,
+                    help='scale the size of the synthetic books (default: %(default)s)')
+    ap.add_argument('--tracemalloc', action='store_true',
+                    help='also measure traced memory peaks (slow)')
+    ap.add_argument('--baseline', metavar='FILE', help='compare against baseline FILE')
+    ap.add_argument('--save-baseline', metavar='FILE', help='save the results as baseline FILE')
+    ap.add_argument('--output', metavar='FILE', help='save the results in FILE')
+    ap.add_argument('--threshold', type=float, default=0.25,
+                    help='relative increase that counts as regression (default: %(default)s)')
+    ap.add_argument('--min-seconds', type=float, default=0.05,
+                    help='ignore timing changes smaller than this (default: %(default)s)')
+    ap.add_argument('--min-kb', type=int, default=8192,
+                    help='ignore memory changes smaller than this (default: %(default)s)')
+    ap.add_argument('--workdir', help='keep books and outputs in WORKDIR (default: temporary)')
+    args = ap.parse_args()
+    args.make = args.make or ['all']
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='ebookmaker-benchmark-')
+    try:
+        books = make_books(args, workdir)
+        results = run(args, books, workdir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'repeat': args.repeat,
+        'scale': args.scale,
+        'make': args.make,
+        'results': results,
+    }
+    for filename in (args.output, args.save_baseline):
+        if filename:
+            with open(filename, 'w', encoding='utf-8') as fp:
+                json.dump(report, fp, indent=1, sort_keys=True)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as fp:
+            baseline_report = json.load(fp)
+        if baseline_report.get('scale') != args.scale:
+            print('warning: baseline was made with scale %s' % baseline_report.get('scale'))
+        baseline = baseline_report['results']
+
+    regressions = compare(args, results, baseline)
+    if regressions:
+        print('\n%d regressions:' % len(regressions))
+        for key, measure, was, now in regressions:
+            print('  %s %s: %s -> %s' % (key, measure, was, now))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
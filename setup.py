@@ -31,6 +31,7 @@ if __name__ == "__main__":
 
         scripts = [
             'scripts/ebookmaker',
+            'scripts/ebookmaker_worker',
             'scripts/rhyme_compiler',
         ],
 
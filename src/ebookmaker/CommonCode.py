@@ -141,10 +141,10 @@ def set_arg_defaults(ap, config_file):
     if cp.has_section('DEFAULT_ARGS'):
         ap.set_defaults(**dict(cp.items('DEFAULT_ARGS')))
 
-def parse_config_and_args(ap, sys_config, defaults=None):
+def parse_config_and_args(ap, sys_config, defaults=None, args=None):
 
     # put command-line args into options
-    options.update(vars(ap.parse_args()))
+    options.update(vars(ap.parse_args(args)))
 
     cp = configparser.ConfigParser()
     cp.read((sys_config, options.config_file))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: UTF8 -*-
+
+"""
+
+DiskCache.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+A content-addressed cache of pickled objects in a directory.
+
+Keys are made from everything that determines the cached result, so
+entries never have to be invalidated: a changed input simply makes a
+new key. Old entries may be deleted at any time.
+
+Work that logs can keep its messages with the cached result, using
+capture_log, and replay_log them when the result comes from the cache.
+
+"""
+
+import contextlib
+import hashlib
+import logging
+import os
+import pickle
+import threading
+
+from libgutenberg.Logger import warning
+
+from ebookmaker.Version import VERSION
+
+
+def make_key(*parts):
+    """ Make a cache key out of bytes and str parts.
+
+    The ebookmaker version is always part of the key.
+
+    """
+
+    hasher = hashlib.sha256(VERSION.encode('utf-8'))
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        elif part is None:
+            part = b''
+        # length prefix, so ('ab', 'c') and ('a', 'bc') differ
+        hasher.update(b'%d:' % len(part))
+        hasher.update(part)
+    return hasher.hexdigest()
+
+
+class LogCapture(logging.Handler):
+    """ Collect the log messages of the current thread. """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.thread = threading.get_ident()
+        self.records = []
+
+
+    def emit(self, record):
+        if record.thread == self.thread:
+            self.records.append((record.levelno, record.getMessage()))
+
+
+@contextlib.contextmanager
+def capture_log():
+    """ Collect the (level, message) logged in the with block into a list. """
+
+    handler = LogCapture()
+    logger = logging.getLogger()
+    logger.addHandler(handler)
+    try:
+        yield handler.records
+    finally:
+        logger.removeHandler(handler)
+
+
+def replay_log(records):
+    """ Log again what capture_log collected. """
+
+    logger = logging.getLogger()
+    for level, message in records:
+        logger.log(level, '%s', message)
+
+
+class DiskCache:
+    """ Cache pickled objects under a directory.
+
+    Each namespace gets its own subdirectory. Entries are spread over
+    256 subdirectories and written atomically, so several processes
+    may share one cache directory.
+
+    """
+
+    def __init__(self, cachedir, namespace):
+        self.dir = os.path.join(cachedir, namespace)
+
+
+    def path(self, key):
+        """ Path to the entry for key. """
+        return os.path.join(self.dir, key[:2], key[2:])
+
+
+    def get(self, key):
+        """ Return the object stored for key or None. """
+
+        try:
+            with open(self.path(key), 'rb') as fp:
+                obj = pickle.load(fp)
+            return obj
+        except FileNotFoundError:
+            return None
+        except Exception as what:
+            # truncated or from an incompatible python, treat as a miss
+            warning('Ignoring bad cache entry %s: %s', self.path(key), what)
+            return None
+
+
+    def put(self, key, obj):
+        """ Store obj for key. """
+
+        path = self.path(key)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as fp:
+                pickle.dump(obj, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError as what:
+            warning('Could not write cache entry %s: %s', path, what)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
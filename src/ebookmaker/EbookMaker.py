@@ -17,8 +17,12 @@ Stand-alone application to build EPUB and others out of html or rst.
 import argparse
 import configparser
 import collections
+import concurrent.futures
 import datetime
 import hashlib
+import importlib.metadata
+import io
+import json
 import logging
 import os.path
 import re
@@ -35,12 +39,15 @@ from libgutenberg import MediaTypes as mt
 from libgutenberg import Cover
 
 from ebookmaker import parsers
+from ebookmaker import Metrics
 from ebookmaker import ParserFactory
 from ebookmaker import Spider
 from ebookmaker import WriterFactory
+from ebookmaker import ZipWriter
 from ebookmaker.packagers import PackagerFactory
 from ebookmaker import CommonCode
 from ebookmaker.CommonCode import Options, dir_from_url, find_candidates
+from ebookmaker.DiskCache import DiskCache, make_key
 from ebookmaker.Version import VERSION
 
 options = Options()
@@ -80,6 +87,14 @@ epub3.images kf8.images
 cover.small cover.medium
 qrcode rdf facebook twitter mastodon null""".split()
 
+# formats that are built from the output file of another format
+SOURCE_FORMATS = {
+    'kindle.images': 'epub.images',
+    'kindle.noimages': 'epub.noimages',
+    'kf8.images': 'epub3.images',
+    'pdf.images': 'html.images',
+}
+
 FILENAMES = {
     'html.images': '{id}-h.html',
 
@@ -106,6 +121,7 @@ FILENAMES = {
 }
 
 COVERPAGE_MIN_AREA = 200 * 200
+COVER_SIZE = (1600, 2400)
 
 def id_from_filename(fn):
     idmatch = re.search(r'\d+', fn)
@@ -192,12 +208,57 @@ def elect_coverpage(spider, url, dc):
             add_cover(cover_url, spider)
 
 
+def cover_key(dc):
+    """ Key for a generated cover: the strings Cover.draw renders and its size. """
+    try:
+        libgutenberg_version = importlib.metadata.version('libgutenberg')
+    except importlib.metadata.PackageNotFoundError:
+        libgutenberg_version = None
+    return make_key(dc.title_no_subtitle, dc.subtitle, dc.authors_short(),
+                    '%dx%d' % COVER_SIZE, libgutenberg_version)
+
+
+last_cover = (None, None)  # (key, png), the other jobs of a book use the same cover
+
+def draw_cover(dc):
+    """ The png bytes of the generated cover for dc, from the caches if possible. """
+    global last_cover
+
+    key = cover_key(dc)
+    if last_cover[0] == key:
+        return last_cover[1]
+    cache_dir = getattr(options, 'image_cache', None)
+    cache = DiskCache(cache_dir, 'covers') if cache_dir else None
+    data = cache.get(key) if cache else None
+    if data is None:
+        with Metrics.stage('draw_cover'):
+            buf = io.BytesIO()
+            Cover.draw(dc, cover_width=COVER_SIZE[0], cover_height=COVER_SIZE[1]).save(buf)
+            data = buf.getvalue()
+        if cache:
+            cache.put(key, data)
+    else:
+        debug('Got generated cover from image cache')
+    last_cover = (key, data)
+    return data
+
+
 def generate_cover(dir, dc):
     try:
-        cover_image = Cover.draw(dc, cover_width=1600, cover_height=2400)
+        data = draw_cover(dc)
         cover_url = os.path.join(dir, make_output_filename('cover', dc))
-        with open(cover_url, 'wb+') as cover:
-            cover_image.save(cover)
+        try:
+            with open(cover_url, 'rb') as fp:
+                if fp.read() == data:
+                    # keep the file, and the parsers and resized images made from it
+                    return cover_url
+        except OSError:
+            pass
+        # write to a temp file first, parallel jobs may be reading the cover
+        tmp_url = '%s.%d.tmp' % (cover_url, os.getpid())
+        with open(tmp_url, 'wb+') as cover:
+            cover.write(data)
+        os.replace(tmp_url, cover_url)
         return cover_url
     except OSError:
         error("OSError, Cairo not installed or couldn't write file.")
@@ -425,6 +486,77 @@ def add_local_options(ap):
         action="store_true",
         help="PG internal use only: read pickled job queue from stdin")
 
+    ap.add_argument(
+        "--parallel",
+        metavar="N",
+        dest="parallel",
+        type=int,
+        default=0,
+        help="build independent output formats in N processes (default: one after another)")
+
+    ap.add_argument(
+        "--image-processes",
+        metavar="N",
+        dest="image_processes",
+        type=int,
+        default=0,
+        help="resize the images of EPUBs in N processes (default: one after another)")
+
+    ap.add_argument(
+        "--hardlink-aux-files",
+        dest="hardlink_aux_files",
+        action="store_true",
+        help="hardlink unchanged images and other files of HTML output to their sources "
+        "instead of copying them (default: copy)")
+
+    ap.add_argument(
+        "--zip-threads",
+        metavar="N",
+        dest="zip_threads",
+        type=int,
+        default=0,
+        help="compress the files in EPUBs and zip files in N threads "
+        "(default: one after another)")
+
+    ap.add_argument(
+        "--zip-level",
+        metavar="EXT=LEVEL",
+        dest="zip_levels",
+        type=ZipWriter.level_option,
+        default=[],
+        action="append",
+        help="compress files with extension EXT (* for all others) in EPUBs and "
+        "zip files at LEVEL 0-9 (default: zlib's default, 6)")
+
+    ap.add_argument(
+        "--incremental",
+        dest="incremental",
+        action="store_true",
+        help="don't rebuild output files whose inputs did not change since the last run")
+
+    ap.add_argument(
+        "--metrics",
+        dest="metrics",
+        action="store_true",
+        help="write per-stage time and memory use of each job as JSON lines next to "
+        "the logfile (run python with -X tracemalloc for traced memory peaks)")
+
+    ap.add_argument(
+        "--parse-cache",
+        metavar="CACHE_DIR",
+        dest="parse_cache",
+        default=None,
+        help="keep parsed html sources in CACHE_DIR and reuse them while they "
+        "don't change (default: no cache)")
+
+    ap.add_argument(
+        "--image-cache",
+        metavar="CACHE_DIR",
+        dest="image_cache",
+        default=None,
+        help="keep resized images and generated covers in CACHE_DIR and reuse them "
+        "in later runs (default: only within a run)")
+
     ap.add_argument(
         "--extension-package",
         metavar="PYTHON_PACKAGE",
@@ -457,6 +589,110 @@ def close_log(handler):
         handler.close()
 
 
+# DublinCore attributes that end up in the output files
+MANIFEST_DC_FIELDS = (
+    'title', 'subtitle', 'alt_title', 'title_file_as', 'source', 'languages', 'created',
+    'publisher', 'rights', 'authors', 'subjects', 'bookshelves', 'loccs', 'categories',
+    'dcmitypes', 'release_date', 'update_date', 'edition', 'contents', 'encoding', 'notes',
+    'credit', 'pubinfo', 'project_gutenberg_id', 'opf_identifier',
+)
+
+# options that don't change the output files
+MANIFEST_IGNORED_OPTIONS = {
+    'verbose', 'validate', 'notify', 'incremental', 'parallel', 'parse_cache', 'image_cache',
+    'image_processes', 'zip_threads', 'hardlink_aux_files',
+    'is_job_queue', 'config_file', 'html_images_list', 'types',
+}
+
+
+def manifest_json(obj):
+    """ Serialize obj for the manifest, following object attributes. """
+
+    def default(o):
+        if isinstance(o, (set, frozenset)):
+            return sorted(o, key=str)
+        if hasattr(o, '__dict__'):
+            return {k: v for k, v in vars(o).items() if not k.startswith('_')}
+        return str(o)
+
+    return json.dumps(obj, default=default, sort_keys=True)
+
+
+def make_manifest(job):
+    """ Record everything the output of a job depends on. """
+
+    def digest(data):
+        return hashlib.sha256(data).hexdigest()
+
+    config = {k: v for k, v in vars(options.config).items() if k != 'TIMESTAMP'}
+    opts = {k: v for k, v in vars(options).items()
+            if k not in MANIFEST_IGNORED_OPTIONS and k != 'config'}
+    dc = {field: getattr(job.dc, field, None) for field in MANIFEST_DC_FIELDS}
+    try:
+        return {
+            'version': VERSION,
+            'type': job.type,
+            # image parsers keep the hash of their file, for all jobs
+            'inputs': {p.attribs.url: p.digest() if hasattr(p, 'digest')
+                                      else digest(p.bytes_content() or b'')
+                       for p in job.spider.parsers},
+            'dc': digest(manifest_json(dc).encode('utf-8')),
+            'options': digest(manifest_json([opts, config]).encode('utf-8')),
+        }
+    except (TypeError, ValueError) as what:
+        # eg. circular references in database objects
+        debug('Cannot make manifest for %s: %s', job.type, what)
+        return None
+
+
+def manifest_path(job):
+    """ Path of the manifest for the output of job. """
+    return os.path.join(os.path.abspath(job.outputdir), '.%s.manifest' % job.outputfile)
+
+
+def output_digest(job):
+    """ Hash of the output file of job, None if there is none. """
+
+    path = os.path.join(os.path.abspath(job.outputdir), job.outputfile)
+    if not os.path.isfile(path):
+        return None
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def is_up_to_date(job, manifest):
+    """ Check if the output of the last run was made from the same inputs. """
+
+    if manifest is None:
+        return False
+    try:
+        with open(manifest_path(job), 'r', encoding='utf-8') as fp:
+            old_manifest = json.load(fp)
+    except (OSError, ValueError):
+        return False
+    output = old_manifest.pop('output', None)
+    return old_manifest == manifest and output is not None and output == output_digest(job)
+
+
+def save_manifest(job, manifest):
+    """ Save the manifest next to the output file. """
+
+    if manifest is None:
+        return
+    manifest = dict(manifest, output=output_digest(job))
+    if manifest['output'] is None:
+        # nothing to check next time
+        return
+    try:
+        with open(manifest_path(job), 'w', encoding='utf-8') as fp:
+            json.dump(manifest, fp, indent=1, sort_keys=True)
+    except OSError as what:
+        warning('Cannot write manifest for %s: %s', job.outputfile, what)
+
+
 def do_job(job):
     """ Do one job. """
 
@@ -484,23 +720,39 @@ def do_job(job):
                 info('the --input-mediatype option is ignored and will be removed')
                 #attribs.orig_mediatype = options.input_mediatype
 
-            spider.recursive_parse(attribs)
+            with Metrics.stage('spider'):
+                spider.recursive_parse(attribs)
+            if Metrics.current is not None:
+                Metrics.count('spider', docs=len(spider.parsers),
+                              bytes=sum(p.data_size() for p in spider.parsers))
             if job.type.split('.')[0] in ('epub', 'epub3', 'html', 'kindle', 'cover', 'pdf'):
-                elect_coverpage(spider, job.url, job.dc)
+                with Metrics.stage('cover'):
+                    elect_coverpage(spider, job.url, job.dc)
             job.url = spider.redirect(job.url)
             job.base_url = job.url
             job.spider = spider
 
-        writer = WriterFactory.create(job.maintype)
-        writer.build(job)
-        ParserFactory.ParserFactory.sources[job.outputfile] = job.url
+        manifest = None
+        if options.incremental and job.url:
+            manifest = make_manifest(job)
+
+        if is_up_to_date(job, manifest):
+            info('%s is up to date, not rebuilding %s' % (job.type, job.outputfile))
+        else:
+            writer = WriterFactory.create(job.maintype)
+            with Metrics.stage('write'):
+                writer.build(job)
+            ParserFactory.ParserFactory.sources[job.outputfile] = job.url
+            save_manifest(job, manifest)
 
-        if options.validate:
-            writer.validate(job)
+            if options.validate:
+                with Metrics.stage('validate'):
+                    writer.validate(job)
 
-        packager = PackagerFactory.create(options.packager, job.type)
-        if packager:
-            packager.package(job)
+            packager = PackagerFactory.create(options.packager, job.type)
+            if packager:
+                with Metrics.stage('package'):
+                    packager.package(job)
 
         if job.type == 'html.images':
             # FIXME: hack for push packager
@@ -508,7 +760,7 @@ def do_job(job):
 
         if job.type.split('.')[0] == 'txt':
             # don't us GutenbergTextParser for subsequent builds
-            ParserFactory.ParserFactory.parsers = {}
+            ParserFactory.ParserFactory.clear_parser_cache()
 
     except SkipOutputFormat:
         debug(f"{job.type} skipped")
@@ -524,8 +776,160 @@ def do_job(job):
         close_log(log_handler)
 
 
-def config():
-    """ Process config files and commandline params. """
+def metrics_path(job):
+    """ Where to write the metrics of a job: next to its logfile. """
+
+    logfile = job.logfile or 'ebookmaker.log'
+    return os.path.join(os.path.abspath(job.outputdir),
+                        os.path.splitext(logfile)[0] + '.metrics.jsonl')
+
+
+def run_job(job, output_files):
+    """ Set up one job from the queue and do it. Return the DC used. """
+
+    if options.metrics:
+        Metrics.start(job)
+    try:
+        with Metrics.stage('job'):
+            debug('Job starting for type %s from %s', job.type, job.url)
+            Logger.ebook = job.ebook
+            with Metrics.stage('get_dc'):
+                dc = get_dc(job) # this is when doc at job.url gets parsed!
+            job.dc = dc
+            job.last_updated()
+            job.outputfile = job.outputfile or make_output_filename(job.type, dc)
+            output_files[job.type] = job.outputfile
+            source_type = SOURCE_FORMATS.get(job.type)
+            if source_type in output_files:
+                absoutputdir = os.path.abspath(job.outputdir)
+                job.url = os.path.join(absoutputdir, output_files[source_type])
+
+            options.outputdir = job.outputdir
+            do_job(job)
+            if dc and hasattr(dc, 'session') and dc.session:
+                dc.session.close()
+                dc.session = None # probably overkill
+            return dc
+    except Exception as e:
+        Logger.ebook = job.ebook or id_from_filename(job.url)
+        critical(f'Job #{Logger.ebook} failed for type {job.type} from {job.url}' )
+        exception(e)
+        return None
+    finally:
+        if options.metrics:
+            Metrics.finish(metrics_path(job))
+
+
+def job_dependencies(job_queue):
+    """ Find the jobs each job in the queue has to wait for.
+
+    Returns a list of sets of queue indices. A job depends on the
+    earlier jobs in the queue whose type it needs, either because
+    DEPENDENCIES says so or because it is built from their output.
+
+    """
+
+    graph = []
+    for i, job in enumerate(job_queue):
+        needs = set(DEPENDENCIES.get(job.type, ()))
+        if job.type in SOURCE_FORMATS:
+            needs.add(SOURCE_FORMATS[job.type])
+        graph.append({j for j, prev in enumerate(job_queue[:i]) if prev.type in needs})
+    return graph
+
+
+def init_worker(shared_options):
+    """ Initialize a worker process for parallel builds. """
+
+    options.update(shared_options)
+    Logger.set_log_level(options.verbose)
+    ParserFactory.load_parsers()
+    WriterFactory.load_writers()
+    PackagerFactory.load_packagers()
+
+
+def run_job_in_worker(job, output_files):
+    """ Do one job in a worker process.
+
+    Returns what the main process needs to know about the job, the
+    job itself holds parsers and trees that do not pickle.
+
+    """
+
+    # a worker picks up jobs in no particular order, so start each
+    # one like the first job of a sequential build
+    ParserFactory.ParserFactory.clear_parser_cache()
+    try:
+        dc = run_job(job, output_files)
+    finally:
+        # worker processes don't run atexit, remove the spilled images now
+        ParserFactory.ParserFactory.clear_parser_cache()
+    return {
+        'outputfile': job.outputfile,
+        'base_url': getattr(job, 'base_url', None),
+        'html_images_list': getattr(options, 'html_images_list', None),
+        'project_gutenberg_id': dc.project_gutenberg_id if dc else None,
+    }
+
+
+def run_jobs_parallel(job_queue, processes):
+    """ Do the jobs in the queue using a pool of worker processes.
+
+    A job is submitted as soon as all the jobs it depends on are
+    done. Returns a DC-like struct with the ebook number for the
+    push packager.
+
+    """
+
+    graph = job_dependencies(job_queue)
+    output_files = dict()
+    pending = list(range(len(job_queue)))
+    running = {}
+    done = set()
+    dc = None
+
+    debug('Building %d jobs in %d processes', len(job_queue), processes)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=init_worker,
+            initargs=(dict(vars(options)),)) as pool:
+        while pending or running:
+            for i in [i for i in pending if graph[i] <= done]:
+                pending.remove(i)
+                future = pool.submit(run_job_in_worker, job_queue[i], dict(output_files))
+                running[future] = i
+
+            finished, dummy_not_done = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                i = running.pop(future)
+                done.add(i)
+                job = job_queue[i]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    critical(f'Job #{job.ebook} failed for type {job.type} from {job.url}')
+                    exception(e)
+                    continue
+                if result['outputfile']:
+                    job.outputfile = result['outputfile']
+                    output_files[job.type] = job.outputfile
+                if result['base_url']:
+                    job.base_url = result['base_url']
+                if result['html_images_list'] is not None:
+                    options.html_images_list = result['html_images_list']
+                if result['project_gutenberg_id'] is not None:
+                    dc = CommonCode.Struct()
+                    dc.project_gutenberg_id = result['project_gutenberg_id']
+    return dc
+
+
+def config(args=None):
+    """ Process config files and commandline params.
+
+    args is a list of commandline arguments, default: sys.argv.
+
+    """
 
     ap = argparse.ArgumentParser(prog='EbookMaker')
     CommonCode.add_common_options(ap, CONFIG_FILES[1])
@@ -544,32 +948,21 @@ def config():
             'mobikf8': 'ebook-convert',
             'rhyming_dict': None,
             'timestamp': datetime.datetime.today().isoformat()[:19],
-        }
+        },
+        args
     )))
 
     if not re.search(r'^(https?|file):', options.url):
         options.url = os.path.abspath(options.url)
 
-def main():
-    """ Main program. """
-
-    try:
-        config()
-    except configparser.Error as what:
-        error("Error in configuration file: %s", str(what))
-        return 1
-
-    Logger.set_log_level(options.verbose)
+def build():
+    """ Build all types requested in options. """
 
     options.types = options.types or ['all']
     options.types = CommonCode.add_dependencies(options.types, DEPENDENCIES, BUILD_ORDER)
     debug("Building types: %s" % ' '.join(options.types))
     start_time = datetime.datetime.now()
 
-    ParserFactory.load_parsers()
-    WriterFactory.load_writers()
-    PackagerFactory.load_packagers()
-
     output_files = dict()
     if options.is_job_queue:
         job_queue = cPickle.load(sys.stdin.buffer) # read bytes
@@ -583,39 +976,12 @@ def main():
             job.outputdir = options.outputdir
             job_queue.append(job)
 
-    dc = None
-    for job in job_queue:
-        try:
-            debug('Job starting for type %s from %s', job.type, job.url)
-            Logger.ebook = job.ebook
-            dc = get_dc(job) # this is when doc at job.url gets parsed!
-            job.dc = dc
-            job.last_updated()
-            job.outputfile = job.outputfile or make_output_filename(job.type, dc)
-            output_files[job.type] = job.outputfile
-            if job.type.startswith('kindle'):
-                absoutputdir = os.path.abspath(job.outputdir)
-                if job.type == 'kindle.images' and 'epub.images' in output_files:
-                    job.url = os.path.join(absoutputdir, output_files['epub.images'])
-                elif job.type == 'kindle.noimages' and 'epub.noimages' in output_files:
-                    job.url = os.path.join(absoutputdir, output_files['epub.noimages'])
-            if job.type.startswith('kf8') and 'epub3.images' in output_files:
-                absoutputdir = os.path.abspath(job.outputdir)
-                job.url = os.path.join(absoutputdir, output_files['epub3.images'])
-            if job.type == 'pdf.images' and 'html.images' in output_files:
-                absoutputdir = os.path.abspath(job.outputdir)
-                job.url = os.path.join(absoutputdir, output_files['html.images'])
-
-            options.outputdir = job.outputdir
-            do_job(job)
-            if dc and hasattr(dc, 'session') and dc.session:
-                dc.session.close()
-                dc.session = None # probably overkill
-        except Exception as e:
-            Logger.ebook = job.ebook or id_from_filename(job.url)
-            critical(f'Job #{Logger.ebook} failed for type {job.type} from {job.url}' )
-            exception(e)
-            continue
+    if options.parallel > 1 and len(job_queue) > 1:
+        dc = run_jobs_parallel(job_queue, options.parallel)
+    else:
+        dc = None
+        for job in job_queue:
+            dc = run_job(job, output_files) or dc
 
     packager = PackagerFactory.create(options.packager, 'push')
     if packager:
@@ -629,5 +995,23 @@ def main():
     return 0
 
 
+def main():
+    """ Main program. """
+
+    try:
+        config()
+    except configparser.Error as what:
+        error("Error in configuration file: %s", str(what))
+        return 1
+
+    Logger.set_log_level(options.verbose)
+
+    ParserFactory.load_parsers()
+    WriterFactory.load_writers()
+    PackagerFactory.load_packagers()
+
+    return build()
+
+
 if __name__ == "__main__":
     sys.exit(main())
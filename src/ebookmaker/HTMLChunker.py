@@ -28,6 +28,7 @@ import libgutenberg.GutenbergGlobals as gg
 from libgutenberg.GutenbergGlobals import NS
 from libgutenberg.Logger import debug, error, info
 
+from ebookmaker import Metrics
 from ebookmaker.CommonCode import Options
 options = Options()
 
@@ -79,6 +80,7 @@ class HTMLChunker:
         self.version = version
         self.max_chunk_size = MAX_CHUNK_SIZE * (1 if version == 'epub2' else 3)
         self.nosplit = False
+        self.sizes = {}
 
         self.tags = {}
         for tag, size in SECTIONS:
@@ -97,29 +99,55 @@ class HTMLChunker:
         return urllib.parse.urlunparse(u)
 
 
+    def size(self, elem):
+        """ Serialized size of elem, measured only once. """
+
+        size = self.sizes.get(elem)
+        if size is None:
+            # size measurement doesn't need to be exact
+            try:
+                size = len(etree.tostring(elem, encoding='utf-8'))
+            except etree.SerialisationError:
+                size = len(etree.tostring(elem, encoding='latin_1'))
+            self.sizes[elem] = size
+        return size
+
+
     @staticmethod
     def make_template(tree):
         """ Make a copy with an empty html:body.
 
         This makes a template into which we can paste our chunks.
+        Only the skeleton is copied, not the contents of the body.
 
         """
 
-        template = copy.deepcopy(tree)
-
-        for c in xpath(template, '//xhtml:body'):
+        empty = set()
+        for c in xpath(tree, '//xhtml:body'):
 
             # descend while elem has only one child
             while len(c) == 1 and c[0].tag not in NEVER_SPLIT:
                 c = c[0]
+            empty.add(c)
+
+        skeleton = set(empty)
+        for c in empty:
+            skeleton.update(c.iterancestors())
 
+        def copy_skeleton(elem):
+            """ Copy elem, the elements in skeleton without their contents. """
+            if elem not in skeleton:
+                return copy.deepcopy(elem)
             # clear children but save attributes
-            attributes = c.attrib.items()
-            c.clear()
-            for a in attributes:
-                c.set(a[0], a[1])
+            elem_copy = elem.makeelement(elem.tag, elem.attrib, nsmap=elem.nsmap)
+            if elem not in empty:
+                elem_copy.text = elem.text
+                elem_copy.tail = elem.tail
+                for child in elem:
+                    elem_copy.append(copy_skeleton(child))
+            return elem_copy
 
-        return template
+        return copy_skeleton(tree)
 
 
     def reset_chunk(self, template):
@@ -177,6 +205,7 @@ class HTMLChunker:
             debug("Adding chunk %s (%d bytes) %s" % (chunk_name, self.chunk_size, chunk_id))
 
 
+    @Metrics.timed('chunk')
     def split(self, tree, attribs):
         """ Split whole html or split chunk.
 
@@ -204,11 +233,7 @@ class HTMLChunker:
                     # comments, processing instructions etc.
                     continue
 
-                # size measurement doesn't need to be exact
-                try:
-                    child_size = len(etree.tostring(child, encoding='utf-8'))
-                except etree.SerialisationError:
-                    child_size = len(etree.tostring(child, encoding='latin_1'))
+                child_size = self.size(child)
 
                 try:
                     tags = [child.tag + '.' + c for c in child.attrib['class'].split()]
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: UTF8 -*-
+
+"""
+
+Metrics.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Per-stage timing and memory metrics for jobs.
+
+Code marks a stage with
+
+  with Metrics.stage('chunk'):
+      ...
+  Metrics.count('chunk', docs=1, bytes=len(data))
+
+or decorates a function with @Metrics.timed('chunk'). Measurements
+are summed per stage over a job and written as one JSON line per
+stage when the job finishes. Nothing is measured unless a job was
+started with Metrics.start().
+
+Memory is reported as the growth of the peak RSS of the process and,
+if python runs with -X tracemalloc, as the peak of traced memory
+during the stage.
+
+"""
+
+import contextlib
+import functools
+import json
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # not on Windows
+    resource = None
+
+from libgutenberg.Logger import warning
+
+
+def maxrss():
+    """ Peak resident set size of the process in kB (0 if unknown). """
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class StageMetrics:
+    """ Measurements of one stage, summed over all calls. """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.maxrss = 0
+        self.maxrss_delta = 0
+        self.traced_peak = None
+        self.counts = {}
+
+
+    def as_dict(self):
+        """ The measurements in JSON-able form. """
+
+        d = {
+            'stage': self.name,
+            'calls': self.calls,
+            'wall_s': round(self.wall, 6),
+            'cpu_s': round(self.cpu, 6),
+            'maxrss_kb': self.maxrss,
+            'maxrss_delta_kb': self.maxrss_delta,
+        }
+        if self.traced_peak is not None:
+            d['tracemalloc_peak_kb'] = self.traced_peak // 1024
+        d.update(self.counts)
+        return d
+
+
+class JobMetrics:
+    """ The stages of one job. """
+
+    def __init__(self, job):
+        self.job = job
+        self.stages = {}
+        self.active = []  # [name, traced peak of nested stages]
+
+
+    def get(self, name):
+        """ Get or make the metrics for a stage. """
+        if name not in self.stages:
+            self.stages[name] = StageMetrics(name)
+        return self.stages[name]
+
+
+current = None
+
+
+def start(job):
+    """ Start collecting metrics for job. """
+
+    global current
+    current = JobMetrics(job)
+
+
+def finish(path):
+    """ Append the metrics of the current job to path and stop collecting. """
+
+    global current
+    job_metrics, current = current, None
+    if job_metrics is None:
+        return
+    lines = []
+    for stage_metrics in job_metrics.stages.values():
+        job = job_metrics.job
+        d = {
+            'ebook': job.ebook or getattr(job.dc, 'project_gutenberg_id', None) or 0,
+            'type': job.type,
+        }
+        d.update(stage_metrics.as_dict())
+        lines.append(json.dumps(d) + '\n')
+    try:
+        # one write, so parallel jobs don't mix their lines
+        with open(path, 'a', encoding='utf-8') as fp:
+            fp.write(''.join(lines))
+    except OSError as what:
+        warning('Cannot write metrics to %s: %s', path, what)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """ Measure the code in the with block as stage name. """
+
+    job_metrics = current
+    if job_metrics is None or any(name == active[0] for active in job_metrics.active):
+        # not collecting, or already inside this stage
+        yield
+        return
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        traced_start, traced_peak = tracemalloc.get_traced_memory()
+        if job_metrics.active:
+            # keep the peak of the enclosing stage before resetting it
+            job_metrics.active[-1][1] = max(job_metrics.active[-1][1], traced_peak)
+        tracemalloc.reset_peak()
+    active = [name, 0]
+    job_metrics.active.append(active)
+    rss_start = maxrss()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        rss = maxrss()
+        job_metrics.active.pop()
+
+        stage_metrics = job_metrics.get(name)
+        stage_metrics.calls += 1
+        stage_metrics.wall += wall
+        stage_metrics.cpu += cpu
+        stage_metrics.maxrss = max(stage_metrics.maxrss, rss)
+        stage_metrics.maxrss_delta += rss - rss_start
+        if tracing:
+            # nested stages reset the peak, they saved it in active
+            peak = max(tracemalloc.get_traced_memory()[1], active[1])
+            stage_metrics.traced_peak = max(stage_metrics.traced_peak or 0,
+                                            peak - traced_start)
+            if job_metrics.active:
+                job_metrics.active[-1][1] = max(job_metrics.active[-1][1], peak)
+
+
+def timed(name):
+    """ Decorator: measure every call of the function as stage name. """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, **counts):
+    """ Add counts (eg. docs=1, bytes=1234) to stage name. """
+
+    if current is None:
+        return
+    stage_counts = current.get(name).counts
+    for key, value in counts.items():
+        stage_counts[key] = stage_counts.get(key, 0) + value
@@ -27,6 +27,7 @@ from libgutenberg.Logger import critical, debug, error, info
 import libgutenberg.GutenbergGlobals as gg
 
 from ebookmaker import parsers
+from ebookmaker.parsers import ImageParser
 from ebookmaker.CommonCode import Options
 from ebookmaker.Version import VERSION
 
@@ -219,3 +220,4 @@ class ParserFactory:
             del parser
 
         cls.parsers = {}
+        ImageParser.remove_spilled()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: UTF8 -*-
+
+"""
+
+Worker.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Long-lived EbookMaker process that builds one book after another.
+
+Parsers, writers and packagers (and the libraries they import) are
+loaded once. Requests are JSON objects, one per line, read from stdin
+or from connections to a Unix socket:
+
+  {"args": ["--make=epub", "--output-dir=/tmp/out", "/path/to/book.html"]}
+
+"args" are the commandline arguments ebookmaker would be called with.
+For each request one JSON line is written back:
+
+  {"status": 0, "elapsed": 1.23}
+
+What argparse prints for --help or a usage error is returned in the
+"output" or "error" of the reply, not written to stdout.
+
+"""
+
+import argparse
+import configparser
+import contextlib
+import datetime
+import io
+import json
+import logging
+import os
+import socket
+import sys
+
+from libgutenberg.Logger import debug, info, error, exception
+from libgutenberg import Logger
+
+from ebookmaker import EbookMaker
+from ebookmaker import ParserFactory
+from ebookmaker import WriterFactory
+from ebookmaker.packagers import PackagerFactory
+from ebookmaker.CommonCode import Options
+
+options = Options()
+
+
+def reset():
+    """ Forget everything the last book left behind. """
+
+    options.__dict__.clear()
+    ParserFactory.ParserFactory.clear_parser_cache()
+    ParserFactory.ParserFactory.sources = {}
+    Logger.ebook = 0
+    Logger.notifier = None
+
+
+def do_request(line):
+    """ Build the book described by one request line. Return the reply. """
+
+    start_time = datetime.datetime.now()
+    try:
+        request = json.loads(line)
+        args = request['args']
+        if not isinstance(args, list):
+            raise ValueError('args must be a list of strings')
+    except (ValueError, KeyError, TypeError) as what:
+        error("Bad request %r: %s", line, what)
+        return {'status': 2, 'error': 'bad request: %s' % what}
+
+    log_level = logging.getLogger().level
+    reset()
+    usage = io.StringIO()
+    try:
+        # keep argparse output out of the reply stream
+        with contextlib.redirect_stdout(usage), contextlib.redirect_stderr(usage):
+            EbookMaker.config(args)
+        if options.is_job_queue:
+            raise ValueError('--jobs is not supported in worker mode')
+        Logger.set_log_level(options.verbose)
+        status = EbookMaker.build()
+        reply = {'status': status}
+    except SystemExit as what:
+        # argparse error or --help
+        reply = {'status': what.code or 0}
+        reply['error' if what.code else 'output'] = usage.getvalue()
+    except configparser.Error as what:
+        error("Error in configuration file: %s", str(what))
+        reply = {'status': 1, 'error': str(what)}
+    except Exception as what:
+        exception(what)
+        reply = {'status': 1, 'error': str(what)}
+    finally:
+        reset()
+        logging.getLogger().setLevel(log_level)
+
+    reply['elapsed'] = (datetime.datetime.now() - start_time).total_seconds()
+    return reply
+
+
+def serve_stream(infile, outfile):
+    """ Answer request lines from infile until EOF. """
+
+    for line in infile:
+        line = line.strip()
+        if not line:
+            continue
+        reply = do_request(line)
+        outfile.write(json.dumps(reply) + '\n')
+        outfile.flush()
+
+
+def serve_socket(path):
+    """ Answer requests on a Unix socket, one connection at a time. """
+
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+    info('Listening on %s', path)
+    try:
+        while True:
+            conn, dummy_address = server.accept()
+            with conn, conn.makefile('r', encoding='utf-8') as infile, \
+                    conn.makefile('w', encoding='utf-8') as outfile:
+                try:
+                    serve_stream(infile, outfile)
+                except OSError as what:
+                    # client went away
+                    debug('Connection closed: %s', what)
+    finally:
+        server.close()
+        os.unlink(path)
+
+
+def main():
+    """ Main program. """
+
+    ap = argparse.ArgumentParser(prog='EbookMaker worker')
+    ap.add_argument(
+        "--socket",
+        metavar="PATH",
+        dest="socket",
+        default=None,
+        help="listen on Unix socket PATH (default: read requests from stdin)")
+    ap.add_argument(
+        "--extension-package",
+        metavar="PYTHON_PACKAGE",
+        dest="extension_packages",
+        default=[],
+        action="append",
+        help="PG internal use only: load extensions from package")
+    ap.add_argument(
+        "--verbose", "-v",
+        action="count",
+        default=0,
+        help="be verbose (-v -v be more verbose)")
+    worker_options = ap.parse_args()
+
+    options.update(vars(worker_options))
+    Logger.set_log_level(options.verbose)
+    ParserFactory.load_parsers()
+    WriterFactory.load_writers()
+    PackagerFactory.load_packagers()
+
+    try:
+        if worker_options.socket:
+            serve_socket(worker_options.socket)
+        else:
+            serve_stream(sys.stdin, sys.stdout)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: UTF8 -*-
+
+"""
+
+ZipWriter.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+A zip file that deflates its members in a pool of threads.
+
+zlib releases the GIL while it compresses, so members added with
+queue() or write_file() are compressed concurrently. They are written
+to the archive in the order they were added, and compressed the same
+way ZipFile compresses them, so the archive is the same as one written
+one member after another.
+
+ZipFile has no public way to write a member that is compressed
+already, or to stream a member with a given compression level, so
+write_compressed and open_member use its internals. They do so only
+with the CPython versions in ZIPFILE_PYTHONS, which test_zip_threads
+checks; with any other python members are compressed one after another
+and streamed members get zlib's default level.
+
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import functools
+import os
+import platform
+import sys
+import zipfile
+import zlib
+
+from libgutenberg.Logger import warning
+
+from ebookmaker.CommonCode import Options
+
+options = Options()
+
+MAX_QUEUED_SIZE = 16 * 1024 * 1024  # bigger files are streamed, not read into memory
+
+# the versions of zipfile the internals used here were checked with, see setup.py
+ZIPFILE_PYTHONS = ((3, 9), (3, 10), (3, 11), (3, 12))
+
+
+def level_option(value):
+    """ Parse an EXT=LEVEL command line argument. """
+    try:
+        ext, level = value.split('=')
+        level = int(level)
+        if not 0 <= level <= 9:
+            raise ValueError
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected EXT=LEVEL, LEVEL 0-9, got '%s'" % value)
+    if ext != '*' and not ext.startswith('.'):
+        ext = '.' + ext
+    return ext.lower(), level
+
+
+def pinned_python():
+    """ Is this python one of ZIPFILE_PYTHONS? """
+    return (platform.python_implementation() == 'CPython'
+            and sys.version_info[:2] in ZIPFILE_PYTHONS)
+
+
+@functools.lru_cache(maxsize=None)
+def pool_supported():
+    """ Does write_compressed work with the zipfile of this python? """
+    if pinned_python():
+        return True
+    warning('Compressing zip members in one thread, --zip-threads does not support python %s',
+            platform.python_version())
+    return False
+
+
+@functools.lru_cache(maxsize=None)
+def stream_level_supported():
+    """ Can open_member set the compression level with the zipfile of this python? """
+    if pinned_python():
+        return True
+    warning('Streaming zip members with the default level, --zip-level does not support '
+            'them with python %s', platform.python_version())
+    return False
+
+
+def deflate(data, level):
+    """ Compress data like ZipFile does. Returns (crc, compressed data). """
+    if level is None:
+        level = zlib.Z_DEFAULT_COMPRESSION
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return zlib.crc32(data), compressor.compress(data) + compressor.flush()
+
+
+class ZipWriter(zipfile.ZipFile):
+    """ A zip file for writing that compresses members in threads.
+
+    threads defaults to options.zip_threads, levels (compression level
+    by file extension, '*' for all others) to options.zip_levels.
+
+    """
+
+    def __init__(self, file, compression=zipfile.ZIP_DEFLATED, threads=None, levels=None):
+        zipfile.ZipFile.__init__(self, file, 'w', compression)
+        if threads is None:
+            threads = getattr(options, 'zip_threads', 0) or 0
+        if levels is None:
+            levels = getattr(options, 'zip_levels', None) or []
+        self.levels = dict(levels)
+        self.pool = None
+        if threads > 1 and pool_supported():
+            self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+        self.window = 2 * threads  # compressed members waiting to be written
+        self.queued = collections.deque()
+
+
+    def level(self, name):
+        """ The compression level for member name, None for zlib's default. """
+        ext = os.path.splitext(name)[1].lower()
+        return self.levels.get(ext, self.levels.get('*'))
+
+
+    def compresses_in_pool(self, zinfo):
+        """ Will queue() compress this member in the pool? """
+        return self.pool is not None and zinfo.compress_type == zipfile.ZIP_DEFLATED
+
+
+    def queue(self, zinfo, data):
+        """ Add a member from bytes or str, compressed in the pool if possible. """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        level = self.level(zinfo.filename)
+        if not self.compresses_in_pool(zinfo):
+            self.writestr(zinfo, data, compresslevel=level)
+            return
+        zinfo.file_size = len(data)
+        self.queued.append((zinfo, self.pool.submit(deflate, data, level)))
+        while len(self.queued) > self.window:
+            self.write_compressed(*self.queued.popleft())
+
+
+    def write_file(self, filename, arcname, compress_type=None):
+        """ ZipFile.write, but compressed in the pool if possible. """
+        zinfo = zipfile.ZipInfo.from_file(filename, arcname)
+        zinfo.compress_type = self.compression if compress_type is None else compress_type
+        if self.compresses_in_pool(zinfo) and zinfo.file_size <= MAX_QUEUED_SIZE:
+            with open(filename, 'rb') as fp:
+                self.queue(zinfo, fp.read())
+        else:
+            self.write(filename, arcname, compress_type, self.level(zinfo.filename))
+
+
+    def open_member(self, zinfo):
+        """ ZipFile.open(zinfo, 'w') with the compression level for zinfo. """
+        level = self.level(zinfo.filename)
+        if level is not None and stream_level_supported():
+            zinfo._compresslevel = level
+        return self.open(zinfo, 'w')
+
+
+    def write_compressed(self, zinfo, future):
+        """ Write a member that was compressed in the pool.
+
+        Does what ZipFile.writestr does, with the internals of the
+        zipfile versions in ZIPFILE_PYTHONS.
+
+        """
+        crc, compressed = future.result()
+        zinfo.CRC = crc
+        zinfo.compress_size = len(compressed)
+        zinfo.flag_bits = 0x00
+        if not zinfo.external_attr:
+            zinfo.external_attr = 0o600 << 16
+        zip64 = max(zinfo.file_size, zinfo.compress_size) > zipfile.ZIP64_LIMIT
+        if zip64 and not self._allowZip64:
+            raise zipfile.LargeZipFile("Filesize would require ZIP64 extensions")
+        with self._lock:
+            if self._seekable:
+                self.fp.seek(self.start_dir)
+            zinfo.header_offset = self.fp.tell()
+            self._writecheck(zinfo)
+            self._didModify = True
+            self.fp.write(zinfo.FileHeader(zip64))
+            self.fp.write(compressed)
+            self.start_dir = self.fp.tell()
+            self.filelist.append(zinfo)
+            self.NameToInfo[zinfo.filename] = zinfo
+
+
+    def flush_queued(self):
+        """ Write all queued members. """
+        while self.queued:
+            self.write_compressed(*self.queued.popleft())
+
+
+    def open(self, name, mode='r', pwd=None, *, force_zip64=False):
+        if mode == 'w':
+            # keep the order of the members
+            self.flush_queued()
+        return zipfile.ZipFile.open(self, name, mode, pwd, force_zip64=force_zip64)
+
+
+    def close(self):
+        try:
+            if self.fp is not None:
+                self.flush_queued()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+            zipfile.ZipFile.close(self)
@@ -790,6 +790,9 @@ class Parser (docutils.parsers.rst.Parser):
             None,
             (('Recognize page numbers and page references (like "[pg n] and [pg n]_").',
              ['--page-numbers'],
+             {'action': 'store_true', 'validator': frontend.validate_boolean}),
+             ('Run each transform in its own pass over the document (for debugging).',
+             ['--separate-transform-passes'],
              {'action': 'store_true', 'validator': frontend.validate_boolean}),))
 
         settings_defaults = {
@@ -66,6 +66,90 @@ class ContentsFilter (nodes.TreeCopyVisitor):
     visit_target = ignore_node_but_process_children
 
 
+def walk (node, transforms):
+    """
+    Walk node and its descendants in document order, calling the
+    handlers of transforms in their order on each node.
+
+    If a visit handler replaces the node, the transforms up to that
+    one finish the old node, the transforms after it walk the
+    replacement.
+
+    """
+
+    for i, transform in enumerate (transforms):
+        if isinstance (node, transform.visit_types):
+            replacement = transform.visit (node)
+            if replacement is not None:
+                walk_children_and_depart (node, transforms[:i + 1])
+                walk (replacement, transforms[i + 1:])
+                return
+    walk_children_and_depart (node, transforms)
+
+
+def walk_children_and_depart (node, transforms):
+    """ Rest of `walk`. """
+
+    if isinstance (node, nodes.Element):
+        for child in list (node.children):
+            walk (child, transforms)
+    for transform in reversed (transforms):
+        if isinstance (node, transform.depart_types):
+            transform.depart (node)
+
+
+class WalkTransform (docutils.transforms.Transform):
+    """
+    A transform that works on one node at a time.
+
+    Subclasses set `visit_types` and `depart_types` and define
+    `visit`, called before the children of a node of those types,
+    and `depart`, called after them.  `visit` may replace the node
+    in the tree and return the replacement.
+
+    Walk transforms that follow each other in the transformer queue
+    are applied together in one walk over the document.  The setting
+    `separate_transform_passes` makes each one walk the document by
+    itself (for debugging).
+
+    """
+
+    visit_types = ()
+    depart_types = ()
+
+    def visit (self, node):
+        """ Called before the children of node. """
+        return None
+
+    def depart (self, node):
+        """ Called after the children of node. """
+
+    def apply (self, **kwargs):
+        transforms = [self]
+        if not getattr (self.document.settings, 'separate_transform_passes', False):
+            transforms.extend (self.pop_walk_transforms ())
+        walk (self.document, transforms)
+
+    def pop_walk_transforms (self):
+        """ Take the walk transforms that come next out of the transformer queue. """
+
+        transformer = self.document.transformer
+        if not transformer.sorted:
+            transformer.transforms.sort (reverse = True)
+            transformer.sorted = True
+
+        transforms = []
+        while transformer.transforms:
+            priority, transform_class, pending, kwargs = transformer.transforms[-1]
+            if (pending is not None or kwargs or
+                not issubclass (transform_class, WalkTransform)):
+                break
+            transformer.transforms.pop ()
+            transformer.applied.append ((priority, transform_class, pending, kwargs))
+            transforms.append (transform_class (self.document))
+        return transforms
+
+
 ###########
 ### 200 ###
 ###########
@@ -173,20 +257,24 @@ class TitleLevelTransform (docutils.transforms.Transform):
 ###########
 
 
-class TocPageNumberTransform (docutils.transforms.Transform):
+class TocPageNumberTransform (WalkTransform):
     """ Finds the page number all sections, tables and figures are in. """
 
     default_priority = 715 # before contents transform
 
-    def apply (self, **kwargs):
-        pageno = '' # pageno is actually a string
+    visit_types = (nodes.target, nodes.section, nodes.figure, nodes.table)
+
+    def __init__ (self, document, startnode = None):
+        WalkTransform.__init__ (self, document, startnode)
+        self.pageno = '' # pageno is actually a string
 
-        for n in self.document.traverse ():
-            if isinstance (n, nodes.target) and 'pageno' in n:
-                pageno = n['pageno']
+    def visit (self, n):
+        if isinstance (n, nodes.target):
+            if 'pageno' in n:
+                self.pageno = n['pageno']
                 # debug ("pageno: >%s<" % self.pageno)
-            elif isinstance (n, (nodes.section, nodes.figure, nodes.table)):
-                n['pageno'] = pageno
+        else:
+            n['pageno'] = self.pageno
 
 
 class TocEntryTransform (docutils.transforms.Transform):
@@ -555,7 +643,7 @@ class DropCapTransform (docutils.transforms.Transform):
         self.startnode.parent.remove (self.startnode)
 
 
-class InlineImageTransform (docutils.transforms.Transform):
+class InlineImageTransform (WalkTransform):
     """Set class 'inline' or 'block' on an image according to actual
     usage so it can be used for styling.
 
@@ -563,12 +651,13 @@ class InlineImageTransform (docutils.transforms.Transform):
 
     default_priority = 730 # before StyleTransform
 
-    def apply (self):
-        for image in self.document.traverse (nodes.image):
-            if isinstance (image.parent, nodes.TextElement):
-                image['classes'] += ['inline']
-            else:
-                image['classes'] += ['block']
+    visit_types = (nodes.image, )
+
+    def visit (self, image):
+        if isinstance (image.parent, nodes.TextElement):
+            image['classes'] += ['inline']
+        else:
+            image['classes'] += ['block']
 
 
 class StyleTransform (docutils.transforms.Transform):
@@ -658,7 +747,7 @@ class StyleTransform (docutils.transforms.Transform):
 ###########
 
 
-class FirstParagraphTransform (docutils.transforms.Transform):
+class FirstParagraphTransform (WalkTransform):
     """
     Mark first paragraphs.
 
@@ -672,43 +761,50 @@ class FirstParagraphTransform (docutils.transforms.Transform):
 
     default_priority = 800 # late
 
-    def apply (self, **kwargs):
-        self.recurse (self.document, False)
+    visit_types = (nodes.Node, )
+    depart_types = (nodes.Element, )
 
-    def recurse (self, parent, follows_paragraph):
-        # follows_paragraph = False # flag: previous element is paragraph
-
-        for node in parent:
+    def __init__ (self, document, startnode = None):
+        WalkTransform.__init__ (self, document, startnode)
+        # flag: previous element is paragraph, for each level
+        self.follows_paragraph = [False]
+
+    def visit (self, node):
+        follows_paragraph = self.follows_paragraph[-1]
+
+        if isinstance (node, (nodes.paragraph)):
+            node['classes'].append ('pnext' if follows_paragraph else 'pfirst')
+            follows_paragraph = True
+        elif isinstance (node, (nodes.title, nodes.subtitle)):
+            # title may also be output as <html:p>
+            node['classes'].append ('pfirst')
+            follows_paragraph = False
+        elif isinstance (node, (mynodes.page)):
+            # explicit vertical space or page breaks
+            follows_paragraph = False
+        elif isinstance (node, (nodes.container, nodes.compound,
+                                nodes.Invisible, nodes.footnote, nodes.figure)):
+            # invisible nodes are neutral, footnotes are not
+            # output here so they are neutral too.  figures are
+            # neutral because they can float away.  (also,
+            # paragraphs in real books may contain block figures
+            # so not indenting the following paragraph would look
+            # ambiguous.)
+            pass
+        else:
+            # everything else
+            follows_paragraph = False
 
-            if isinstance (node, (nodes.paragraph)):
-                node['classes'].append ('pnext' if follows_paragraph else 'pfirst')
-                follows_paragraph = True
-            elif isinstance (node, (nodes.title, nodes.subtitle)):
-                # title may also be output as <html:p>
-                node['classes'].append ('pfirst')
-                follows_paragraph = False
-            elif isinstance (node, (mynodes.page)):
-                # explicit vertical space or page breaks
-                follows_paragraph = False
-            elif isinstance (node, (nodes.container, nodes.compound,
-                                    nodes.Invisible, nodes.footnote, nodes.figure)):
-                # invisible nodes are neutral, footnotes are not
-                # output here so they are neutral too.  figures are
-                # neutral because they can float away.  (also,
-                # paragraphs in real books may contain block figures
-                # so not indenting the following paragraph would look
-                # ambiguous.)
-                pass
-            else:
-                # everything else
-                follows_paragraph = False
+        self.follows_paragraph[-1] = follows_paragraph
+        if isinstance (node, nodes.Element):
+            self.follows_paragraph.append (follows_paragraph)
 
-            if not isinstance (node, nodes.Text):
-                self.recurse (node, follows_paragraph)
+    def depart (self, node):
+        self.follows_paragraph.pop ()
 
 
 
-class BlockImageWrapper (docutils.transforms.Transform):
+class BlockImageWrapper (WalkTransform):
     """
     Wrap a block-level image into a figure.
 
@@ -716,33 +812,36 @@ class BlockImageWrapper (docutils.transforms.Transform):
 
     default_priority = 801
 
-    def apply (self):
+    visit_types = (nodes.image, )
 
-        for image in self.document.traverse (nodes.image):
+    def visit (self, image):
 
-            # skip inline images
-            # (See also: class `TextElement` in `docutils.nodes`.)
-            if isinstance (image.parent, nodes.TextElement):
-                continue
-
-            # wrap all block images into figures
-            if isinstance (image.parent, nodes.figure):
-                figure = image.parent
-            else:
-                figure = nodes.figure ()
-                figure['float'] = ('none', ) # do not float bare images
-                figure['width'] = image.attributes.get ('width', 'image')
-                figure['align'] = image.attributes.get ('align', 'center')
-                image['width']  = '100%'
-                image.replace_self (figure)
-                figure.append (image)
+        # skip inline images
+        # (See also: class `TextElement` in `docutils.nodes`.)
+        if isinstance (image.parent, nodes.TextElement):
+            return None
 
-            # set default width, align for block images only
-            image.setdefault ('width', '100%')
-            image.setdefault ('align', 'center')
-
-
-class SetDefaults (docutils.transforms.Transform):
+        # wrap all block images into figures
+        if isinstance (image.parent, nodes.figure):
+            figure = image.parent
+            replacement = None
+        else:
+            figure = nodes.figure ()
+            figure['float'] = ('none', ) # do not float bare images
+            figure['width'] = image.attributes.get ('width', 'image')
+            figure['align'] = image.attributes.get ('align', 'center')
+            image['width']  = '100%'
+            image.replace_self (figure)
+            figure.append (image)
+            replacement = figure
+
+        # set default width, align for block images only
+        image.setdefault ('width', '100%')
+        image.setdefault ('align', 'center')
+        return replacement
+
+
+class SetDefaults (WalkTransform):
     """Set default attributes.
 
     Set default attributes to simplify writers.
@@ -761,6 +860,32 @@ class SetDefaults (docutils.transforms.Transform):
 
     default_priority = 802
 
+    # Image default attributes are set in BlockImageWrapper.
+    defaults = (
+        (nodes.figure, (
+            ('align',          'center'),
+            ('float',          ('here', 'top', 'bottom', 'page')),
+            ('width',          'image'),
+        )),
+        (nodes.table, (
+            ('align',          'center'),
+            ('float',          ('here', 'top', 'bottom', 'page')),
+            ('hrules',         ('table', 'rows')),
+            ('summary',        'no summary'),
+            ('tabularcolumns', None),
+            ('vrules',         ('none', )),
+            ('width',          '100%'),
+        )),
+        (nodes.topic, (
+            ('float',          ('here', )),
+        )),
+        (nodes.sidebar, (
+            ('float',          ('here', )),
+        )),
+    )
+
+    visit_types = (nodes.image, nodes.figure, nodes.table, nodes.topic, nodes.sidebar)
+
     def get_default_width (self, uri):
         """Calculate a sensible default width for images.
 
@@ -783,46 +908,23 @@ class SetDefaults (docutils.transforms.Transform):
         return '100%'
 
 
-    def apply (self, **kwargs):
-
-        def setdefault (node_type, l):
-            for node in self.document.traverse (node_type):
-                for name, default in l:
-                    node.setdefault (name, default)
-
-        # Image default attributes are set in BlockImageWrapper.
-
-        setdefault (nodes.figure, (
-            ('align',          'center'),
-            ('float',          ('here', 'top', 'bottom', 'page')),
-            ('width',          'image'),
-        ))
-
-        for image in self.document.traverse (nodes.image):
-            if isinstance (image.parent, nodes.figure):
-                figure = image.parent
+    def visit (self, node):
+        # figures come before their images, so they have their defaults
+        if isinstance (node, nodes.image):
+            if isinstance (node.parent, nodes.figure):
+                figure = node.parent
                 if figure['width'] == 'image':
-                    figure['width'] = self.get_default_width (image['uri'])
+                    figure['width'] = self.get_default_width (node['uri'])
                     figure['classes'].append ('auto-scaled')
+            return
 
-        setdefault (nodes.table, (
-            ('align',          'center'),
-            ('float',          ('here', 'top', 'bottom', 'page')),
-            ('hrules',         ('table', 'rows')),
-            ('summary',        'no summary'),
-            ('tabularcolumns', None),
-            ('vrules',         ('none', )),
-            ('width',          '100%'),
-        ))
-        setdefault (nodes.topic, (
-            ('float',          ('here', )),
-        ))
-        setdefault (nodes.sidebar, (
-            ('float',          ('here', )),
-        ))
+        for node_type, l in self.defaults:
+            if isinstance (node, node_type):
+                for name, default in l:
+                    node.setdefault (name, default)
 
 
-class AlignTransform (docutils.transforms.Transform):
+class AlignTransform (WalkTransform):
     """
     Transforms align attribute into align-* class.
 
@@ -830,14 +932,16 @@ class AlignTransform (docutils.transforms.Transform):
 
     default_priority = 803 # after SetDefaults
 
-    def apply (self):
-        for body in self.document.traverse (
-            lambda x: isinstance (x, (nodes.Body, nodes.Structural))):
-            if 'align' in body:
-                body['classes'].append ('align-%s' % body['align'])
+    # on departure, after the images of a figure have set its width
+    # and classes
+    depart_types = (nodes.Body, nodes.Structural)
+
+    def depart (self, body):
+        if 'align' in body:
+            body['classes'].append ('align-%s' % body['align'])
 
 
-class TextTransform (docutils.transforms.Transform):
+class TextTransform (WalkTransform):
     """
     Implements CSS text-transform.
 
@@ -852,12 +956,18 @@ class TextTransform (docutils.transforms.Transform):
 
     re_quotes_thin_space = re.compile (r'([“„‟’])([‘‚‛”])')
 
-    def apply (self, **kwargs):
-        self.recurse (self.document, {})
+    visit_types = (nodes.Node, )
+    depart_types = (nodes.Element, )
+
+    def __init__ (self, document, startnode = None):
+        WalkTransform.__init__ (self, document, startnode)
+        self.text_transforms = [{}]
 
     # FIXME this has been obsoleted by class inheritance
 
-    def recurse (self, node, text_transform):
+    def visit (self, node):
+        text_transform = self.text_transforms[-1]
+
         if isinstance (node, nodes.Text):
             if len (text_transform) > 0:
                 oldtext = text = node.astext ()
@@ -868,8 +978,10 @@ class TextTransform (docutils.transforms.Transform):
                     # insert thin space between quotes
                     text = self.re_quotes_thin_space.sub (r'\1 \2', text)
                 if text != oldtext:
-                    node.parent.replace (node, nodes.Text (text)) # cannot change text nodes
-            return
+                    new_node = nodes.Text (text) # cannot change text nodes
+                    node.parent.replace (node, new_node)
+                    return new_node
+            return None
 
         ntt = text_transform.copy ()
         classes = node['classes']
@@ -885,8 +997,11 @@ class TextTransform (docutils.transforms.Transform):
         if 'white-space-pre-line' in classes:
             ntt['pre-line'] = True
 
-        for child in node:
-            self.recurse (child, ntt)
+        self.text_transforms.append (ntt)
+        return None
+
+    def depart (self, node):
+        self.text_transforms.pop ()
 
 
 class CharsetTransform (docutils.transforms.Transform):
@@ -908,7 +1023,7 @@ class CharsetTransform (docutils.transforms.Transform):
                 text  = n.astext ()
 
 
-class TextNodeWrapper (docutils.transforms.Transform):
+class TextNodeWrapper (WalkTransform):
     """
     Wrap all naked Text nodes in inline nodes.
 
@@ -918,17 +1033,20 @@ class TextNodeWrapper (docutils.transforms.Transform):
 
     default_priority = 897 # before NodeTypeTransform
 
-    def apply (self):
-        for node in self.document.traverse (nodes.Text):
+    visit_types = (nodes.Text, )
 
-            # skip already wrapped nodes
-            if isinstance (node.parent, nodes.Inline):
-                continue
+    def visit (self, node):
+
+        # skip already wrapped nodes
+        if isinstance (node.parent, nodes.Inline):
+            return None
 
-            node.parent.replace (node, nodes.inline ('', node.astext ()))
+        inline = nodes.inline ('', node.astext ())
+        node.parent.replace (node, inline)
+        return inline
 
 
-class NodeTypeTransform (docutils.transforms.Transform):
+class NodeTypeTransform (WalkTransform):
     """
     Determines the type of a node.
 
@@ -958,21 +1076,23 @@ class NodeTypeTransform (docutils.transforms.Transform):
 
     default_priority = 898
 
-    def apply (self, **kwargs):
-        for node in self.document.traverse ():
-            node.type = \
-                'text'   if isinstance (node, nodes.Text) else (
-                'inline' if isinstance (node, nodes.Inline) else (
-                'simple' if isinstance (node, nodes.TextElement) else
-                'empty'  if isinstance (node, (nodes.transition, nodes.image)) else
-                'compound'))
+    visit_types = (nodes.Node, )
+
+    def visit (self, node):
+        node.type = \
+            'text'   if isinstance (node, nodes.Text) else (
+            'inline' if isinstance (node, nodes.Inline) else (
+            'simple' if isinstance (node, nodes.TextElement) else
+            'empty'  if isinstance (node, (nodes.transition, nodes.image)) else
+            'compound'))
 
-            # this helps distinguish the use of elements than can be
-            # both blocks or inline elements (eg. images)
-            node.is_block = not node.parent or not isinstance (node.parent, (nodes.TextElement))
+        # this helps distinguish the use of elements than can be
+        # both blocks or inline elements (eg. images)
+        node.is_block = not node.parent or not isinstance (node.parent, (nodes.TextElement))
+        return None
 
 
-class InheritTransform (docutils.transforms.Transform):
+class InheritTransform (WalkTransform):
     """
     Inheritance for docutil classes. Abstract base class.
 
@@ -1020,10 +1140,20 @@ class InheritTransform (docutils.transforms.Transform):
         'compound': apply_to_simple | apply_to_inline | apply_to_text,
         }
 
-    def apply (self, **kwargs):
-        self.recurse (None, self.document, set ())
+    visit_types = (nodes.Node, )
+    depart_types = (nodes.Element, )
+
+    def __init__ (self, document, startnode = None):
+        WalkTransform.__init__ (self, document, startnode)
+        self.passed_on = [set ()]
+
+    def visit (self, node):
+        inherited_classes = self.passed_on[-1]
+
+        if isinstance (node, nodes.Text):
+            node.attributes = {'classes': list (inherited_classes) } # HACK! Text has no attributes
+            return None
 
-    def recurse (self, parent, node, inherited_classes):
         classes_to_pass_on = self.pass_on[node.type]
 
         classes = set (node['classes']) | inherited_classes
@@ -1035,10 +1165,8 @@ class InheritTransform (docutils.transforms.Transform):
         # this avoids problems with classes like 'smaller'
         node['classes'] = list (classes - classes_to_pass_on)
 
-        passed_on_classes = classes & classes_to_pass_on
+        self.passed_on.append (classes & classes_to_pass_on)
+        return None
 
-        for n in node.children:
-            if isinstance (n, nodes.Text):
-                n.attributes = {'classes': list (passed_on_classes) } # HACK! Text has no attributes
-            else:
-                self.recurse (node, n, passed_on_classes)
+    def depart (self, node):
+        self.passed_on.pop ()
@@ -22,6 +22,8 @@ import zipfile
 from libgutenberg.Logger import debug, info, warning, error
 import libgutenberg.GutenbergGlobals as gg
 
+from ebookmaker.ZipWriter import ZipWriter
+
 GZIP_EXTENSION = '.gzip'
 
 class BasePackager:
@@ -77,7 +79,7 @@ class ZipPackager(BasePackager):
         """ Create a zip file. """
 
         info('Creating Zip file: %s' % zipfilename)
-        return  zipfile.ZipFile(zipfilename, 'w', zipfile.ZIP_DEFLATED)
+        return ZipWriter(zipfilename)
 
 
     @staticmethod
@@ -88,9 +90,9 @@ class ZipPackager(BasePackager):
             os.stat(filename)
             dummy_name, ext = os.path.splitext(filename)
             debug('  Adding file: %s as %s' % (filename, memberfilename))
-            zip_.write(filename, memberfilename,
-                        zipfile.ZIP_STORED if ext in ['.zip', '.png']
-                        else zipfile.ZIP_DEFLATED)
+            zip_.write_file(filename, memberfilename,
+                            zipfile.ZIP_STORED if ext in ['.zip', '.png']
+                            else zipfile.ZIP_DEFLATED)
         except OSError:
             warning('ZipPackager: Cannot add file %s', filename)
 
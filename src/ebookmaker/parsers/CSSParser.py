@@ -13,6 +13,8 @@ Open an url and return raw data.
 
 """
 
+import collections
+import hashlib
 import logging
 import re
 from six.moves import urllib
@@ -81,6 +83,134 @@ PG_CSS_PROFILE = (
 
 cssutils.profile.addProfiles([PG_CSS_PROFILE])
 
+# Parsed stylesheets and serialized results by a hash of the css text.
+# cssutils sheets can be neither copied nor pickled, so only code that
+# does not change a sheet may use a cached one.
+SHEET_CACHE_SIZE = 100
+sheet_cache = collections.OrderedDict()
+
+
+class CSSRewriter:
+    """ Rewrite a sheet with a set of fixes, in one pass over its rules.
+
+    selector_fixes: f(text) -> the new text of each selector of a style rule.
+    style_fixes: f(rule) changes a style rule, returns False to drop it.
+    media_fixes: f(rule) changes an @media rule.
+    replace: f(rule) -> list of rules to put in place of a fixed rule, None to keep it.
+    append: (selector text, style text) of style rules to add at the end.
+    url_fix: f(url) -> the new url, for all urls in the sheet.
+
+    Fixes run in the order given, selector fixes before style fixes.
+
+    """
+
+    def __init__(self, selector_fixes=(), style_fixes=(), media_fixes=(),
+                 replace=None, append=(), url_fix=None):
+        self.selector_fixes = list(selector_fixes)
+        self.style_fixes = list(style_fixes)
+        self.media_fixes = list(media_fixes)
+        self.replace = replace
+        self.append = list(append)
+        self.url_fix = url_fix
+
+
+    def fix_selectors(self, rule):
+        """ Run the selector fixes, reparse only the selectors that changed. """
+        for selector in rule.selectorList:
+            text = new_text = selector.selectorText
+            for fix in self.selector_fixes:
+                new_text = fix(new_text)
+            if new_text != text:
+                selector.selectorText = new_text
+
+
+    def apply(self, sheet):
+        """ Rewrite sheet in place. """
+        rules = []
+        dropped = []
+        for rule in sheet:
+            if rule.type == rule.STYLE_RULE:
+                if self.selector_fixes:
+                    self.fix_selectors(rule)
+                if any(fix(rule) is False for fix in self.style_fixes):
+                    dropped.append(rule)
+                    continue
+            elif rule.type == rule.MEDIA_RULE:
+                for fix in self.media_fixes:
+                    fix(rule)
+            if self.replace is not None:
+                new_rules = self.replace(rule)
+                rules.extend([rule] if new_rules is None else new_rules)
+
+        if self.replace is not None:
+            sheet.cssRules.clear()
+            for rule in rules:
+                sheet.add(rule)
+        else:
+            for rule in dropped:
+                sheet.deleteRule(rule)
+        for selector_text, style in self.append:
+            sheet.add(cssutils.css.CSSStyleRule(selectorText=selector_text, style=style))
+        if self.url_fix is not None:
+            cssutils.replaceUrls(sheet, self.url_fix)
+
+
+def lowercase_selector(text):
+    """ Make element names in a selector lowercase to match xhtml tags. """
+    return RE_ELEMENT.sub(lambda m: m.group(1).lower() if m.group(1) else m.group(0), text)
+
+
+def drop_images(rule):
+    """ Style fix: drop rules with url() in them. """
+    if rule.cssText and 'url(' in rule.cssText:
+        return False
+    return True
+
+
+def new_sheet(css_text):
+    """ Parse css_text into a new sheet with lowercase selectors. """
+    sheet = cssutils.CSSParser().parseString(css_text)
+    CSSRewriter(selector_fixes=[lowercase_selector]).apply(sheet)
+    return sheet
+
+
+def cached(key, make):
+    """ Get key from the sheet cache, make() it if it's not there. """
+    if key in sheet_cache:
+        sheet_cache.move_to_end(key)
+        return sheet_cache[key]
+    value = make()
+    sheet_cache[key] = value
+    if len(sheet_cache) > SHEET_CACHE_SIZE:
+        sheet_cache.popitem(last=False)
+    return value
+
+
+def css_key(css_text):
+    """ Hash of css_text. """
+    return hashlib.sha256(css_text.encode('utf-8', 'surrogateescape')).digest()
+
+
+def shared_sheet(css_text):
+    """ The sheet for css_text, parsed once. It is shared: don't change it. """
+    return cached((css_key(css_text), None), lambda: new_sheet(css_text))
+
+
+def sheet_text(css_text, fix=None, fix_key=None):
+    """ The serialized sheet for css_text after fix(sheet).
+
+    fix_key must identify what fix does, the result is cached by it
+    and the css text.
+
+    """
+    def make():
+        if fix is None:
+            return shared_sheet(css_text).cssText
+        sheet = new_sheet(css_text)
+        fix(sheet)
+        return sheet.cssText
+    return cached((css_key(css_text), ('text', fix_key)), make)
+
 class Parser(ParserBase):
     """ Parse an external CSS file. """
 
@@ -108,8 +238,7 @@ class Parser(ParserBase):
                 return
 
         self.attribs.mediatype = 'text/css'
-        self.lowercase_selectors(self.sheet)
-        self.make_links_absolute()
+        CSSRewriter(selector_fixes=[lowercase_selector], url_fix=self.abs_url).apply(self.sheet)
 
 
     def parse_string(self, s):
@@ -118,11 +247,8 @@ class Parser(ParserBase):
         if self.sheet is not None:
             return
 
-        parser = cssutils.CSSParser()
-        self.sheet = parser.parseString(s)
-
+        self.sheet = new_sheet(s)
         self.attribs.mediatype = 'text/css'
-        self.lowercase_selectors(self.sheet)
 
 
     @staticmethod
@@ -137,18 +263,15 @@ class Parser(ParserBase):
     @staticmethod
     def lowercase_selectors(sheet):
         """ make element names in selectors lowercase to match xhtml tags """
-        for rule in sheet:
-            if rule.type == rule.STYLE_RULE:
-                for sel in rule.selectorList:
-                    sel.selectorText = RE_ELEMENT.sub(
-                        lambda m: m.group(1).lower() if m.group(1) else m.group(0),
-                        sel.selectorText)
+        CSSRewriter(selector_fixes=[lowercase_selector]).apply(sheet)
+
+    def abs_url(self, url):
+        """ url made absolute """
+        return urllib.parse.urljoin(self.attribs.url, url)
 
     def make_links_absolute(self):
         """ make links absolute """
-        def abs_url(url):
-            return urllib.parse.urljoin(self.attribs.url, url)
-        cssutils.replaceUrls(self.sheet, abs_url)
+        cssutils.replaceUrls(self.sheet, self.abs_url)
 
 
     def rewrite_links(self, f):
@@ -164,12 +287,7 @@ class Parser(ParserBase):
 
     def strip_images(self):
         """ remove all rules with url() in them """
-        to_delete = []
-        for rule in self.sheet:
-            if rule.type == rule.STYLE_RULE and rule.cssText and 'url(' in rule.cssText:
-                to_delete.append(rule)
-        for rule in to_delete:
-            self.sheet.deleteRule(rule)
+        CSSRewriter(style_fixes=[drop_images]).apply(self.sheet)
 
 
     def get_aux_urls(self):
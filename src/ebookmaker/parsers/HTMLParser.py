@@ -12,15 +12,22 @@ Distributable under the GNU General Public License Version 3 or newer.
 
 """
 import copy
+import json
+import logging
 import re
 import unicodedata
+from xml.sax.saxutils import quoteattr
 
 from six.moves import urllib
 
+import bs4
+import html5lib
 import lxml.html
 from lxml import etree
 
 from bs4 import BeautifulSoup, Comment, NavigableString, Tag
+from bs4.builder import HTMLTreeBuilder, LXMLTreeBuilderForXML
+from bs4.dammit import EncodingDetector
 from bs4.formatter import EntitySubstitution, HTMLFormatter
 
 
@@ -29,11 +36,12 @@ from libgutenberg.Logger import critical, info, debug, warning, error
 from libgutenberg.MediaTypes import mediatypes as mt
 
 from ebookmaker import parsers
+from ebookmaker.DiskCache import DiskCache, make_key, capture_log, replay_log
 from ebookmaker.CommonCode import (csv_escape, EbookAltText, EbookmakerBadFileException,
                                    filesdir, Options, pgnum_from_url)
 from ebookmaker.utils import add_class, add_style, css_len, replace_elements, xpath
 from . import HTMLParserBase
-from .boilerplate import mark_soup
+from .boilerplate import mark_soup, mark_tree, TreeMarkingError
 
 options = Options()
 
@@ -184,11 +192,130 @@ XMLOPENCOMMENT = re.compile(r'<!--(.*?)')
 CSSCOMMENT = re.compile(r'/\*(.*?)\*/', re.S)
 JSCOMMENT = re.compile(r'//(.*?)')
 
+STYLE_COMMENT_FIXES = [
+    # ancient browsers didn't understand stylesheets, so xml comments were used to hide the
+    # style text. Our CSS parser is too modern to remember this, it seems.
+    # So we needed to un-comment the style text
+    (XMLCOMMENT, r'\1'),
+    (XMLOPENCOMMENT, r''),
+    # pg producers did crazy things in css comments, such as inserting CDATA sections
+    (CSSCOMMENT, ''),
+    # a lot of them thought it was a good idea to put javascript comments in style blocks
+    (JSCOMMENT, ''),
+]
+
 def nfc(_str):
     return unicodedata.normalize('NFC', EntitySubstitution.substitute_xml(_str))
 
 nfc_formatter = HTMLFormatter(entity_substitution=nfc)
 
+# What BeautifulSoup does to a document, for parsing without it.
+# test_tree_parse compares the result with the soup on the sample books.
+# The lxml builder feeds the parser in chunks of this size.
+SOUP_CHUNK_SIZE = LXMLTreeBuilderForXML.CHUNK_SIZE
+# Strings of these ascii spaces only are collapsed, except in these tags.
+SOUP_SPACES = ' \n\t\x0c\r'
+SOUP_PRESERVE_WHITESPACE = HTMLTreeBuilder.DEFAULT_PRESERVE_WHITESPACE_TAGS
+# Attributes holding lists of classes etc. are re-joined with single spaces.
+SOUP_LIST_ATTRIBUTES = HTMLTreeBuilder.DEFAULT_CDATA_LIST_ATTRIBUTES
+RE_SOUP_LIST = re.compile(r'\S+')
+# The text of these tags is not escaped or normalized.
+SOUP_CDATA_TAGS = nfc_formatter.cdata_containing_tags
+# lxml takes no attribute names with prefixes but without namespaces,
+# so xml:lang is xml\u00b7lang until the tree gets its namespaces.
+SOUP_PREFIX_MARK = '\u00b7'
+
+# Strings the XML parser would not take back, or take back changed.
+RE_XML_UNSAFE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\u2028\ud800-\udfff\ufffe\uffff]')
+RE_XML_NEWLINE = re.compile(r'\r\n?')
+RE_CDATA_UNSAFE = re.compile(r'[<&]|]]>')
+RE_ATTR_SPACE = re.compile(r'[\t\n\r]')
+RE_XML_SPECIAL = re.compile(r'([&<>])')
+
+
+def nfc_text(text):
+    """ Normalize text like nfc_formatter, which normalizes between the escaped &, < and >. """
+    if text.isascii() or unicodedata.is_normalized('NFC', text):
+        return text
+    return ''.join(unicodedata.normalize('NFC', piece) for piece in RE_XML_SPECIAL.split(text))
+
+
+def soup_name(name):
+    """ The attribute name as the soup has it. """
+    return name.replace(SOUP_PREFIX_MARK, ':')
+
+
+def soup_attribute(tag, name, value):
+    """ The value of an attribute after a trip through the soup and the XML parser. """
+    if name in SOUP_LIST_ATTRIBUTES['*'] or name in SOUP_LIST_ATTRIBUTES.get(tag, ()):
+        value = ' '.join(RE_SOUP_LIST.findall(value))
+    return RE_ATTR_SPACE.sub(' ', RE_XML_NEWLINE.sub('\n', nfc_text(value)))
+
+
+def soup_strings(html):
+    """ Collapse whitespace-only strings in the html tree like the soup does.
+
+    Return False if the tree has something the soup and the XML parser
+    would change in other ways: prefixed names, characters not allowed
+    in XML, script text that is no XML text ...
+
+    """
+
+    preserve = 0
+    prefixes = {'xml'} | {name[6:] for name in map(soup_name, html.attrib)
+                          if name.startswith('xmlns:')}
+
+    def fixed_string(text):
+        if RE_XML_UNSAFE.search(text):
+            return None
+        if not preserve and not text.strip(SOUP_SPACES):
+            return '\n' if '\n' in text else ' '
+        return RE_XML_NEWLINE.sub('\n', text) if '\r' in text else text
+
+    for event, elem in etree.iterwalk(html, events=('start', 'end', 'comment', 'pi')):
+        if event == 'start':
+            if not parsers.RE_XML_NAME.match(elem.tag):
+                return False
+            if elem.tag in SOUP_PRESERVE_WHITESPACE:
+                preserve += 1
+            for name, value in elem.attrib.items():
+                name = soup_name(name)
+                prefix, dummy_sep, local = name.rpartition(':')
+                if not parsers.RE_XML_NAME.match(local) or RE_XML_UNSAFE.search(value):
+                    return False
+                if name == 'xmlns' or prefix == 'xmlns':
+                    if elem is not html:
+                        return False
+                elif prefix and prefix not in prefixes:
+                    return False
+            if elem.text:
+                if elem.tag == 'script' and RE_CDATA_UNSAFE.search(elem.text):
+                    return False
+                text = fixed_string(elem.text)
+                if text is None:
+                    return False
+                elem.text = text
+            continue
+
+        if event == 'end':
+            if elem.tag in SOUP_PRESERVE_WHITESPACE:
+                preserve -= 1
+            if elem is html:
+                break
+        elif event == 'comment':
+            text = fixed_string(elem.text or '')
+            if text is None:
+                return False
+            elem.text = text
+        else:
+            return False
+        if elem.tail:
+            tail = fixed_string(elem.tail)
+            if tail is None:
+                return False
+            elem.tail = tail
+    return True
+
 class Parser(HTMLParserBase):
     """ Parse a HTML Text
     and convert it to xhtml suitable for ePub packaging.
@@ -736,7 +863,26 @@ class Parser(HTMLParserBase):
         if self.xhtml is not None:
             return
 
+        if not getattr(options, 'parse_cache', None):
+            self._pre_parse()
+            return
+
+        cache = DiskCache(options.parse_cache, 'html')
+        key = self._parse_cache_key()
+        if self._load_parsed(cache.get(key)):
+            debug("Got %s from parse cache", self.attribs.url)
+            return
+        with capture_log() as log:
+            self._pre_parse()
+        if self.xhtml is not None:
+            cache.put(key, self._dump_parsed(log))
+
+
+    def _pre_parse(self):
+        """ Parse the source into self.xhtml. """
+
         debug("HTMLParser.pre_parse() ...")
+        xhtml = None
         if b'xmlns=' in self.bytes_content() or b'-//W3C//DTD X' in self.bytes_content():
             if b'http://www.w3.org/2000/svg' in self.bytes_content():
                 info('using an HTML5 parser because of svg xml')
@@ -746,10 +892,32 @@ class Parser(HTMLParserBase):
                 info('using an XML parser')
                 bs_parser = 'lxml'
                 extra_params = {'exclude_encodings':["us-ascii"]}
+                xhtml = self._parse_tree()
         else:
             info('using an HTML5 parser')
             bs_parser = 'html5lib'
             extra_params = {}
+
+        if xhtml is None:
+            html = self._parse_soup(bs_parser, extra_params)
+            if not html:
+                return
+            xhtml = self.__parse(html)     # let exception bubble up
+        self.xhtml = xhtml
+
+        self._fix_anchors() # needs relative paths
+
+        self.xhtml.make_links_absolute(base_url=self.attribs.url)
+
+        self._to_xhtml11()
+        self._make_coverpage_link()
+
+        debug("Done parsing %s", self.attribs.url)
+
+
+    def _parse_soup(self, bs_parser, extra_params):
+        """ Parse with BeautifulSoup, fix the soup and return it as xhtml string. """
+
         try:
             soup = BeautifulSoup(self.bytes_content(), bs_parser, **extra_params)
         except:
@@ -765,22 +933,9 @@ class Parser(HTMLParserBase):
 
         soup.html['xmlns'] = NS.xhtml
 
-        # ancient browsers didn't understand stylesheets, so xml comments were used to hide the
-        # style text. Our CSS parser is too modern to remember this, it seems.
-        # So we needed to un-comment the style text
-        for commented_style in soup.find_all('style', string=XMLCOMMENT):
-            commented_style.string = XMLCOMMENT.sub(r'\1', str(commented_style.string))
-
-        for commented_style in soup.find_all('style', string=XMLOPENCOMMENT):
-            commented_style.string = XMLOPENCOMMENT.sub(r'', str(commented_style.string))
-
-        # pg producers did crazy things in css comments, such as inserting CDATA sections
-        for commented_style in soup.find_all('style', string=CSSCOMMENT):
-            commented_style.string = CSSCOMMENT.sub('', str(commented_style.string))
-
-        # a lot of them thought it was a good idea to put javascript comments in style blocks
-        for commented_style in soup.find_all('style', string=JSCOMMENT):
-            commented_style.string = JSCOMMENT.sub('', str(commented_style.string))
+        for comment, replacement in STYLE_COMMENT_FIXES:
+            for commented_style in soup.find_all('style', string=comment):
+                commented_style.string = comment.sub(replacement, str(commented_style.string))
 
         """ same as setting enclose-text option on tidy;
         ' enclose any text it finds in the body element within a <P> element.
@@ -815,22 +970,227 @@ class Parser(HTMLParserBase):
         html = soup.decode(formatter=nfc_formatter)
         if not html:
             critical('no content in %s', self.attribs.url)
-            return
+            return None
 
         if '\r' in html or '\u2028' in html:
             html = '\n'.join(html.splitlines())
         self.unicode_buffer = html
+        return html
 
-        self.xhtml = self.__parse(html)     # let exception bubble up
 
-        self._fix_anchors() # needs relative paths
+    def _parse_tree(self):
+        """ Parse straight into the xhtml tree, without the soup.
 
-        self.xhtml.make_links_absolute(base_url=self.attribs.url)
+        Does what _parse_soup and __parse do, on the lxml tree, with
+        the same result. Returns None if the document has something the
+        soup would treat differently, then _parse_soup must do it.
 
-        self._to_xhtml11()
-        self._make_coverpage_link()
+        """
 
-        debug("Done parsing %s", self.attribs.url)
+        html = self._parse_html_tree()
+        if html is None or html.tag != 'html' or not soup_strings(html):
+            return None
+        body = next(html.iter('body'), None)
+        if body is None or (not body.text and len(body) == 0):
+            return None
+
+        for comment, replacement in STYLE_COMMENT_FIXES:
+            for commented_style in html.iter('style'):
+                if len(commented_style) == 0 and commented_style.text and \
+                        comment.search(commented_style.text):
+                    commented_style.text = comment.sub(replacement, commented_style.text)
+        for style in html.iter('style'):
+            if style.text and RE_CDATA_UNSAFE.search(style.text):
+                return None
+
+        # same as the enclose-text option of tidy, see _parse_soup
+        added_classes = set()
+        def wrapper():
+            added_classes.add(BODY_WRAPPER_CLASS)
+            return body.makeelement('div', {'class': BODY_WRAPPER_CLASS})
+
+        if body.text and body.text.strip(' \n\r\t'):
+            new_div = wrapper()
+            new_div.text, body.text = body.text, None
+            body.insert(0, new_div)
+        for elem in list(body):
+            if isinstance(elem.tag, str) and elem.tag not in ALLOWED_IN_BODY:
+                new_div = wrapper()
+                new_div.tail, elem.tail = elem.tail, None
+                elem.addprevious(new_div)
+                new_div.append(elem)
+                elem = new_div
+            if elem.tail and elem.tail.strip(' \n\r\t'):
+                new_div = wrapper()
+                new_div.text, elem.tail = elem.tail, None
+                elem.addnext(new_div)
+
+        # workaround to let lxml iterlinks for math@altimg attribute links
+        for elem in html.iter('math'):
+            if elem.get('altimg') is not None:
+                elem.set('src', elem.get('altimg'))
+
+        try:
+            marked = mark_tree(html)
+        except TreeMarkingError as what:
+            debug('Cannot mark boilerplate in the tree: %s', what)
+            return None
+        if not marked:
+            if options.production and self.attribs.id == 'start':
+                critical('Boilerplate markers are missing in %s', self.attribs.url)
+
+        xhtml = self._xhtml_from_tree(html)
+        if xhtml is not None:
+            self.added_classes.update(added_classes)
+            self.unicode_buffer = etree.tostring(xhtml, encoding='unicode')
+        return xhtml
+
+
+    def _parse_html_tree(self):
+        """ Parse the source with lxml like the lxml builder of BeautifulSoup does. """
+
+        # The soup gets the parser events, not the tree libxml2 would
+        # build, eg. valueless attributes are empty, not repeat their name.
+        element_parser = lxml.html.HTMLParser()
+        roots = []
+        def make_element(tag, attrib):
+            if any(':' in name or SOUP_PREFIX_MARK in name for name in attrib):
+                if any(SOUP_PREFIX_MARK in name for name in attrib):
+                    raise ValueError('%s in attribute name' % SOUP_PREFIX_MARK)
+                attrib = {name.replace(':', SOUP_PREFIX_MARK): value
+                          for name, value in attrib.items()}
+            elem = element_parser.makeelement(tag, attrib)
+            if not roots:
+                roots.append(elem)
+            return elem
+
+        detector = EncodingDetector(self.bytes_content(), is_html=True,
+                                    exclude_encodings=['us-ascii'])
+        markup = detector.markup
+        for encoding in detector.encodings:
+            roots.clear()
+            parser = etree.HTMLParser(
+                target=etree.TreeBuilder(element_factory=make_element),
+                recover=True, encoding=encoding)
+            try:
+                parser.feed(markup[:SOUP_CHUNK_SIZE])
+                for i in range(SOUP_CHUNK_SIZE, len(markup), SOUP_CHUNK_SIZE):
+                    parser.feed(markup[i:i + SOUP_CHUNK_SIZE])
+                parser.close()
+                return roots[0] if roots else None
+            except (UnicodeDecodeError, LookupError, etree.ParserError):
+                continue
+            except (etree.LxmlError, ValueError):
+                # also comments XML does not allow
+                return None
+        return None
+
+
+    def _xhtml_from_tree(self, html):
+        """ Move the html tree into the xhtml namespace.
+
+        The result is the same as the XHTML parser makes of the soup.
+
+        """
+
+        attribs = {soup_name(name): value for name, value in html.attrib.items()}
+        attribs['xmlns'] = str(NS.xhtml)
+        start_tag = ' '.join('%s=%s' % (name, quoteattr(soup_attribute('html', name, value)))
+                             for name, value in sorted(attribs.items()))
+        try:
+            xhtml = etree.fromstring(
+                '<!DOCTYPE html >\n<html %s/>' % start_tag,
+                lxml.html.XHTMLParser(huge_tree=True),
+                base_url=self.attribs.url)
+        except etree.ParseError as what:
+            debug('Cannot use the tree: %s', what)
+            return None
+
+        xhtml.text = nfc_text(html.text) if html.text else None
+        xhtml.extend(list(html))
+
+        ns = '{%s}' % NS.xhtml
+        prefixes = {prefix: '{%s}' % uri for prefix, uri in xhtml.nsmap.items() if prefix}
+        prefixes['xml'] = '{%s}' % NS.xml
+        for elem in xhtml.iterdescendants():
+            tag = elem.tag
+            if isinstance(tag, str):
+                elem.tag = ns + tag
+                if elem.attrib:
+                    attribs = elem.attrib.items()
+                    fixed_attribs = []
+                    for name, value in sorted((soup_name(name), value)
+                                              for name, value in attribs):
+                        prefix, sep, local = name.partition(':')
+                        fixed_attribs.append((prefixes[prefix] + local if sep else name,
+                                              soup_attribute(tag, name, value)))
+                    if fixed_attribs != attribs:
+                        elem.attrib.clear()
+                        elem.attrib.update(fixed_attribs)
+                text = elem.text
+                if text and tag not in SOUP_CDATA_TAGS:
+                    fixed_text = nfc_text(text)
+                    if fixed_text is not text:
+                        elem.text = fixed_text
+            tail = elem.tail
+            if tail:
+                fixed_tail = nfc_text(tail)
+                if fixed_tail is not tail:
+                    elem.tail = fixed_tail
+        return xhtml
+
+
+    def _parse_cache_key(self):
+        """ Key for the parse cache.
+
+        Everything pre_parse depends on besides the code: the source,
+        its url (links are made absolute) and the alt text overrides.
+        The messages logged while parsing are replayed from the cache,
+        so the key also has what decides them: the log level,
+        production mode, the files dir of the [ALTTEXT] urls and if
+        this is the start document.
+
+        """
+
+        alt_map = self.alter._alt_map
+        return make_key(
+            self.bytes_content(),
+            self.attribs.url,
+            json.dumps(alt_map, sort_keys=True) if alt_map is not None else None,
+            str(bool(getattr(options, 'production', False))),
+            filesdir(),
+            str(self.attribs.id == 'start'),
+            etree.__version__,
+            bs4.__version__,
+            html5lib.__version__,
+            str(logging.getLogger().getEffectiveLevel()),
+        )
+
+
+    def _dump_parsed(self, log):
+        """ The results of pre_parse and what it logged, for the parse cache. """
+
+        return {
+            'xhtml': etree.tostring(self.xhtml.getroottree(), encoding='utf-8'),
+            'unicode_buffer': self.unicode_buffer,
+            'added_classes': self.added_classes,
+            'log': log,
+        }
+
+
+    def _load_parsed(self, parsed):
+        """ Restore the results of pre_parse from the parse cache. """
+
+        if parsed is None or 'log' not in parsed:
+            return False
+        replay_log(parsed['log'])
+        self.xhtml = etree.fromstring(
+            parsed['xhtml'],
+            lxml.html.XHTMLParser(huge_tree=True),
+            base_url=self.attribs.url)
+        self.unicode_buffer = parsed['unicode_buffer']
+        self.added_classes = parsed['added_classes']
+        return True
 
 
     def parse(self):
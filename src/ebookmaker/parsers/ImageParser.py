@@ -13,22 +13,404 @@ Parse an url of type image/*.
 
 """
 
+import atexit
+import concurrent.futures
 import copy
+import functools
 import importlib
 import io
+import math
+import os
+import re
+import shutil
+import struct
+import tempfile
 import six
+from six.moves import urllib
+import PIL
 from PIL import Image, ImageFile
 from lxml import etree
 
 from libgutenberg.Logger import debug, critical, error
 from libgutenberg.MediaTypes import mediatypes as mt
+from ebookmaker import Metrics
+from ebookmaker.CommonCode import Options
+from ebookmaker.DiskCache import DiskCache, make_key
 from ebookmaker.parsers import ParserBase
 
 # works around problems with bad checksums in a small number of png files
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+options = Options()
+
 mediatypes = (mt.jpeg, mt.png, mt.gif, mt.svg)
 
+JPEG_QUALITIES = (90, 85, 80, 70, 60, 50, 40, 30, 20, 10)
+BIG_PNG_PIXELS = 1000000
+PNG_OPTIMIZE_GAIN = 1.25  # optimized pngs are mostly less than 20% smaller
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+RE_SVG_LENGTH = re.compile(r'^\s*(\d+(?:\.\d*)?)\s*(px)?\s*$')
+
+
+def scale_image(image, scale, full_size=None):
+    """ Scale image down by scale.
+
+    full_size is the size of the image before it was decoded at a
+    reduced size, the scale is relative to it.
+
+    """
+    full_size = full_size or image.size
+    was = ''
+    if scale < 1.0:
+        dimen = (int(full_size[0] * scale), int(full_size[1] * scale))
+        was = "(was %d x %d scale=%.2f) " % (full_size[0], full_size[1], scale)
+        image = image.resize(dimen, Image.LANCZOS)
+    return was, image
+
+
+def get_image_data(image, format_, quality='keep', optimize=True):
+    """ Format is the output format, not necessarily the input format """
+    buf = six.BytesIO()
+    if image.format != 'JPEG' and quality == 'keep':
+        quality = 90
+    if format_ == 'png':
+        image.save(buf, 'png', optimize=optimize)
+    else:
+        try:
+            image.save(buf, 'jpeg', quality=quality)
+        except ValueError as e:
+            if quality == 'keep' and 'quantization' in str(e):
+                image.save(buf, 'jpeg', quality=90)
+            else:
+                raise e
+    return buf.getvalue()
+
+
+def fit_png(unsized_image, full_size, scale, size, max_size, optimized=None):
+    """ Find the largest scale in steps of 0.8 that makes a png fit into max_size.
+
+    size is the size of the png at scale, optimized the optimized png
+    at scale if the caller made it. Fast, not optimized encodings
+    find a first guess, the optimized pngs decide: if smaller scales
+    make smaller pngs, this is the scale the old loop over all steps
+    found. Returns (was, image, data) for the optimized png.
+
+    """
+
+    scales = [scale]
+    while scales[-1] > 0.01:
+        scales.append(scales[-1] * 0.8)
+    last = len(scales) - 1
+
+    images = {}
+    def scaled(step):
+        """ (was, image) at scales[step]. """
+        if step not in images:
+            images[step] = scale_image(unsized_image, scales[step], full_size)
+        return images[step]
+
+    trials = {}
+    def trial(step):
+        """ Size of the not optimized png at scales[step]. """
+        if step not in trials:
+            trials[step] = len(get_image_data(scaled(step)[1], 'png', optimize=False))
+        return trials[step]
+
+    pngs = {} if optimized is None else {0: optimized}
+    def fits(step):
+        """ Does the optimized png at scales[step] fit? """
+        if step not in pngs:
+            pngs[step] = get_image_data(scaled(step)[1], 'png')
+        return len(pngs[step]) <= max_size
+
+    # the size of a png goes about with the number of pixels
+    step = math.ceil(math.log(max_size / size) / math.log(0.64))
+    step = min(max(step, 1), last)
+    if trial(step) <= max_size:
+        while step > 1 and trial(step - 1) <= max_size:
+            step -= 1
+    else:
+        while step < last and trial(step) > max_size:
+            step += 1
+
+    if fits(step):
+        # optimizing may make larger scales fit too
+        while step > 0 and fits(step - 1):
+            step -= 1
+    else:
+        while step < last:
+            step += 1
+            if fits(step):
+                break
+
+    was, image = scaled(step)
+    return was, image, pngs[step]
+
+
+def fit_jpeg(image, max_size):
+    """ Find the best quality that makes a jpeg fit into max_size.
+
+    Binary search, a lower quality never makes a larger file. Returns
+    (quality, data).
+
+    """
+
+    encoded = {}
+    def fits(index):
+        """ Does the jpeg at JPEG_QUALITIES[index] fit? """
+        if index not in encoded:
+            encoded[index] = get_image_data(image, 'jpeg', quality=JPEG_QUALITIES[index])
+        return len(encoded[index]) <= max_size
+
+    low, high = 0, len(JPEG_QUALITIES) - 1
+    while low < high:
+        middle = (low + high) // 2
+        if fits(middle):
+            high = middle
+        else:
+            low = middle + 1
+    fits(low)
+    return JPEG_QUALITIES[low], encoded[low]
+
+
+def resize_image_data(image_data, max_size, max_dimen, output_format=None):
+    """ Scale and encode an image to fit max_dimen and max_size.
+
+    Returns (to_png, data, dimen, comment), to_png is set if a gif was
+    converted to png. Raises IOError if the image cannot be read.
+
+    """
+
+    unsized_image = Image.open(six.BytesIO(image_data))
+    full_size = unsized_image.size
+
+    # maybe resize image
+
+    # find scaling factor
+    scale = 1.0
+    scale = min(scale, max_dimen[0] / float(full_size[0]))
+    scale = min(scale, max_dimen[1] / float(full_size[1]))
+
+    if unsized_image.format == 'JPEG' and scale <= 0.5:
+        # let the decoder scale by 1/2, 1/4 or 1/8 to at least the final size
+        unsized_image.draft(unsized_image.mode,
+                            (int(full_size[0] * scale), int(full_size[1] * scale)))
+
+    format_ = unsized_image.format.lower()
+    if output_format:
+        format_ = output_format
+    to_png = format_ == 'gif'
+    if to_png:
+        format_ = 'png'
+    if format_ == 'jpeg' and unsized_image.mode.lower() not in ('rgb', 'l'):
+        unsized_image = unsized_image.convert('RGB')
+
+    if 'dpi' in unsized_image.info:
+        del unsized_image.info['dpi']
+
+    was, image = scale_image(unsized_image, scale, full_size)
+    data = None
+    if format_ == 'png' and image.size[0] * image.size[1] > BIG_PNG_PIXELS:
+        # optimizing a big png is slow, a quick encoding tells if it
+        # has to be scaled down anyway
+        size = len(get_image_data(image, format_, optimize=False))
+        if size > max_size * PNG_OPTIMIZE_GAIN:
+            was, image, data = fit_png(unsized_image, full_size, scale, size, max_size)
+
+    if data is None:
+        data = get_image_data(image, format_)
+        if len(data) > max_size:
+            if format_ == 'png':
+                was, image, data = fit_png(unsized_image, full_size, scale, len(data), max_size,
+                                           data)
+            else:
+                quality, data = fit_jpeg(image, max_size)
+                was += 'q=%d' % quality
+    comment = "Image: %d x %d size=%d %s" % (
+        image.size[0], image.size[1], len(data), was
+    )
+    #debug(comment)
+
+    return to_png, data, tuple(image.size), comment
+
+
+spill_dir = None
+spill_pid = None
+
+
+def spill(data):
+    """ Write data into a new file in a temporary directory, return its path.
+
+    Every process gets its own directory, it is removed at exit or by
+    remove_spilled.
+
+    """
+
+    global spill_dir, spill_pid
+    if spill_dir is None or spill_pid != os.getpid():
+        spill_dir = tempfile.mkdtemp(prefix='ebookmaker-images-')
+        spill_pid = os.getpid()
+        atexit.register(shutil.rmtree, spill_dir, ignore_errors=True)
+    fd, path = tempfile.mkstemp(dir=spill_dir)
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(data)
+    return path
+
+
+def remove_spilled():
+    """ Remove the files written by spill in this process. """
+
+    global spill_dir
+    if spill_dir is not None and spill_pid == os.getpid():
+        shutil.rmtree(spill_dir, ignore_errors=True)
+        spill_dir = None
+
+
+def file_path(url):
+    """ The local path of a file: url, or None. """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme == 'file' and not parts.netloc:
+        path = urllib.request.url2pathname(parts.path)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def probe_jpeg(fp):
+    """ Find the size in the SOF segment of a jpeg. """
+    while True:
+        byte = fp.read(1)
+        while byte and byte != b'\xff':
+            byte = fp.read(1)
+        while byte == b'\xff':
+            byte = fp.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            continue  # no segment
+        if marker == 0xD9 or marker == 0xDA:
+            return None  # end of image or start of scan
+        header = fp.read(2)
+        if len(header) < 2:
+            return None
+        length = struct.unpack('>H', header)[0]
+        if marker in JPEG_SOF_MARKERS:
+            sof = fp.read(5)
+            if len(sof) < 5:
+                return None
+            height, width = struct.unpack('>xHH', sof)
+            return width, height
+        fp.seek(length - 2, os.SEEK_CUR)
+
+
+def probe_svg(fp):
+    """ Get the size from the width and height of the svg root element. """
+    try:
+        for dummy_event, elem in etree.iterparse(fp, events=('start',),
+                                                 resolve_entities=False, no_network=True):
+            width = RE_SVG_LENGTH.match(elem.get('width', ''))
+            height = RE_SVG_LENGTH.match(elem.get('height', ''))
+            if width and height:
+                return int(float(width.group(1))), int(float(height.group(1)))
+            return None
+    except etree.XMLSyntaxError:
+        pass
+    return None
+
+
+def probe_image_dimen(fp):
+    """ Get the size of a png, jpeg, gif or svg image from its header.
+
+    Reads only the first few bytes (or the segment headers of a jpeg).
+    Returns None if the size is not found there.
+
+    """
+    head = fp.read(26)
+    if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+        return struct.unpack('>II', head[16:24])
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return struct.unpack('<HH', head[6:10])
+    if head.startswith(b'\xff\xd8'):
+        fp.seek(2)
+        return probe_jpeg(fp)
+    if b'<' in head:
+        fp.seek(0)
+        return probe_svg(fp)
+    return None
+
+
+@functools.lru_cache(maxsize=4096)
+def probe_file_dimen(path, mtime_ns, size):
+    """ probe_image_dimen for a file; path, mtime_ns and size are the memo key. """
+    try:
+        with open(path, 'rb') as fp:
+            return probe_image_dimen(fp)
+    except (IOError, struct.error):
+        return None
+
+
+def get_file_dimen(path):
+    """ Get the size of an image file from its header, or None. """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return probe_file_dimen(path, stat.st_mtime_ns, stat.st_size)
+
+
+def resize_image_file(args):
+    """ resize_image_data for a process pool.
+
+    The image is read from the file if a path is given. Returns None
+    if the image is broken.
+
+    """
+    source, max_size, max_dimen = args
+    try:
+        if isinstance(source, str):
+            with open(source, 'rb') as fp:
+                source = fp.read()
+        return resize_image_data(source, max_size, max_dimen)
+    except IOError:
+        return None
+
+
+def resize_images(requests):
+    """ Resize images, in a pool of processes if options.image_processes > 1.
+
+    requests is a list of (parser, max_size, max_dimen). Returns the
+    new parsers in the same order, just like calling resize_image on
+    each parser would. The pool only fills the parsers' caches, the
+    resized parsers are still made here one after another.
+
+    """
+
+    processes = getattr(options, 'image_processes', 0) or 0
+    todo = {}
+    if processes > 1:
+        for parser, max_size, max_dimen in requests:
+            if parser.attribs.mediatype != mt.svg:
+                key = parser.resize_key(max_size, max_dimen)
+                if key not in todo and parser.get_resized(key) is None:
+                    todo[key] = (parser, max_size, max_dimen)
+
+    if len(todo) > 1:
+        with Metrics.stage('resize_images'):
+            debug('Resizing %d images in %d processes', len(todo), processes)
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=min(processes, len(todo))) as pool:
+                results = pool.map(
+                    resize_image_file,
+                    [(parser.image_path or parser.image_data, max_size, max_dimen)
+                     for parser, max_size, max_dimen in todo.values()])
+                for (key, (parser, dummy_size, dummy_dimen)), resized in zip(
+                        todo.items(), results):
+                    if resized is not None:
+                        parser.put_resized(key, resized)
+                        parser.keep_resized(key, resized)
+
+    return [parser.resize_image(max_size, max_dimen) for parser, max_size, max_dimen in requests]
 
 
 class Parser(ParserBase):
@@ -36,42 +418,78 @@ class Parser(ParserBase):
 
     And maybe resize it for ePub packaging.
 
+    Images from local files and resized images are not kept in memory:
+    image_data reads them from image_path when needed, so each use
+    reads it once into a local variable.
+
     """
 
     def __init__(self, attribs=None):
         ParserBase.__init__(self, attribs)
-        self.image_data = None
+        self._image_data = None
+        self._digest = None
+        self.image_path = None
         self.dimen = None
+        self.resized = {}  # (to_png, path, dimen, comment) by cache key
+
+
+    @property
+    def image_data(self):
+        """ The bytes of the image. """
+        if self._image_data is None and self.image_path is not None:
+            with open(self.image_path, 'rb') as fp:
+                return fp.read()
+        return self._image_data
+
+
+    @image_data.setter
+    def image_data(self, data):
+        self._image_data = data
+        self._digest = None
+
 
+    def digest(self, data=None):
+        """ Hash of the image bytes, data if the caller has read them. """
+        if self._digest is None:
+            self._digest = make_key(self.image_data if data is None else data)
+        return self._digest
 
+
+    def resize_key(self, max_size, max_dimen, output_format=None, data=None):
+        """ Key for the result of resizing this image. """
+        return make_key(self.digest(data), repr((max_size, tuple(max_dimen), output_format)),
+                        PIL.__version__)
+
+
+    def get_resized(self, key):
+        """ Get a resized image from memory or the image cache, or None. """
+        resized = self.resized.get(key)
+        if resized is None and getattr(options, 'image_cache', None):
+            cached = DiskCache(options.image_cache, 'images').get(key)
+            if cached is not None:
+                debug("Got %s from image cache", self.attribs.url)
+                resized = self.keep_resized(key, cached)
+        return resized
+
+
+    def keep_resized(self, key, resized):
+        """ Keep a resize_image_data result, with the data in a temporary file. """
+        to_png, data, dimen, comment = resized
+        self.resized[key] = (to_png, spill(data), dimen, comment)
+        return self.resized[key]
+
+
+    @staticmethod
+    def put_resized(key, resized):
+        """ Put a resize_image_data result into the image cache. """
+        if getattr(options, 'image_cache', None):
+            DiskCache(options.image_cache, 'images').put(key, resized)
+
+
+    @Metrics.timed('resize_images')
     def resize_image(self, max_size, max_dimen, output_format=None):
         """ Create a new parser with a resized image. """
 
-        def scale_image(image, scale):
-            was = ''
-            if scale < 1.0:
-                dimen = (int(image.size[0] * scale), int(image.size[1] * scale))
-                was = "(was %d x %d scale=%.2f) " % (image.size[0], image.size[1], scale)
-                image = image.resize(dimen, Image.LANCZOS)
-            return was, image
-
-        def get_image_data(image, format_, quality='keep'):
-            """ Format is the output format, not necessarily the input format """
-            buf = six.BytesIO()
-            if image.format != 'JPEG' and quality == 'keep':
-                quality = 90
-            if format_ == 'png':
-                image.save(buf, 'png', optimize=True)
-            else:
-                try:
-                    image.save(buf, 'jpeg', quality=quality)
-                except ValueError as e:
-                    if quality == 'keep' and 'quantization' in str(e):
-                        image.save(buf, 'jpeg', quality=90)
-                    else:
-                        raise e
-            return buf.getvalue()
-
         # can't do anything with SVG files
         if self.attribs.mediatype == mt.svg:
             #it's xml!
@@ -80,54 +498,29 @@ class Parser(ParserBase):
         new_parser = Parser()
 
         try:
-            unsized_image = Image.open(six.BytesIO(self.image_data))
-
-            format_ = unsized_image.format.lower()
-            if output_format:
-                format_ = output_format
-            if format_ == 'gif':
-                format_ = 'png'
+            # read the image once for the key and the resize
+            data = self.image_data if self._digest is None else None
+            key = self.resize_key(max_size, max_dimen, output_format, data)
+            if key in self.resized:
+                Metrics.count('resize_images', reused=1)
+            resized = self.get_resized(key)
+            if resized is None:
+                if data is None:
+                    data = self.image_data
+                resized = resize_image_data(data, max_size, max_dimen, output_format)
+                self.put_resized(key, resized)
+                resized = self.keep_resized(key, resized)
+
+            to_png, path, dimen, comment = resized
+            if to_png:
                 self.attribs.url +=  '.png'
                 self.attribs.orig_mediatype = self.attribs.mediatype
                 self.attribs.mediatype = mt.png
-            if format_ == 'jpeg' and unsized_image.mode.lower() not in ('rgb', 'l'):
-                unsized_image = unsized_image.convert('RGB')
-
-            if 'dpi' in unsized_image.info:
-                del unsized_image.info['dpi']
-
-            # maybe resize image
-
-            # find scaling factor
-            scale = 1.0
-            scale = min(scale, max_dimen[0] / float(unsized_image.size[0]))
-            scale = min(scale, max_dimen[1] / float(unsized_image.size[1]))
 
-            was, image = scale_image(unsized_image, scale)
-            data = get_image_data(image, format_)
-
-            if format_ == 'png':
-                # scale it till it fits into max_size
-                while len(data) > max_size and scale > 0.01:
-                    scale = scale * 0.8
-                    was, image = scale_image(unsized_image, scale)
-                    data = get_image_data(image, format_)
-            else:
-                # find best quality that fits into max_size
-                if len(data) > max_size:
-                    for quality in (90, 85, 80, 70, 60, 50, 40, 30, 20, 10):
-                        data = get_image_data(image, format_, quality=quality)
-                        if len(data) <= max_size:
-                            break
-
-                    was += 'q=%d' % quality
-            comment = "Image: %d x %d size=%d %s" % (
-                image.size[0], image.size[1], len(data), was
-            )
-            #debug(comment)
-
-            new_parser.image_data = data
-            new_parser.dimen = tuple(image.size)
+            new_parser.image_path = path
+            new_parser.dimen = dimen
+            Metrics.count('resize_images', images=1, bytes_in=self.data_size(),
+                          bytes=os.path.getsize(path))
 
             new_parser.attribs = copy.copy(self.attribs)
             new_parser.attribs.comment = comment
@@ -144,11 +537,20 @@ class Parser(ParserBase):
 
 
     def get_image_dimen(self):
-        """ image dimensions """
+        """ image dimensions, from the header if possible """
+        if self.dimen is None:
+            if self._image_data is None and self.image_path is not None:
+                self.dimen = get_file_dimen(self.image_path)
+            elif self._image_data:
+                try:
+                    self.dimen = probe_image_dimen(six.BytesIO(self._image_data))
+                except struct.error:
+                    pass
         if self.dimen is None:
-            if self.image_data:
+            data = self.image_data
+            if data:
                 try:
-                    image = Image.open(six.BytesIO(self.image_data))
+                    image = Image.open(six.BytesIO(data))
                     self.dimen = image.size
                 except IOError as what:
                     error("Could not resize image (probably broken): %s", self.attribs.url)
@@ -158,22 +560,61 @@ class Parser(ParserBase):
         return self.dimen
 
 
+    def data_size(self):
+        """ Size of the image in bytes. """
+        if self._image_data is None and self.image_path is not None:
+            return os.path.getsize(self.image_path)
+        return len(self._image_data or b'')
+
+
     def pre_parse(self):
-        if self.image_data is None:
-            self.image_data = self.bytes_content()
+        if self._image_data is None and self.image_path is None:
+            path = file_path(self.attribs.url)
+            if path is not None:
+                # read it when needed
+                self.image_path = path
+                if self.fp is not None:
+                    self.fp.close()
+            else:
+                self.image_data = ParserBase.bytes_content(self)
+                self.buffer = None
+
+
+    def bytes_content(self):
+        """ Get the image as raw bytes, without keeping them. """
+        self.pre_parse()
+        return self.image_data
+
+
+    def serialized_path(self):
+        """ Path of a file with the serialized image, or None. """
+        if self._image_data is None and self.attribs.mediatype != mt.svg:
+            return self.image_path
+        return None
+
 
     def parse(self):
         pass
 
+    def serialize_to(self, fp):
+        """ Serialize the image to fp, copying image files in blocks. """
+        path = self.serialized_path()
+        if path:
+            with open(path, 'rb') as fp_src:
+                shutil.copyfileobj(fp_src, fp, 1024 * 1024)
+        else:
+            fp.write(self.serialize())
+
     def serialize(self):
         """ Serialize the image. """
         if self.attribs.mediatype == mt.svg:
             atts_to_remove = ['data-variant', 'focusable', 'role']
+            data = self.image_data
             try:
-                tree = etree.parse(io.BytesIO(self.image_data))
+                tree = etree.parse(io.BytesIO(data))
             except etree.XMLSyntaxError as e:
                 critical(f'SVG image {self.attribs.url} was badly formed XML: {e}')
-                return self.image_data
+                return data
             for element in tree.iter():
                 for att in atts_to_remove:
                     if att in element.attrib:
@@ -14,9 +14,12 @@ Distributable under the GNU General Public License Version 3 or newer.
 from __future__ import unicode_literals
 
 
+import copy
 import importlib
+import os
+import pickle
 import re
-from functools import partial
+from functools import lru_cache, partial
 
 from six.moves import urllib
 
@@ -24,6 +27,8 @@ from lxml import etree
 import lxml.html
 
 import docutils.readers.standalone
+import docutils.transforms
+import docutils.utils
 from docutils import nodes, frontend
 import docutils
 
@@ -33,7 +38,6 @@ from libgutenberg.MediaTypes import mediatypes as mt
 from ebookmaker import ParserFactory, parsers
 from ebookmaker.parsers import HTMLParser
 
-from ebookmaker.mydocutils import nodes as mynodes
 from ebookmaker.mydocutils.writers import xhtml1, epub2, xetex
 
 from ebookmaker.mydocutils.gutenberg import parsers as gutenberg_parsers
@@ -42,6 +46,18 @@ mediatypes =(mt.rst, )
 
 REB_EMACS_CHARSET = re.compile(rb'-\*-.*coding:\s*(\S+)',  re.I)
 
+# docutils option parsers and config file settings by component classes
+settings_cache = {}
+
+
+@lru_cache(maxsize=None)
+def read_resource(package, resource):
+    """ Read a resource of an ebookmaker package. """
+    ref = importlib.resources.files('ebookmaker.' + package).joinpath(resource)
+    contents = ref.read_bytes()
+    return contents.decode('utf-8')
+
+
 class Parser(HTMLParser.Parser):
     """ Parse a ReStructured Text
 
@@ -52,6 +68,7 @@ class Parser(HTMLParser.Parser):
     def __init__(self, attribs=None):
         HTMLParser.Parser.__init__(self, attribs)
         self.document1 = None
+        self.doctree = None
 
 
     def preprocess(self, charset):
@@ -150,27 +167,64 @@ class Parser(HTMLParser.Parser):
 
 
     def get_settings(self, components, defaults):
-        """ setting from settings file as cli arguments. """
-        option_parser = frontend.OptionParser(
-            components=components,
-            defaults=defaults,
-            read_config_files=1)
-        return option_parser.get_default_values()
+        """ setting from settings file as cli arguments.
+
+        The option parser and the config files are read once for each
+        set of components, defaults are applied to a copy of their
+        settings.
+
+        """
+        key = (tuple(type(component) for component in components),
+               os.getcwd(), os.environ.get('DOCUTILSCONFIG'))
+        if key not in settings_cache:
+            option_parser = frontend.OptionParser(components=components)
+            try:
+                config_settings = option_parser.get_standard_config_settings()
+            except ValueError as err:
+                option_parser.error(str(err))
+            settings_cache[key] = option_parser, config_settings.__dict__
+        option_parser, config_settings = settings_cache[key]
+
+        # same order as OptionParser: components, defaults, config files.
+        # copied, some defaults are changed while docutils runs (record_dependencies)
+        settings = copy.deepcopy(option_parser.get_default_values())
+        settings.__dict__.update(defaults)
+        if not settings._disable_config:
+            settings.__dict__.update(copy.deepcopy(config_settings))
+        return settings
 
 
     def pre_parse(self):
         """ Parse a RST file as link list. """
 
         debug("RSTParser: Pre-parsing %s" % self.attribs.url)
+        self.read_doctree()
+        debug("RSTParser: Done pre-parsing %s" % self.attribs.url)
+
+
+    def read_doctree(self):
+        """ Parse the RST source once for all output formats.
+
+        The doctree is kept pickled before the transforms run, because
+        the transforms depend on the writer. Each format gets its own
+        copy from the pickle.
+
+        """
+
+        if self.doctree is not None:
+            return
 
         default_style = self.get_resource(
             'mydocutils.parsers', 'default_style.rst')
 
-        source = docutils.io.StringInput(default_style + self.unicode_content())
+        source = docutils.io.StringInput(default_style + self.unicode_content(),
+                                 self.attribs.url, 'unicode')
         reader = docutils.readers.standalone.Reader()
         parser = gutenberg_parsers.Parser()
 
+        # settings the parser uses, the others are for the transforms and writers
         overrides = {
+            'page_numbers': 1,
             'get_resource': self.get_resource,
             'get_image_size': self.get_image_size_from_parser,
             'base_url': self.attribs.url,
@@ -182,86 +236,44 @@ class Parser(HTMLParser.Parser):
 
         self.rewrite_links(partial(urllib.parse.urljoin, self.attribs.url))
 
-        debug("RSTParser: Done pre-parsing %s" % self.attribs.url)
+        # the settings hold functions, they are replaced for each format.
+        # docutils drops the reporter and transformer from a pickled
+        # document, the transforms the parser added go along with it.
+        settings = doc.settings
+        doc.settings = None
+        try:
+            self.doctree = pickle.dumps(
+                (doc, doc.transformer.transforms, doc.transformer.serialno),
+                pickle.HIGHEST_PROTOCOL)
+        finally:
+            doc.settings = settings
 
 
     def _full_parse(self, writer, overrides):
-        """ Full parse from scratch. """
+        """ Full parse: a copy of the doctree, transformed for writer. """
 
         debug("RSTParser: Full-parsing %s" % self.attribs.url)
 
-        default_style = self.get_resource(
-            'mydocutils.parsers', 'default_style.rst')
+        self.read_doctree()
 
-        source = docutils.io.StringInput(default_style + self.unicode_content(),
-                                 self.attribs.url, 'unicode')
+        source = docutils.io.StringInput('', self.attribs.url, 'unicode')
         reader = docutils.readers.standalone.Reader()
         parser = gutenberg_parsers.Parser()
 
-        doc = reader.read(
-            source, parser,
-            self.get_settings((reader, parser, writer), overrides))
+        doc, transforms, serialno = pickle.loads(self.doctree)
+        doc.settings = self.get_settings((reader, parser, writer), overrides)
+        doc.reporter = docutils.utils.new_reporter(self.attribs.url, doc.settings)
+        doc.transformer = docutils.transforms.Transformer(doc)
+        doc.transformer.transforms = transforms
+        doc.transformer.serialno = serialno
         self.document1 = doc
 
-        self.rewrite_links(partial(urllib.parse.urljoin, self.attribs.url))
-
         doc.transformer.populate_from_components((source, reader, parser, writer))
         doc.transformer.apply_transforms()
         debug("RSTParser: Done full-parsing %s" % self.attribs.url)
 
         return doc
 
-
-    def _full_parse_2(self, writer, destination, overrides):
-        """ Full parser from pickled doctree.
-
-        Doesn't work yet. It turned out pickling a doctree is much
-        harder than I thought. """
-
-        debug("Full-parsing %s" % self.attribs.url)
-
-        source = docutils.io.StringInput(self.unicode_content())
-        reader = docutils.readers.standalone.Reader()
-        parser = gutenberg_parsers.Parser()
-
-        doc = reader.read(
-            source, parser,
-            self.get_settings((reader, parser, writer), overrides))
-        self.document1 = doc
-
-        self.rewrite_links(partial(urllib.parse.urljoin, self.attribs.url))
-
-        # make it picklable
-        reporter = doc.reporter #  = None
-        # doc.reporter = None
-        transformer = doc.transformer
-        doc.settings = None
-        from docutils.parsers.rst.directives.html import MetaBody
-
-        #for metanode in doc.traverse(MetaBody.meta):
-        for pending in doc.traverse(nodes.pending):
-            # pending.transform = None
-            # docutils' meta nodes aren't picklable because the class is nested
-            # in pending['nodes']
-            if 'nodes' in pending.details:
-                if isinstance(pending.details['nodes'][0], MetaBody.meta):
-                    pending.details['nodes'][0].__class__ = mynodes.meta
-        from six.moves import cPickle as pickle
-        pickled = pickle.dumps(doc)
-
-        doc = pickle.loads(pickled)
-
-        #doc.transformer.populate_from_components(
-        #   (source, reader, parser, writer))
-
-        doc.transformer = transformer
-        doc.reporter = reporter
-        doc.settings = self.get_settings((reader, parser, writer), overrides)
-
-        doc.transformer.apply_transforms()
-
-        return writer.write(doc, destination)
-
     def rst2xetex(self, job):
         """ Convert RST to xetex. """
 
@@ -326,9 +338,7 @@ class Parser(HTMLParser.Parser):
 
     def get_resource(self, package, resource):
         """ import resources. """
-        ref = importlib.resources.files('ebookmaker.' + package).joinpath(resource)
-        contents = ref.read_bytes()
-        return contents.decode('utf-8')
+        return read_resource(package, resource)
 
 
     def get_image_size_from_parser(self, uri):
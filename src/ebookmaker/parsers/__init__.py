@@ -80,6 +80,9 @@ BOGUS_CHARSET_NAMES = {'iso-latin-1': 'iso-8859-1',
                        }
 COREATTRS = ["class", "dir", "id", "lang", "style", "title"]
 
+# elements that make TOC entries
+TOC_HEADERS = {NS.xhtml.h1, NS.xhtml.h2, NS.xhtml.h3, NS.xhtml.h4}
+
 # legal on A but not GLOBAL
 A_NOT_GLOBAL = [
     'download',
@@ -190,6 +193,7 @@ class ParserBase:
         self.fp = None
         self.buffer = None
         self.unicode_buffer = None
+        self.placed_files = {}  # see writers.BaseWriter.copy_aux_file
 
 
     def reset(self):
@@ -269,6 +273,12 @@ class ParserBase:
         return self.buffer
 
 
+    def data_size(self):
+        """ Size of the document content in bytes. """
+
+        return len(self.bytes_content() or b'')
+
+
     def unicode_content(self):
         """ Get document content as unicode string. """
 
@@ -356,6 +366,11 @@ class ParserBase:
         """ Rewrite all links using the dictionary url_map. """
         return
 
+
+    def serialize_to(self, fp):
+        """ Write the serialized file to the file-like object fp. """
+        fp.write(self.serialize())
+
 class TxtParser(ParserBase):
     """ Base class for text files we don't want to convert.
     """
@@ -437,6 +452,9 @@ class HTMLParserBase(ParserBase):
 
     def remap_links(self, url_map):
         """ Rewrite all links using the dictionary url_map. """
+        if not url_map:
+            return
+
         def f(url):
             """ Remap function """
             ur, frag = urllib.parse.urldefrag(url)
@@ -509,7 +527,7 @@ class HTMLParserBase(ParserBase):
             """ clean header text
                 also, replace breaks with whitespace. tidy used to put whitespace around <br>
                 elements. PPs relied on this behavior, so we're stuck. """
-            for br in xpath(header, '//xhtml:br'):
+            for br in header.iter(NS.xhtml.br):
                 if RE_NO_WS.match(str(br.tail)):
                     br.tail = '\n' + str(br.tail) if br.tail else '\n'
 
@@ -528,16 +546,24 @@ class HTMLParserBase(ParserBase):
                 elem.set('id', six.next(idg))
             return elem.get('id')
 
+        def toc_elements():
+            """ Headers, page numbers and contents headers in document order. """
+            ns = '{%s}' % NS.xhtml
+            for elem in xhtml.iter(etree.Element):
+                if elem.tag in TOC_HEADERS:
+                    yield elem
+                elif elem.tag.startswith(ns):
+                    class_ = elem.get('class', '')
+                    # DP page number
+                    if 'pageno' in class_:
+                        yield elem
+                    # DocUtils contents header
+                    elif elem.tag == NS.xhtml.p and 'topic-title' in class_:
+                        yield elem
+
         toc = []
 
-        for header in xpath(
-                xhtml,
-                '//xhtml:h1|//xhtml:h2|//xhtml:h3|//xhtml:h4|'
-                # DP page number
-                '//xhtml:*[contains (@class, "pageno")]|'
-                # DocUtils contents header
-                '//xhtml:p[contains (@class, "topic-title")]'
-            ):
+        for header in toc_elements():
 
             previous = header.getprevious()
             if previous is not None and previous.tag == header.tag:
@@ -587,16 +613,26 @@ class HTMLParserBase(ParserBase):
         return toc
 
 
-    def serialize(self):
-        """ Serialize to string. """
+    def doctype(self):
+        """ The doctype to serialize with. """
         if self.attribs.url.endswith('.xhtml'):
             # epub3
-            doctype = ""
-        else:
-            # epub2
-            doctype=gg.XHTML_DOCTYPE
+            return ""
+        # epub2
+        return gg.XHTML_DOCTYPE
+
+
+    def serialize(self):
+        """ Serialize to string. """
         return etree.tostring(self.xhtml,
-                              doctype=doctype,
+                              doctype=self.doctype(),
                               xml_declaration=True,
                               encoding='utf-8',
                               pretty_print=True)
+
+
+    def serialize_to(self, fp):
+        """ Serialize to fp a few KB at a time, the same bytes as serialize(). """
+        with etree.xmlfile(fp, encoding='utf-8') as xf:
+            xf.write_declaration(doctype=self.doctype())
+            xf.write(self.xhtml, pretty_print=True)
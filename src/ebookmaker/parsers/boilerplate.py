@@ -24,7 +24,9 @@ pg_smallprint
     at the top of the text, and is often comically dated.
 
 
-BeautifulSoup is used for its superior "scraping" tools.
+mark_soup works on a BeautifulSoup, which is used for its superior
+"scraping" tools. mark_tree does the same on an lxml tree without
+namespaces.
 
 """
 
@@ -32,6 +34,7 @@ import copy
 import re
 
 import soupsieve as sv
+from lxml import etree
 
 from libgutenberg.GutenbergGlobals import xmlspecialchars
 from libgutenberg.Logger import critical, info, debug, warning, error
@@ -54,21 +57,22 @@ MARKER_END = re.compile(r"\*+")
 
 def prune(root, divider, after=True):
     ''' prune parts of the root element before or after a divider  '''
-    def next_or_prev(el, after=True):
-        return el.next_sibling if after else el.previous_sibling
-
-    def after_or_before(el, after=True):
-        return list(el.next_siblings) if after else list(el.previous_siblings)
-
     dividers = [divider] + list(divider.parents)
-    keep = False
     for elem in dividers:
         if elem is root:
             break
-        has_sibling = bool(next_or_prev(elem, after=not after))
-        for sibling in after_or_before(elem, after=after):
-            sibling.extract()
-        keep = has_sibling or keep
+        # extract looks for the element in its parent's contents, so only
+        # extract first children, which are found at once
+        parent = elem.parent
+        siblings = parent.contents
+        if after:
+            # take out the children to keep, clear the rest, put them back
+            keep = [siblings[0].extract() for dummy in range(parent.index(elem) + 1)]
+            parent.clear()
+            parent.extend(keep)
+        else:
+            while siblings[0] is not elem:
+                siblings[0].extract()
 
 def check_patterns(node, patterns):
     ''' finds the element containing the marker pattern '''
@@ -144,6 +148,166 @@ def mark_soup(soup):
     return found_top or found_bottom
 
 
+class TreeMarkingError(Exception):
+    ''' mark_tree cannot mark the tree exactly like mark_soup would mark the soup '''
+
+
+# Strings in an lxml tree are the text or tail of an element, or a comment.
+# They are passed around as (element, kind) tuples, kind is 'text', 'tail' or 'comment'.
+
+def string_value(string):
+    elem, kind = string
+    return elem.tail if kind == 'tail' else elem.text
+
+def tree_strings(node):
+    ''' all strings in node, in document order '''
+    for event, elem in etree.iterwalk(node, events=('start', 'end', 'comment')):
+        if event == 'start':
+            if elem.text:
+                yield elem, 'text'
+        elif event == 'comment':
+            yield elem, 'comment'
+            if elem.tail:
+                yield elem, 'tail'
+        elif elem is not node and elem.tail:
+            yield elem, 'tail'
+
+def string_parent(string):
+    elem, kind = string
+    return elem if kind == 'text' else elem.getparent()
+
+def has_class(elem, class_):
+    return class_ in elem.get('class', '').split()
+
+def check_tree_patterns(node, patterns):
+    ''' finds the string containing the marker pattern '''
+    for pattern in patterns:
+        for string in tree_strings(node):
+            if pattern.search(string_value(string)):
+                parent = string_parent(string)
+                in_bp = has_class(parent, 'pg_boilerplate') or any(
+                    has_class(ancestor, 'pg_boilerplate') for ancestor in parent.iterancestors())
+                if not in_bp:
+                    return string
+                break
+
+def only_string(elem):
+    ''' the text of elem if it is the only thing in elem, like soup .string '''
+    if len(elem) == 0:
+        return elem.text
+    if len(elem) == 1 and not elem.text and not elem[0].tail:
+        if not isinstance(elem[0].tag, str):
+            return elem[0].text
+        return only_string(elem[0])
+    return None
+
+def split_tree(root, divider, before=True):
+    ''' move everything in root before (after) the divider and the divider into a new section
+
+    Elements containing the divider stay in root and are copied into the section,
+    so the result is the same as pruning a copy of root and root.
+    '''
+    elem, kind = divider
+    level = string_parent(divider)
+    part = level.makeelement(level.tag, level.attrib)
+    if kind == 'text':
+        part.text, elem.text = elem.text, None
+        if not before:
+            part.extend(list(elem))
+    elif kind == 'tail':
+        index = level.index(elem)
+        if before:
+            part.text, level.text = level.text, None
+            part.extend(level[:index + 1])
+        else:
+            part.text, elem.tail = elem.tail, None
+            part.extend(level[index + 1:])
+    else:
+        index = level.index(elem)
+        if before:
+            part.text, level.text = level.text, None
+            level.text, elem.tail = elem.tail, None
+            part.extend(level[:index + 1])
+        else:
+            part.extend(level[index:])
+
+    while level is not root:
+        parent = level.getparent()
+        index = parent.index(level)
+        parent_part = parent.makeelement(parent.tag, parent.attrib)
+        if before:
+            parent_part.text, parent.text = parent.text, None
+            parent_part.extend(parent[:index])
+            parent_part.append(part)
+        else:
+            parent_part.append(part)
+            part.tail, level.tail = level.tail, None
+            parent_part.extend(parent[index + 1:])
+        part = parent_part
+        level = parent
+    return part
+
+def mark_tree(html):
+    ''' mark_soup for an html element '''
+    def mark_bp(node, mark, markers, top=True):
+        for marked in node.iterdescendants():
+            if marked.get('id') == mark:
+                marked.tag = 'section'
+                return True
+        divider = check_tree_patterns(node, markers)
+        if divider:
+
+            # the span mess of mark_soup
+            elem, kind = divider
+            span = None
+            if kind == 'text':
+                span = elem[0] if len(elem) else None
+            elif kind == 'tail' or not elem.tail:
+                span = elem.getnext()
+            if span is not None and span.tag == 'span':
+                if span.tail or (span.getnext() is not None and
+                                 not isinstance(span.getnext().tag, str)):
+                    span_string = only_string(span)
+                    if kind == 'comment' or not span.tail or span_string is None:
+                        # the soup would get two adjacent strings or fail
+                        raise TreeMarkingError('cannot merge marker %r' % string_value(divider))
+                    merged = string_value(divider) + span_string + span.tail
+                    if kind == 'text':
+                        elem.text = merged
+                    else:
+                        elem.tail = merged
+                    span.getparent().remove(span)
+
+            bp_section = split_tree(node, divider, before=top)
+            bp_section.tag = 'section'
+            bp_section.attrib.clear()
+            bp_section.set('id', mark)
+            bp_section.set('class', 'pg_boilerplate')
+
+            # insert the boilerplate
+            if top:
+                bp_section.tail, node.text = node.text, None
+                node.insert(0, bp_section)
+            else:
+                node.append(bp_section)
+            return True
+        return False
+
+    body = next(html.iter('body'), None)
+    if body is None:
+        return None
+
+    found_top = mark_bp(body, 'pg-header', TOP_MARKERS, top=True)
+    if not found_top:
+        info('No PG header marker found.')
+
+    found_bottom = mark_bp(body, 'pg-footer', BOTTOM_MARKERS, top=False)
+    if not found_bottom:
+        info('No PG footer marker found.')
+
+    return found_top or found_bottom
+
+
 def strip_headers_from_txt(text):
     '''
     when input is plain text, strip the heaters and return (stripped_text, pg_header, pg_footer)
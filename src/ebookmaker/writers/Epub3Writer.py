@@ -31,9 +31,11 @@ from libgutenberg.MediaTypes import mediatypes as mt
 from ebookmaker import parsers
 from ebookmaker import ParserFactory
 from ebookmaker import HTMLChunker
+from ebookmaker import Metrics
 from ebookmaker.CommonCode import EbookAltText, Options
 from ebookmaker.Version import VERSION, GENERATOR
 from ebookmaker.Spider import OPS_AUDIO_MEDIATYPES
+from ebookmaker.parsers.CSSParser import CSSRewriter
 
 from .EpubWriter import (
     MAX_IMAGE_SIZE,
@@ -561,30 +563,39 @@ class Writer(EpubWriter.Writer):
         for e in xpath(xhtml, "//xhtml:math"):
             e.attrib['xmlns'] = "http://www.w3.org/1998/Math/MathML"
 
+    @staticmethod
+    def fix_media_rule(rule):
+        """ Replace "media handheld" rules. """
+        for medium in rule.media:
+            if medium == 'handheld':
+                rule.media.deleteMedium(medium)
+                rule.media.appendMedium(HANDHELD_QUERY)
+
+    @staticmethod
+    def fix_incompatible_rule(rule):
+        """ Strip CSS properties and values of a style rule that are not EPUB3 compatible. """
+        for p in list(rule.style):
+            # Apple books only allows position property in fixed-layout books
+            if p.name == 'position':
+                debug("Dropping property %s" % p.name)
+                rule.style.removeProperty('position')
+                rule.style.removeProperty('left')
+                rule.style.removeProperty('right')
+                rule.style.removeProperty('top')
+                rule.style.removeProperty('bottom')
+
+    @staticmethod
+    def incompatible_css_rewriter():
+        """ The fixes for CSS that is not EPUB3 compatible. """
+        return CSSRewriter(style_fixes=[Writer.fix_incompatible_rule],
+                           media_fixes=[Writer.fix_media_rule])
+
     @staticmethod
     def fix_incompatible_css(sheet):
         """ Strip CSS properties and values that are not EPUB3 compatible.
             Remove "media handheld" rules
         """
-        cssclass = re.compile(r'\.(-?[_a-zA-Z]+[_a-zA-Z0-9-]*)')
-        for rule in sheet:
-            if rule.type == rule.MEDIA_RULE:
-                for medium in rule.media:
-                    if medium == 'handheld':
-                        rule.media.deleteMedium(medium)
-                        rule.media.appendMedium(HANDHELD_QUERY)
-
-            if rule.type == rule.STYLE_RULE:
-                ruleclasses = list(cssclass.findall(rule.selectorList.selectorText))
-                for p in list(rule.style):
-                    # Apple books only allows position property in fixed-layout books
-                    if p.name == 'position':
-                        debug("Dropping property %s" % p.name)
-                        rule.style.removeProperty('position')
-                        rule.style.removeProperty('left')
-                        rule.style.removeProperty('right')
-                        rule.style.removeProperty('top')
-                        rule.style.removeProperty('bottom')
+        Writer.incompatible_css_rewriter().apply(sheet)
 
     def shipout(self, job, parserlist, ncx, ncx2):
         """ Build the zip file. """
@@ -602,8 +613,15 @@ class Writer(EpubWriter.Writer):
 
             for p in parserlist:
                 try:
-                    ocf.add_bytes(self.url2filename(p.attribs.url), p.serialize(),
-                                  p.mediatype())
+                    path = p.serialized_path() if hasattr(p, 'serialized_path') else None
+                    if path:
+                        # images stream from their files
+                        ocf.add_file(self.url2filename(p.attribs.url), path, p.mediatype())
+                    else:
+                        # serialized straight into the zip
+                        size = ocf.add_stream(self.url2filename(p.attribs.url),
+                                              p.serialize_to, p.mediatype())
+                        Metrics.count('serialize', docs=1, bytes=size)
                     if p.mediatype() == mt.xhtml:
                         opf.spine_item_from_parser(p)
                     else:
@@ -647,6 +665,16 @@ class Writer(EpubWriter.Writer):
             raise
 
 
+    @staticmethod
+    def image_limits(job, p):
+        """ Return (max_size, max_dimen) for the image of parser p. """
+        if 'icon' in p.attribs.rel:
+            return MAX_IMAGE_SIZE, MAX_COVER_DIMEN
+        if 'linked_image' in p.attribs.rel:
+            return LINKED_IMAGE_SIZE, LINKED_IMAGE_DIMEN
+        return MAX_IMAGE_SIZE, MAX_IMAGE_DIMEN
+
+
     def build(self, job):
         """ Build epub """
 
@@ -662,115 +690,106 @@ class Writer(EpubWriter.Writer):
 
         try:
             chunker = HTMLChunker.HTMLChunker(version='epub3')
-            coverpage_url = None
 
             # do images early as we need the new dimensions later
-            for p in job.spider.parsers:
-                if hasattr(p, 'resize_image'):
-                    unsized_url = p.attribs.url
-                    if 'icon' in p.attribs.rel:
-                        np = p.resize_image(MAX_IMAGE_SIZE, MAX_COVER_DIMEN)
-                        np.id = p.attribs.get('id', 'coverpage')
-                        coverpage_url = p.attribs.url
-                    elif 'linked_image' in p.attribs.rel:
-                        np = p.resize_image(LINKED_IMAGE_SIZE, LINKED_IMAGE_DIMEN)
-                        np.id = p.attribs.get('id')
-                    else:
-                        np = p.resize_image(MAX_IMAGE_SIZE, MAX_IMAGE_DIMEN)
-                        np.id = p.attribs.get('id')
-                    if unsized_url != p.attribs.url:
-                        idmap[unsized_url] = p.attribs.url
-                    parserlist.append(np)
-
-            for p in job.spider.parsers:
-                if p.mediatype() in OPS_CONTENT_DOCUMENTS:
-                    debug("URL: %s" % p.attribs.url)
-
-                    if hasattr(p, 'rst2epub2'):
-                        xhtml = p.rst2epub2(job)
-                        xhtml = copy.deepcopy(xhtml)
-
-                        if options.verbose >= 2:
-                            # write html to disk for debugging
-                            debugfilename = os.path.join(os.path.abspath(job.outputdir),
-                                                         job.outputfile)
-                            debugfilename = os.path.splitext(debugfilename)[0] + '.' + \
-                                job.maintype + '.debug.html'
-                            with open(debugfilename, 'wb') as fp:
-                                fp.write(etree.tostring(xhtml, encoding='utf-8'))
-
-                    else:
-                        # make a copy so we can mess around
-                        p.parse()
-
-                        # rewrite the changed image links
-                        p.remap_links(idmap)
-
-                        xhtml = copy.deepcopy(p.xhtml) if hasattr(p, 'xhtml') else None
-
-                    if xhtml is not None:
-                    
-                        # can't have absolute positions in reflowable EPUB3
-                        strip_classes = self.get_classes_with_prop(xhtml, props=('position'))                        
-                        strip_classes = strip_classes.intersection(STRIP_CLASSES)
-                        if strip_classes:
-                            self.strip_pagenumbers(xhtml, strip_classes)
-
-                        if not boilerplate_done:
-                            HTMLWriter.Writer.replace_boilerplate(job, xhtml)
+            coverpage_url = self.resize_images(job, parserlist, idmap)
+
+            with Metrics.stage('transform'):
+                for p in job.spider.parsers:
+                    if p.mediatype() in OPS_CONTENT_DOCUMENTS:
+                        debug("URL: %s" % p.attribs.url)
+                        Metrics.count('transform', docs=1)
+
+                        if hasattr(p, 'rst2epub2'):
+                            xhtml = p.rst2epub2(job)
+                            xhtml = copy.deepcopy(xhtml)
+
+                            if options.verbose >= 2:
+                                # write html to disk for debugging
+                                debugfilename = os.path.join(os.path.abspath(job.outputdir),
+                                                             job.outputfile)
+                                debugfilename = os.path.splitext(debugfilename)[0] + '.' + \
+                                    job.maintype + '.debug.html'
+                                with open(debugfilename, 'wb') as fp:
+                                    fp.write(etree.tostring(xhtml, encoding='utf-8'))
+
+                            HTMLWriter.Writer.normalize(job, xhtml, p.attribs.url,
+                                                        boilerplate=not boilerplate_done)
                             boilerplate_done = True
-                        HTMLWriter.Writer.xhtml_to_html(xhtml)
-
-                        self.html_for_epub3(xhtml)
-                        xhtml.make_links_absolute(base_url=p.attribs.url)
-
-                        # build up TOC
-                        # has side effects on xhtml
-                        ncx.toc += p.make_toc(xhtml)
-                        ncx2.toc += p.make_toc(xhtml)
-
-                        # allows authors to customize css for epub
-                        self.add_body_class(xhtml, 'x-ebookmaker')
-                        self.add_body_class(xhtml, 'x-ebookmaker-3')
 
-                        self.insert_root_div(xhtml)
+                        else:
+                            # make a copy so we can mess around
+                            p.parse()
 
-                        # strip all links to items not in manifest
-                        p.strip_links(xhtml, job.spider.dict_urls_mediatypes())
-                        self.strip_links(xhtml, job.spider.dict_urls_mediatypes())
+                            # rewrite the changed image links
+                            p.remap_links(idmap)
 
-                        self.strip_noepub(xhtml)
+                            if hasattr(p, 'xhtml'):
+                                xhtml = HTMLWriter.Writer.normalized_xhtml(
+                                    job, p, boilerplate=not boilerplate_done)
+                                boilerplate_done = True
+                            else:
+                                xhtml = None
 
-                        self.fix_html_image_dimensions(xhtml)
-                        if coverpage_url and not hasattr(p.attribs, 'nonlinear'):
-                            self.remove_coverpage(xhtml, coverpage_url)
-
-                        # externalize and fix CSS
-                        for style in xpath(xhtml, '//xhtml:style'):
-                            self.add_external_css(
-                                job.spider, xhtml, style.text, "%d.css" % css_count)
-                            css_count += 1
-                            style.drop_tree()
-
-                        self.add_external_css(job.spider, xhtml, None, 'pgepub.css')
-
-                        self.add_meta_generator(xhtml)
-
-                        debug("Splitting %s ..." % p.attribs.url)
-                        chunker.next_id = 0
-                        chunker.split(xhtml, p.attribs)
-                    else:
-                        # parsing xml worked, but it isn't xhtml. so we need to reset mediatype
-                        # to something that isn't recognized as content
-                        p.attribs.mediatype = 'text/xml'
+                        if xhtml is not None:
+                    
+                            # can't have absolute positions in reflowable EPUB3
+                            strip_classes = self.get_classes_with_prop(xhtml, props=('position'))                        
+                            strip_classes = strip_classes.intersection(STRIP_CLASSES)
+                            if strip_classes:
+                                self.strip_pagenumbers(xhtml, strip_classes)
+
+                            HTMLWriter.Writer.xhtml_to_html(xhtml)
+
+                            self.html_for_epub3(xhtml)
+
+                            # build up TOC
+                            # has side effects on xhtml
+                            toc = p.make_toc(xhtml)
+                            ncx.toc += toc
+                            # the entries get rewritten in place
+                            ncx2.toc += [list(entry) for entry in toc]
+
+                            # allows authors to customize css for epub
+                            self.add_body_class(xhtml, 'x-ebookmaker')
+                            self.add_body_class(xhtml, 'x-ebookmaker-3')
+
+                            self.insert_root_div(xhtml)
+
+                            # strip all links to items not in manifest
+                            p.strip_links(xhtml, job.spider.dict_urls_mediatypes())
+                            self.strip_links(xhtml, job.spider.dict_urls_mediatypes())
+
+                            self.strip_noepub(xhtml)
+
+                            self.fix_html_image_dimensions(xhtml)
+                            if coverpage_url and not hasattr(p.attribs, 'nonlinear'):
+                                self.remove_coverpage(xhtml, coverpage_url)
+
+                            # externalize and fix CSS
+                            for style in xpath(xhtml, '//xhtml:style'):
+                                self.add_external_css(
+                                    job.spider, xhtml, style.text, "%d.css" % css_count)
+                                css_count += 1
+                                style.drop_tree()
+
+                            self.add_external_css(job.spider, xhtml, None, 'pgepub.css')
+
+                            self.add_meta_generator(xhtml)
+
+                            debug("Splitting %s ..." % p.attribs.url)
+                            chunker.next_id = 0
+                            chunker.split(xhtml, p.attribs)
+                        else:
+                            # parsing xml worked, but it isn't xhtml. so we need to reset mediatype
+                            # to something that isn't recognized as content
+                            p.attribs.mediatype = 'text/xml'
+            css_rewriter = self.css_rewriter(job)
             for p in job.spider.parsers:
                 if str(p.attribs.mediatype) == 'text/css':
                     p.parse()
                 if hasattr(p, 'sheet') and p.sheet:
-                    self.fix_incompatible_css(p.sheet)
-                    if job.subtype == '.noimages':
-                        p.strip_images()
-                    p.rewrite_links(self.url2filename)
+                    css_rewriter.apply(p.sheet)
                     parserlist.append(p)
                     continue
                 if str(p.attribs.mediatype) in OPS_FONT_TYPES:
@@ -780,6 +799,8 @@ class Writer(EpubWriter.Writer):
                 if str(p.attribs.mediatype) in OPS_AUDIO_MEDIATYPES:
                     parserlist.append(p)
 
+            Metrics.count('chunk', chunks=len(chunker.chunks))
+
             # after splitting html into chunks we have to rewrite all
             # internal links in HTML
             chunker.rewrite_internal_links()
@@ -17,8 +17,10 @@ Writes an EPUB file.
 import copy
 import datetime
 import importlib
+import io
 import os
 import re
+import shutil
 import time
 import zipfile
 
@@ -35,9 +37,13 @@ from libgutenberg.MediaTypes import mediatypes as mt
 from ebookmaker import parsers
 from ebookmaker import ParserFactory
 from ebookmaker import HTMLChunker
+from ebookmaker import Metrics
 from ebookmaker import writers
 from ebookmaker.CommonCode import Options
 from ebookmaker.Version import VERSION, GENERATOR
+from ebookmaker.ZipWriter import ZipWriter, MAX_QUEUED_SIZE
+from ebookmaker.parsers import ImageParser
+from ebookmaker.parsers.CSSParser import CSSRewriter, drop_images
 from ebookmaker.utils import gg, xpath
 
 from . import HTMLWriter
@@ -146,7 +152,7 @@ OPS_FONT_TYPES = set(('application/font-woff', 'application/vnd.ms-opentype'))
 match_link_url = re.compile(r'^(https?://|mailto:)', re.I)
 match_non_link = re.compile(r'[a-zA-Z0-9_\-\.]*(#.*)?$')
 
-class OEBPSContainer(zipfile.ZipFile):
+class OEBPSContainer(ZipWriter):
     """ Class representing an OEBPS Container. """
 
     def __init__(self, filename, oebps_path=None):
@@ -162,7 +168,7 @@ class OEBPSContainer(zipfile.ZipFile):
         mkdir_for_filename(filename)
 
         # open zipfile
-        zipfile.ZipFile.__init__(self, filename, 'w', zipfile.ZIP_DEFLATED)
+        ZipWriter.__init__(self, filename)
 
         # write mimetype
         # the OCF spec says mimetype must be first and uncompressed
@@ -176,6 +182,7 @@ class OEBPSContainer(zipfile.ZipFile):
         self.wrappers = 0 # to generate unique filenames for wrappers
 
 
+    @Metrics.timed('zip')
     def commit(self):
         """ Close OCF Container. """
         debug("Done Epub file: %s" % self.zipfilename)
@@ -188,26 +195,63 @@ class OEBPSContainer(zipfile.ZipFile):
         os.remove(self.zipfilename)
 
 
+    @Metrics.timed('zip')
     def add_unicode(self, name, u):
         """ Add file to zip from unicode string. """
         i = self.zi(name)
-        self.writestr(i, u.encode('utf-8'))
+        bytes_ = u.encode('utf-8')
+        self.queue(i, bytes_)
+        Metrics.count('zip', files=1, bytes=len(bytes_))
 
 
+    @Metrics.timed('zip')
     def add_bytes(self, name, bytes_, mediatype=None):
         """ Add file to zip from bytes string. """
 
         i = self.zi(name)
         if mediatype and mediatype in parsers.ImageParser.mediatypes:
             i.compress_type = zipfile.ZIP_STORED
-        self.writestr(i, bytes_)
+        self.queue(i, bytes_)
+        Metrics.count('zip', files=1, bytes=len(bytes_))
 
 
-    def add_file(self, name, url, mediatype=None):
-        """ Add file to zip from bytes string. """
+    @Metrics.timed('zip')
+    def add_stream(self, name, write, mediatype=None):
+        """ Add file to zip, write(fp) writes its contents to a file object.
+
+        Returns the size of the file.
+
+        """
+
+        i = self.zi(name)
+        if mediatype and mediatype in parsers.ImageParser.mediatypes:
+            i.compress_type = zipfile.ZIP_STORED
+        if self.compresses_in_pool(i):
+            fp_dest = io.BytesIO()
+            write(fp_dest)
+            self.queue(i, fp_dest.getvalue())
+        else:
+            with self.open_member(i) as fp_dest:
+                write(fp_dest)
+        Metrics.count('zip', files=1, bytes=i.file_size)
+        return i.file_size
 
-        with open(url) as fp:
-            self.add_bytes(name, fp.read(), mediatype)
+
+    @Metrics.timed('zip')
+    def add_file(self, name, path, mediatype=None):
+        """ Add file to zip from a file, without reading it all into memory. """
+
+        i = self.zi(name)
+        if mediatype and mediatype in parsers.ImageParser.mediatypes:
+            i.compress_type = zipfile.ZIP_STORED
+        i.file_size = os.path.getsize(path)
+        if self.compresses_in_pool(i) and i.file_size <= MAX_QUEUED_SIZE:
+            with open(path, 'rb') as fp_src:
+                self.queue(i, fp_src.read())
+        else:
+            with open(path, 'rb') as fp_src, self.open_member(i) as fp_dest:
+                shutil.copyfileobj(fp_src, fp_dest, 1024 * 1024)
+        Metrics.count('zip', files=1, bytes=i.file_size)
 
 
     def zi(self, filename=None):
@@ -252,7 +296,7 @@ class OEBPSContainer(zipfile.ZipFile):
 
         i = self.zi()
         i.filename = 'META-INF/container.xml'
-        self.writestr(i, etree.tostring(
+        self.queue(i, etree.tostring(
             container, encoding='utf-8', xml_declaration=True, pretty_print=True))
 
 
@@ -899,59 +943,82 @@ class Writer(writers.HTMLishWriter):
                 node.tail = str(node.tail).translate(Writer.translate_map)
 
 
+    CSSCLASS = re.compile(r'\.(-?[_a-zA-Z]+[_a-zA-Z0-9-]*)')
+    HTML5TAG = re.compile(r'(^|[ ,~>+])(figure|figcaption|footer|header|section|nav|main)')
+
+    @staticmethod
+    def fix_html5_selector(text):
+        """ Change html5 tags in a selector to classes with the same name. """
+        return Writer.HTML5TAG.sub(r'\1div.\2', text)
+
+
+    @staticmethod
+    def fix_media_rule(rule):
+        """ Unpack "media handheld" rules. """
+        if rule.media.mediaText.find('handheld') > -1:
+            debug("Unpacking CSS @media handheld rule.")
+            rule.media.mediaText = 'all'
+            info("replacing  @media handheld rule with @media all")
+
+
+    @staticmethod
+    def fix_incompatible_rule(rule):
+        """ Strip CSS properties and values of a style rule that are not EPUB compatible. """
+        ruleclasses = list(Writer.CSSCLASS.findall(rule.selectorList.selectorText))
+        for p in list(rule.style):
+            if p.name == 'float' and "x-ebookmaker" not in ruleclasses:
+                debug("Dropping property %s" % p.name)
+                rule.style.removeProperty('float')
+                rule.style.removeProperty('width')
+                rule.style.removeProperty('height')
+            elif p.name == 'position':
+                debug("Dropping property %s" % p.name)
+                rule.style.removeProperty('position')
+                rule.style.removeProperty('left')
+                rule.style.removeProperty('right')
+                rule.style.removeProperty('top')
+                rule.style.removeProperty('bottom')
+            elif p.name in ('background-image', 'background-position',
+                            'background-attachment', 'background-repeat'):
+                debug("Dropping property %s" % p.name)
+                rule.style.removeProperty(p.name)
+            elif 'border' not in p.name and 'px' in p.value:
+                debug("Dropping property with px value %s" % p.name)
+                rule.style.removeProperty(p.name)
+            elif p.name == 'speak':
+                val = rule.style.getPropertyValue('speak')
+                if val == 'spell-out':
+                    rule.style.removeProperty('speak')
+                    rule.style.setProperty('speak-as', 'spell-out')
+                elif val == 'none':
+                    rule.style.setProperty('speak', 'never')
+                elif val == 'inherit':
+                    rule.style.setProperty('speak', 'auto')
+
+
+    @staticmethod
+    def incompatible_css_rewriter():
+        """ The fixes for CSS that is not EPUB compatible. """
+        return CSSRewriter(selector_fixes=[Writer.fix_html5_selector],
+                           style_fixes=[Writer.fix_incompatible_rule],
+                           media_fixes=[Writer.fix_media_rule])
+
+
     @staticmethod
     def fix_incompatible_css(sheet):
         """ Strip CSS properties and values that are not EPUB compatible.
             Unpack "media handheld" rules
         """
+        Writer.incompatible_css_rewriter().apply(sheet)
+
 
-        cssclass = re.compile(r'\.(-?[_a-zA-Z]+[_a-zA-Z0-9-]*)')
-        html5tag = re.compile(r'(^|[ ,~>+])(figure|figcaption|footer|header|section|nav|main)')
-
-        for rule in sheet:
-            if rule.type == rule.MEDIA_RULE:
-                if rule.media.mediaText.find('handheld') > -1:
-                    debug("Unpacking CSS @media handheld rule.")
-                    rule.media.mediaText = 'all'
-                    info("replacing  @media handheld rule with @media all")
-
-            if rule.type == rule.STYLE_RULE:
-                #change html5 tags to classes with the same name
-                newrule = html5tag.sub(r'\1div.\2', rule.selectorList.selectorText)
-                rule.selectorList.selectorText = newrule
-
-                ruleclasses = list(cssclass.findall(rule.selectorList.selectorText))
-                for p in list(rule.style):
-                    if p.name == 'float' and "x-ebookmaker" not in ruleclasses:
-                        debug("Dropping property %s" % p.name)
-                        rule.style.removeProperty('float')
-                        rule.style.removeProperty('width')
-                        rule.style.removeProperty('height')
-                    elif p.name == 'position':
-                        debug("Dropping property %s" % p.name)
-                        rule.style.removeProperty('position')
-                        rule.style.removeProperty('left')
-                        rule.style.removeProperty('right')
-                        rule.style.removeProperty('top')
-                        rule.style.removeProperty('bottom')
-                    elif p.name in ('background-image', 'background-position',
-                                    'background-attachment', 'background-repeat'):
-                        debug("Dropping property %s" % p.name)
-                        rule.style.removeProperty(p.name)
-                    elif 'border' not in p.name and 'px' in p.value:
-                        debug("Dropping property with px value %s" % p.name)
-                        rule.style.removeProperty(p.name)
-                    elif p.name == 'speak':
-                        val = rule.style.getPropertyValue('speak')
-                        if val == 'spell-out':
-                            rule.style.removeProperty('speak')
-                            rule.style.setProperty('speak-as', 'spell-out')
-                        elif val == 'none':
-                            rule.style.setProperty('speak', 'never')
-                        elif val == 'inherit':
-                            rule.style.setProperty('speak', 'auto')
-
-        # debug("exit fix_incompatible_css")
+    def css_rewriter(self, job):
+        """ All the fixes of a sheet in this book, for one pass over it. """
+        rewriter = self.incompatible_css_rewriter()
+        if job.subtype == '.noimages':
+            rewriter.style_fixes.append(drop_images)
+        rewriter.url_fix = self.url2filename
+        return rewriter
 
 
     @staticmethod
@@ -962,11 +1029,8 @@ class Writer(writers.HTMLishWriter):
         regex = re.compile(r"\.(\w+)", re.ASCII)
 
         for style in xpath(xhtml, "//xhtml:style"):
-            p = parsers.CSSParser.Parser()
             if style.text: # try to fix os-dependent empty style bug
-                p.parse_string(style.text)
-
-                for rule in p.sheet:
+                for rule in parsers.CSSParser.shared_sheet(style.text):
                     if rule.type == rule.STYLE_RULE:
                         for p in rule.style:
                             if p.name in props:
@@ -983,14 +1047,13 @@ class Writer(writers.HTMLishWriter):
         # debug("enter fix_style_elements")
 
         for style in xpath(xhtml, "//xhtml:style"):
-            p = parsers.CSSParser.Parser()
             if style.text: # try to fix os-dependent empty style bug
-                p.parse_string(style.text)
+                css_text = parsers.CSSParser.sheet_text(style.text)
                 try:
                     # pylint: disable=E1103
-                    style.text = p.sheet.cssText.decode('utf-8') or '/* empty style */'
+                    style.text = css_text.decode('utf-8') or '/* empty style */'
                 except (ValueError, UnicodeError):
-                    debug("CSS:\n%s" % p.sheet.cssText)
+                    debug("CSS:\n%s" % css_text)
                     raise
 
         # debug("exit fix_style_elements")
@@ -1339,8 +1402,15 @@ class Writer(writers.HTMLishWriter):
 
             for p in parserlist:
                 try:
-                    ocf.add_bytes(self.url2filename(p.attribs.url), p.serialize(),
-                                  p.mediatype())
+                    path = p.serialized_path() if hasattr(p, 'serialized_path') else None
+                    if path:
+                        # images stream from their files
+                        ocf.add_file(self.url2filename(p.attribs.url), path, p.mediatype())
+                    else:
+                        # serialized straight into the zip
+                        size = ocf.add_stream(self.url2filename(p.attribs.url),
+                                              p.serialize_to, p.mediatype())
+                        Metrics.count('serialize', docs=1, bytes=size)
                     if p.mediatype() == mt.xhtml:
                         opf.spine_item_from_parser(p)
                     else:
@@ -1374,6 +1444,46 @@ class Writer(writers.HTMLishWriter):
             raise
 
 
+    @staticmethod
+    def image_limits(job, p):
+        """ Return (max_size, max_dimen) for the image of parser p. """
+        if 'icon' in p.attribs.rel:
+            if job.subtype == '.noimages':
+                return MAX_NOIMAGE_SIZE, MAX_COVER_DIMEN
+            return MAX_IMAGE_SIZE, MAX_COVER_DIMEN
+        if 'linked_image' in p.attribs.rel:
+            if job.subtype == '.noimages':
+                return MAX_NOIMAGE_SIZE, LINKED_IMAGE_DIMEN
+            return LINKED_IMAGE_SIZE, LINKED_IMAGE_DIMEN
+        return MAX_IMAGE_SIZE, MAX_IMAGE_DIMEN
+
+
+    def resize_images(self, job, parserlist, idmap):
+        """ Resize the images of the book.
+
+        Appends the resized parsers to parserlist and the changed urls
+        to idmap. Returns the url of the coverpage or None.
+
+        """
+
+        coverpage_url = None
+        images = [p for p in job.spider.parsers if hasattr(p, 'resize_image')]
+        unsized_urls = [p.attribs.url for p in images]
+        resized = ImageParser.resize_images(
+            [(p,) + self.image_limits(job, p) for p in images])
+
+        for p, unsized_url, np in zip(images, unsized_urls, resized):
+            if 'icon' in p.attribs.rel:
+                np.id = p.attribs.get('id', 'coverpage')
+                coverpage_url = p.attribs.url
+            else:
+                np.id = p.attribs.get('id')
+            if unsized_url != p.attribs.url:
+                idmap[unsized_url] = p.attribs.url
+            parserlist.append(np)
+        return coverpage_url
+
+
     def build(self, job):
         """ Build epub """
 
@@ -1388,135 +1498,116 @@ class Writer(writers.HTMLishWriter):
 
         try:
             chunker = HTMLChunker.HTMLChunker()
-            coverpage_url = None
 
             # do images early as we need the new dimensions later
-            for p in job.spider.parsers:
-                if hasattr(p, 'resize_image'):
-                    unsized_url = p.attribs.url
-                    if 'icon' in p.attribs.rel:
-                        if job.subtype == '.noimages':
-                            np = p.resize_image(MAX_NOIMAGE_SIZE, MAX_COVER_DIMEN)
-                        else:
-                            np = p.resize_image(MAX_IMAGE_SIZE, MAX_COVER_DIMEN)
-                        np.id = p.attribs.get('id', 'coverpage')
-                        coverpage_url = p.attribs.url
-                    elif 'linked_image' in p.attribs.rel:
-                        if job.subtype == '.noimages':
-                            np = p.resize_image(MAX_NOIMAGE_SIZE, LINKED_IMAGE_DIMEN)
-                        else:
-                            np = p.resize_image(LINKED_IMAGE_SIZE, LINKED_IMAGE_DIMEN)
-                        np.id = p.attribs.get('id')
-                    else:
-                        np = p.resize_image(MAX_IMAGE_SIZE, MAX_IMAGE_DIMEN)
-                        np.id = p.attribs.get('id')
-                    if unsized_url != p.attribs.url:
-                        idmap[unsized_url] = p.attribs.url
-                    parserlist.append(np)
-
-            for p in job.spider.parsers:
-                if p.mediatype() in OPS_CONTENT_DOCUMENTS:
-                    debug("URL: %s" % p.attribs.url)
-
-                    if hasattr(p, 'rst2epub2'):
-                        xhtml = p.rst2epub2(job)
-                        xhtml = copy.deepcopy(xhtml)
-                        self.fix_html5(xhtml)
-
-                        if options.verbose >= 2:
-                            # write html to disk for debugging
-                            debugfilename = os.path.join(os.path.abspath(job.outputdir),
-                                                         job.outputfile)
-                            debugfilename = os.path.splitext(debugfilename)[0] + '.' + \
-                                job.maintype + '.debug.html'
-                            with open(debugfilename, 'wb') as fp:
-                                fp.write(etree.tostring(xhtml, encoding='utf-8'))
-
-                    else:
-                        # make a copy so we can mess around
-                        p.parse()
-
-                        # rewrite the changed image links
-                        p.remap_links(idmap)
-
-                        xhtml = copy.deepcopy(p.xhtml) if hasattr(p, 'xhtml') else None
-                    if xhtml is not None:
-                        if not boilerplate_done:
-                            HTMLWriter.Writer.replace_boilerplate(job, xhtml)
+            coverpage_url = self.resize_images(job, parserlist, idmap)
+
+            with Metrics.stage('transform'):
+                for p in job.spider.parsers:
+                    if p.mediatype() in OPS_CONTENT_DOCUMENTS:
+                        debug("URL: %s" % p.attribs.url)
+                        Metrics.count('transform', docs=1)
+
+                        if hasattr(p, 'rst2epub2'):
+                            xhtml = p.rst2epub2(job)
+                            xhtml = copy.deepcopy(xhtml)
+                            self.fix_html5(xhtml)
+
+                            if options.verbose >= 2:
+                                # write html to disk for debugging
+                                debugfilename = os.path.join(os.path.abspath(job.outputdir),
+                                                             job.outputfile)
+                                debugfilename = os.path.splitext(debugfilename)[0] + '.' + \
+                                    job.maintype + '.debug.html'
+                                with open(debugfilename, 'wb') as fp:
+                                    fp.write(etree.tostring(xhtml, encoding='utf-8'))
+
+                            HTMLWriter.Writer.normalize(job, xhtml, p.attribs.url,
+                                                        boilerplate=not boilerplate_done)
                             boilerplate_done = True
 
-                        # rewrite the changed image links
-                        p.remap_links(idmap)
-
-                        xhtml.make_links_absolute(base_url=p.attribs.url)
-                        self.fix_html5(xhtml)
-
-                        strip_classes = self.get_classes_with_prop(xhtml)
-                        strip_classes = strip_classes.intersection(STRIP_CLASSES)
-                        if strip_classes:
-                            self.strip_pagenumbers(xhtml, strip_classes)
-
-                        # build up TOC
-                        # has side effects on xhtml
-                        ncx.toc += p.make_toc(xhtml)
-
-                        # allows authors to customize css for epub
-                        self.add_body_class(xhtml, 'x-ebookmaker')
-                        self.add_body_class(xhtml, 'x-ebookmaker-2')
-
-                        self.insert_root_div(xhtml)
-                        self.fix_charset(xhtml)
-                        self.fix_style_elements(xhtml)
-
-                        if job.subtype in ('.images', '.noimages'):
-                            # omit for future subtype '.v3'
-                            self.reflow_pre(xhtml)
-                            self.render_q(xhtml)
-
-                        # strip all links to items not in manifest
-                        p.strip_links(xhtml, job.spider.dict_urls_mediatypes())
-                        self.strip_links(xhtml, job.spider.dict_urls_mediatypes())
-                        self.strip_data_attribs(xhtml)
-                        self.strip_aria_attribs(xhtml)
-
-                        self.strip_noepub(xhtml)
-                        # self.strip_rst_dropcaps(xhtml)
-
-                        self.fix_html_image_dimensions(xhtml)
-                        if coverpage_url and not hasattr(p.attribs, 'nonlinear'):
-                            self.remove_coverpage(xhtml, coverpage_url)
-
-                        # externalize and fix CSS
-                        for style in xpath(xhtml, '//xhtml:style'):
-                            self.add_external_css(
-                                job.spider, xhtml, style.text, "%d.css" % css_count)
-                            css_count += 1
-                            style.drop_tree()
-
-                        self.add_external_css(job.spider, xhtml, None, 'pgepub.css')
-
-                        self.add_meta_generator(xhtml)
-
-                        debug("Splitting %s ..." % p.attribs.url)
-                        chunker.next_id = 0
-                        chunker.split(xhtml, p.attribs)
-                    else:
-                        # parsing xml worked, but it isn't xhtml. so we need to reset mediatype
-                        # to something that isn't recognized as content
-                        p.attribs.mediatype = 'text/xml'
+                        else:
+                            # make a copy so we can mess around
+                            p.parse()
+
+                            # rewrite the changed image links
+                            p.remap_links(idmap)
+
+                            if hasattr(p, 'xhtml'):
+                                xhtml = HTMLWriter.Writer.normalized_xhtml(
+                                    job, p, boilerplate=not boilerplate_done)
+                                boilerplate_done = True
+                            else:
+                                xhtml = None
+                        if xhtml is not None:
+                            self.fix_html5(xhtml)
+
+                            strip_classes = self.get_classes_with_prop(xhtml)
+                            strip_classes = strip_classes.intersection(STRIP_CLASSES)
+                            if strip_classes:
+                                self.strip_pagenumbers(xhtml, strip_classes)
+
+                            # build up TOC
+                            # has side effects on xhtml
+                            ncx.toc += p.make_toc(xhtml)
+
+                            # allows authors to customize css for epub
+                            self.add_body_class(xhtml, 'x-ebookmaker')
+                            self.add_body_class(xhtml, 'x-ebookmaker-2')
+
+                            self.insert_root_div(xhtml)
+                            self.fix_charset(xhtml)
+                            self.fix_style_elements(xhtml)
+
+                            if job.subtype in ('.images', '.noimages'):
+                                # omit for future subtype '.v3'
+                                self.reflow_pre(xhtml)
+                                self.render_q(xhtml)
+
+                            # strip all links to items not in manifest
+                            p.strip_links(xhtml, job.spider.dict_urls_mediatypes())
+                            self.strip_links(xhtml, job.spider.dict_urls_mediatypes())
+                            self.strip_data_attribs(xhtml)
+                            self.strip_aria_attribs(xhtml)
+
+                            self.strip_noepub(xhtml)
+                            # self.strip_rst_dropcaps(xhtml)
+
+                            self.fix_html_image_dimensions(xhtml)
+                            if coverpage_url and not hasattr(p.attribs, 'nonlinear'):
+                                self.remove_coverpage(xhtml, coverpage_url)
+
+                            # externalize and fix CSS
+                            for style in xpath(xhtml, '//xhtml:style'):
+                                self.add_external_css(
+                                    job.spider, xhtml, style.text, "%d.css" % css_count)
+                                css_count += 1
+                                style.drop_tree()
+
+                            self.add_external_css(job.spider, xhtml, None, 'pgepub.css')
+
+                            self.add_meta_generator(xhtml)
+
+                            debug("Splitting %s ..." % p.attribs.url)
+                            chunker.next_id = 0
+                            chunker.split(xhtml, p.attribs)
+                        else:
+                            # parsing xml worked, but it isn't xhtml. so we need to reset mediatype
+                            # to something that isn't recognized as content
+                            p.attribs.mediatype = 'text/xml'
+            css_rewriter = self.css_rewriter(job)
             for p in job.spider.parsers:
                 if str(p.attribs.mediatype) == 'text/css':
                     p.parse()
                 if hasattr(p, 'sheet') and p.sheet:
-                    self.fix_incompatible_css(p.sheet)
-                    if job.subtype == '.noimages':
-                        p.strip_images()
-                    p.rewrite_links(self.url2filename)
+                    css_rewriter.apply(p.sheet)
                     parserlist.append(p)
                 if str(p.attribs.mediatype) in OPS_FONT_TYPES:
                     warning('font file embedded: %s ;  check its license!', p.attribs.url)
                     parserlist.append(p)
 
+            Metrics.count('chunk', chunks=len(chunker.chunks))
+
             # after splitting html into chunks we have to rewrite all
             # internal links in HTML
             chunker.rewrite_internal_links()
@@ -27,11 +27,12 @@ from libgutenberg.GutenbergGlobals import PG_URL
 
 from cssutils import css
 
+from ebookmaker import Metrics
 from ebookmaker import writers
 from ebookmaker.CommonCode import Options
 from ebookmaker.EbookMaker import FILENAMES
 from ebookmaker.parsers import webify_url, CSSParser
-from ebookmaker.parsers.CSSParser import cssutils
+from ebookmaker.parsers.CSSParser import cssutils, CSSRewriter
 from ebookmaker.parsers.HTMLParser import BODY_WRAPPER_CLASS
 from ebookmaker.utils import (
     add_class, add_style, css_len, check_lang, replace_elements, gg, xpath, NS
@@ -182,7 +183,7 @@ class Writer(writers.HTMLishWriter):
             title.text = f'{job.dc.title} | Project Gutenberg'
 
     @staticmethod
-    def replace_boilerplate(job, tree):
+    def add_boilerplate_credit(job, tree):
         """ get text after the divider, put in dc.credit if not already there"""
         for pre in xpath(tree, '//*[@id="pg-header"]//xhtml:pre'):
             divided = DIVIDER.split(' '.join(pre.itertext()))
@@ -190,13 +191,26 @@ class Writer(writers.HTMLishWriter):
                 job.dc.add_credit(divided[1])
                 info('credit text from source file : %s', divided[1].strip())
 
+
+    @staticmethod
+    def replace_boilerplate(job, tree):
+        """ Add the credit to job.dc and replace the boilerplate with a generated one. """
+        Writer.add_boilerplate_credit(job, tree)
+        Writer.insert_boilerplate(tree, HtmlTemplates.pgheader(job.dc),
+                                  HtmlTemplates.pgfooter(job.dc))
+
+
+    @staticmethod
+    def insert_boilerplate(tree, new_header, new_footer):
+        """ Replace pg-header and pg-footer in tree, remove the old boilerplate. """
+
         for body in xpath(tree, '//xhtml:body'):
             break
         else:
             error('No Body!!!')
             return
 
-        new_bp = HtmlTemplates.pgheader(job.dc)
+        new_bp = new_header
 
         for pg_header in xpath(tree, '//*[@id="pg-header"]'):
             prev = pg_header.getprevious()
@@ -209,7 +223,7 @@ class Writer(writers.HTMLishWriter):
         else:
             debug('No pg-header found, not inserting a generated one.')
 
-        new_bp = HtmlTemplates.pgfooter(job.dc)
+        new_bp = new_footer
 
         for pg_footer in xpath(tree, '//*[@id="pg-footer"]'):
             next_el = pg_footer.getnext()
@@ -236,6 +250,23 @@ class Writer(writers.HTMLishWriter):
                 parent.remove(pg_wrapper)
 
 
+    @staticmethod
+    def normalize(job, xhtml, url, boilerplate=True):
+        """ Replace the boilerplate and make the links absolute. """
+        if boilerplate:
+            Writer.replace_boilerplate(job, xhtml)
+        xhtml.make_links_absolute(base_url=url)
+
+
+    @staticmethod
+    def normalized_xhtml(job, p, boilerplate=True):
+        """ Return a copy of p.xhtml, normalized for the writers. """
+        with Metrics.stage('normalize'):
+            xhtml = copy.deepcopy(p.xhtml)
+            Writer.normalize(job, xhtml, p.attribs.url, boilerplate)
+            return xhtml
+
+
     def outputfileurl(self, job, url):
         """
         Make the output path for the parser.
@@ -292,11 +323,19 @@ class Writer(writers.HTMLishWriter):
         return os.path.join(os.path.abspath(job.outputdir), relativeURL)
 
 
+    # don't let the source change the body bgcolor or text color
+    BODY_CSS = (('body', 'background:initial;color:initial'),
+                ('a', 'text-decoration:initial'))
+
     @staticmethod
-    def fix_body_css(sheet):
+    def fix_body_rule(rule):
         """
             print output can't put margins on body.
+            Returns the rules to replace a body rule with, None for other rules.
         """
+        if rule.type != rule.STYLE_RULE or 'body' not in rule.selectorText:
+            return None
+
         SHOULD_MOVE = re.compile(r'^(margin-?|padding-?).*')
         def style_filter(style, patt=SHOULD_MOVE ):
             in_style = copy.copy(style)
@@ -308,81 +347,91 @@ class Writer(writers.HTMLishWriter):
                     in_style.removeProperty(p.name)
             return (in_style, out_style)
 
-        old_rules = sheet.cssRules.copy()
-        sheet.cssRules.clear()
-
-        for rule in old_rules:
-            if rule.type == rule.STYLE_RULE and 'body' in rule.selectorText:
-                for selector in rule.selectorList:
-                    # if there are selectors like 'body.CLASSNAME' we shouldn't need to worry
-                    # because they won't stick to the print body anyway
-                    if selector.selectorText == 'body':
-                        # separate properties we can't have on print body from the others
-                        should_move_sty, can_keep_sty = style_filter(rule.style)
-
-                        # make a rule that keeps the properties that have been set on body
-                        if len(list(can_keep_sty)) > 0:
-                            new_rule = css.CSSStyleRule(selectorText='body', style=can_keep_sty)
-                            sheet.add(new_rule)
-
-                        if len(list(should_move_sty)) > 0:
-                            # make a rule that will apply to the screen body
-                            at_rules = css.CSSRuleList()
-                            at_rules.insert(0, css.CSSStyleRule(
-                                selectorText='body', style=should_move_sty))
-                            new_rule = css.CSSMediaRule(mediaText='screen')
-                            new_rule.cssRules = at_rules
-                            sheet.add(new_rule)
-
-                            # make a rule that will apply to the page divs
-                            new_rule = css.CSSStyleRule(
-                                selectorText='.pagedjs_page_content > div', style=should_move_sty)
-                            sheet.add(new_rule)
-                    else:
-                        # other selectors
-                        new_rule = css.CSSStyleRule(
-                            selectorText=selector.selectorText, style=rule.style)
-                        sheet.add(new_rule)
-
+        new_rules = []
+        for selector in rule.selectorList:
+            # if there are selectors like 'body.CLASSNAME' we shouldn't need to worry
+            # because they won't stick to the print body anyway
+            if selector.selectorText == 'body':
+                # separate properties we can't have on print body from the others
+                should_move_sty, can_keep_sty = style_filter(rule.style)
+
+                # make a rule that keeps the properties that have been set on body
+                if len(list(can_keep_sty)) > 0:
+                    new_rules.append(css.CSSStyleRule(selectorText='body', style=can_keep_sty))
+
+                if len(list(should_move_sty)) > 0:
+                    # make a rule that will apply to the screen body
+                    at_rules = css.CSSRuleList()
+                    at_rules.insert(0, css.CSSStyleRule(
+                        selectorText='body', style=should_move_sty))
+                    new_rule = css.CSSMediaRule(mediaText='screen')
+                    new_rule.cssRules = at_rules
+                    new_rules.append(new_rule)
+
+                    # make a rule that will apply to the page divs
+                    new_rules.append(css.CSSStyleRule(
+                        selectorText='.pagedjs_page_content > div', style=should_move_sty))
             else:
-                sheet.add(rule)
+                # other selectors
+                new_rules.append(css.CSSStyleRule(
+                    selectorText=selector.selectorText, style=rule.style))
+        return new_rules
+
+    @staticmethod
+    def fix_body_css(sheet):
+        """
+            print output can't put margins on body.
+        """
+        CSSRewriter(replace=Writer.fix_body_rule, append=Writer.BODY_CSS).apply(sheet)
 
-        # don't let the source change the body bgcolor or text color
-        new_rule = css.CSSStyleRule(selectorText='body', style='background:initial;color:initial')
-        sheet.add(new_rule)
-        new_rule = css.CSSStyleRule(selectorText='a', style='text-decoration:initial')
-        sheet.add(new_rule)
+    @staticmethod
+    def fix_incompatible_rule(rule):
+        """ Strip CSS properties and values of a style rule that are not HTML5 compatible. """
+        for p in list(rule.style):
+            if p.name == 'speak':
+                val = rule.style.getPropertyValue('speak')
+                if val == 'spell-out':
+                    rule.style.removeProperty('speak')
+                    rule.style.setProperty('speak-as', 'spell-out')
+                elif val == 'none':
+                    rule.style.setProperty('speak', 'never')
+                elif val == 'inherit':
+                    rule.style.setProperty('speak', 'auto')
 
     @staticmethod
     def fix_incompatible_css(sheet):
         """ Strip CSS properties and values that are not HTML5 compatible.
             Unpack "media handheld" rules
         """
-        for rule in sheet:
-            if rule.type == rule.STYLE_RULE:
-                for p in list(rule.style):
-                    if p.name == 'speak':
-                        val = rule.style.getPropertyValue('speak')
-                        if val == 'spell-out':
-                            rule.style.removeProperty('speak')
-                            rule.style.setProperty('speak-as', 'spell-out')
-                        elif val == 'none':
-                            rule.style.setProperty('speak', 'never')
-                        elif val == 'inherit':
-                            rule.style.setProperty('speak', 'auto')
+        CSSRewriter(style_fixes=[Writer.fix_incompatible_rule]).apply(sheet)
+
+    @staticmethod
+    def deprecated_selector_fix(tags='', replacement='span'):
+        """ selector fix: for deprecated tags, change selector to {replacement}.xhtml_{tag name}
+        """
+        subs = [(re.compile(f'(^| |\\+|,|>|~){tag}'), f'\\1{replacement}.xhtml_{tag}')
+                for tag in tags]
+        def fix(text):
+            for tagre, tagsub in subs:
+                text = tagre.sub(tagsub, text)
+            return text
+        return fix
 
     @staticmethod
     def fix_css_for_deprecated(sheet, tags='', replacement='span'):
         """ for deprecated tags, change selector to {replacement}.xhtml_{tag name};
             if no existing selector, add the selector with a style
         """
-        for tag in tags:
-            tagre = re.compile(f'(^| |\\+|,|>|~){tag}')
-            tagsub = f'\\1{replacement}.xhtml_{tag}'
-            for rule in sheet:
-                if rule.type == rule.STYLE_RULE:
-                    for selector in rule.selectorList:
-                        selector.selectorText = tagre.sub(tagsub, selector.selectorText)
+        CSSRewriter(selector_fixes=[Writer.deprecated_selector_fix(tags, replacement)]).apply(sheet)
+
+    @staticmethod
+    def html5_css_rewriter(deprecated=()):
+        """ All the fixes of an HTML5 sheet, for one pass over it. """
+        return CSSRewriter(
+            selector_fixes=[Writer.deprecated_selector_fix(deprecated)] if deprecated else [],
+            style_fixes=[Writer.fix_incompatible_rule],
+            replace=Writer.fix_body_rule,
+            append=Writer.BODY_CSS)
 
 
     @staticmethod
@@ -501,15 +550,13 @@ class Writer(writers.HTMLishWriter):
         ##### cleanup #######
 
         # fix css in style elements
-        cssparser = cssutils.CSSParser()
+        fix_sheet = Writer.html5_css_rewriter(deprecated_used).apply
+
+        # the deprecated tags are applied in set order, the key keeps that order
+        fix_key = ('html5', ) + tuple(deprecated_used)
         for style in xpath(html, "//xhtml:style"):
             if style.text:
-                sheet = cssparser.parseString(style.text)
-                CSSParser.Parser.lowercase_selectors(sheet)
-                Writer.fix_incompatible_css(sheet)
-                Writer.fix_css_for_deprecated(sheet, tags=deprecated_used)
-                Writer.fix_body_css(sheet)
-                style.text = sheet.cssText.decode("utf-8")
+                style.text = CSSParser.sheet_text(style.text, fix_sheet, fix_key).decode("utf-8")
 
         deprecated_used.add('*')  # '*' provides for css rules that are always added
         css_for_deprecated = ' '.join([CSS_FOR_REPLACED.get(tag, '') for tag in deprecated_used])
@@ -555,7 +602,7 @@ class Writer(writers.HTMLishWriter):
 
             elif hasattr(p, 'xhtml'):
                 p.parse()
-                xhtml = copy.deepcopy(p.xhtml)
+                xhtml = self.normalized_xhtml(job, p)
                 self.make_links_relative(xhtml, p.attribs.url)
                 if hasattr(p, 'finalize_html5'):
                     p.finalize_html5(xhtml)
@@ -567,7 +614,7 @@ class Writer(writers.HTMLishWriter):
             try:
 
                 if xhtml is not None:
-                    html = copy.deepcopy(xhtml)
+                    html = xhtml
 
                     if NS.xml.lang in html.attrib:
                         lang = html.attrib[NS.xml.lang]
@@ -580,7 +627,8 @@ class Writer(writers.HTMLishWriter):
                     self.add_meta_generator(html)
                     self.add_moremeta(job, html, p.attribs.url)
 
-                    self.replace_boilerplate(job, html)
+                    if hasattr(p, 'rst2html'):
+                        self.replace_boilerplate(job, html)
                     self.xhtml_to_html(html)
 
                     # strip xhtml namespace
@@ -591,19 +639,20 @@ class Writer(writers.HTMLishWriter):
                     # Remove unused namespace declarations
                     etree.cleanup_namespaces(html)
 
-                    self.write_with_crlf(outfile, serialize(html))
+                    with Metrics.stage('serialize'):
+                        data = serialize(html)
+                    Metrics.count('serialize', docs=1, bytes=len(data))
+                    self.write_with_crlf(outfile, data)
                     debug("Done generating HTML file: %s" % outfile)
 
                 else:
                     #images and css files
 
                     if hasattr(p, 'sheet') and p.sheet:
-                        self.fix_incompatible_css(p.sheet)
-                        self.fix_body_css(p.sheet)
+                        self.html5_css_rewriter().apply(p.sheet)
 
                     try:
-                        with open(outfile, 'wb') as fp_dest:
-                            fp_dest.write(p.serialize())
+                        self.copy_aux_file(p, outfile)
                     except IOError as what:
                         error('Cannot copy %s to %s: %s', job.attribs.url, outfile, what)
 
@@ -49,8 +49,7 @@ class Writer(writers.BaseWriter):
                 debug('Copying %s to %s' % (src_uri, fn_dest))
                 gg.mkdir_for_filename(fn_dest)
                 try:
-                    with open(fn_dest, 'wb') as fp_dest:
-                        fp_dest.write(p.serialize())
+                    self.copy_aux_file(p, fn_dest)
                 except IOError as what:
                     error('Cannot copy %s to %s: %s' % (src_uri, fn_dest, what))
 
@@ -14,6 +14,7 @@ Base classes for *Writer modules. (EpubWriter, PluckerWriter, ...)
 
 """
 import re
+import shutil
 import subprocess
 
 from functools import partial
@@ -38,6 +39,31 @@ def remove_cr(content):
     content = re.sub(r'\s*[\r\n]+\s*', '&#10;', content)
     return content
 
+def copy_file(src, dest):
+    """ Copy src to dest without reading it into python.
+
+    Uses copy_file_range (which makes reflinks on filesystems that
+    support them), else shutil.copyfile (sendfile on Linux).
+
+    """
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as fp_src, open(dest, 'wb') as fp_dest:
+                size = os.fstat(fp_src.fileno()).st_size
+                copied = 0
+                while copied < size:
+                    n = os.copy_file_range(fp_src.fileno(), fp_dest.fileno(), size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            if copied == size:
+                return
+        except OSError:
+            # not supported for these files
+            pass
+    shutil.copyfile(src, dest)
+
+
 class BaseWriter:
     """
     Base class for EpubWriter, PluckerWriter, ...
@@ -63,6 +89,52 @@ class BaseWriter:
             fp.write(bytes_)
 
 
+    @staticmethod
+    def copy_aux_file(p, fn_dest):
+        """ Put the file of parser p (an image, css ...) at fn_dest.
+
+        Unmodified files are hardlinked (with --hardlink-aux-files) or
+        copied in the kernel, and are not copied again if they are still
+        there from an earlier job. fn_dest is replaced, never written
+        into, so a hardlinked source file cannot be changed.
+
+        """
+
+        path = p.serialized_path() if hasattr(p, 'serialized_path') else None
+        try:
+            stat = os.stat(fn_dest)
+        except OSError:
+            stat = None
+
+        if stat is not None and path:
+            src_mtime = os.stat(path).st_mtime_ns
+            if (os.path.samefile(path, fn_dest) or p.placed_files.get(fn_dest) ==
+                    (stat.st_ino, stat.st_size, stat.st_mtime_ns, src_mtime)):
+                debug('Not copying %s to %s: already there' % (path, fn_dest))
+                return
+
+        if stat is not None or os.path.islink(fn_dest):
+            os.unlink(fn_dest)
+
+        if path:
+            linked = False
+            if getattr(options, 'hardlink_aux_files', False):
+                try:
+                    os.link(path, fn_dest)
+                    linked = True
+                except OSError:
+                    # another filesystem
+                    pass
+            if not linked:
+                copy_file(path, fn_dest)
+            stat = os.stat(fn_dest)
+            p.placed_files[fn_dest] = (stat.st_ino, stat.st_size, stat.st_mtime_ns,
+                                       os.stat(path).st_mtime_ns)
+        else:
+            with open(fn_dest, 'wb') as fp_dest:
+                p.serialize_to(fp_dest)
+
+
     def validate(self, job):
         """ Validate generated file using external tools. """
 
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+run this with
+python -m unittest -v tests.test_parallel
+'''
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import unittest
+import zipfile
+
+
+import ebookmaker
+
+# conversion and modification dates differ between any two builds
+RE_TIMESTAMP = re.compile(rb'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d+)?(\+00:00|Z)')
+
+# a mobi maker that just copies the epub, to see which epub the kindle job got
+FAKE_EBOOK_CONVERT = '''#!/bin/sh
+cp "$1" "$2"
+'''
+
+class TestParallel(unittest.TestCase):
+    def setUp(self):
+        self.sample_dir = os.path.join(os.path.dirname(__file__), 'files')
+        self.tmp_dir = tempfile.mkdtemp()
+        mobimaker = os.path.join(self.tmp_dir, 'ebook-convert')
+        with open(mobimaker, 'w') as fp:
+            fp.write(FAKE_EBOOK_CONVERT)
+        os.chmod(mobimaker, 0o755)
+        self.config_file = os.path.join(self.tmp_dir, 'ebookmaker.conf')
+        with open(self.config_file, 'w') as fp:
+            fp.write('[ebookmaker]\nmobigen = %s\nmobilang = %s\n' % (mobimaker, mobimaker))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def build(self, out_dir, *args):
+        htmfile = os.path.join(self.sample_dir, '43172', '43172-h', '43172-h.htm')
+        os.mkdir(out_dir)
+        # the txt job is skipped for html, but it drops the parser cache
+        cmd = ['ebookmaker', '--config=%s' % self.config_file, '--ebook=43172',
+               '--make=txt', '--make=test', '--make=kindle', '--output-dir=%s' % out_dir]
+        cmd += list(args) + [htmfile]
+        env = dict(os.environ, PYTHONHASHSEED='0')
+        subprocess.check_call(cmd, env=env, stderr=subprocess.DEVNULL)
+
+        files = {}
+        for root, dummy_dirs, filenames in os.walk(out_dir):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                if zipfile.is_zipfile(path):
+                    with zipfile.ZipFile(path) as zf:
+                        data = [(name, RE_TIMESTAMP.sub(b'', zf.read(name)))
+                                for name in zf.namelist()]
+                else:
+                    with open(path, 'rb') as fp:
+                        data = RE_TIMESTAMP.sub(b'', fp.read())
+                files[os.path.relpath(path, out_dir)] = data
+        return files
+
+    def test_43172(self):
+        serial = self.build(os.path.join(self.tmp_dir, 'serial'))
+        parallel = self.build(os.path.join(self.tmp_dir, 'parallel'), '--parallel=2')
+
+        self.assertIn('43172-images-kindle.mobi', serial)
+        self.assertEqual(sorted(parallel), sorted(serial))
+        for name in serial:
+            self.assertTrue(parallel[name] == serial[name], name)
+        # the kindle job ran after the epub it is made from was finished
+        with open(os.path.join(self.tmp_dir, 'parallel', '43172-images-kindle.mobi'),
+                  'rb') as fp:
+            mobi = fp.read()
+        with open(os.path.join(self.tmp_dir, 'parallel', '43172-images-epub.epub'),
+                  'rb') as fp:
+            self.assertEqual(mobi, fp.read())
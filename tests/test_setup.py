@@ -4,22 +4,43 @@
 run this with
 python -m unittest -v ebookmaker.tests.test_setup
 '''
+import glob
+import io
 import os
+import shutil
+import tempfile
 import unittest
 import subprocess
+import zipfile
+from unittest import mock
 
+from docutils import frontend
+from docutils.readers import standalone
 from libgutenberg import Logger
+from libgutenberg import DublinCore
+from libgutenberg.GutenbergGlobals import xpath
 from libgutenberg.Logger import debug
+from lxml import etree
+from PIL import Image
 
 import ebookmaker
 from ebookmaker import CommonCode
+from ebookmaker import EbookMaker
+from ebookmaker import HTMLChunker
 from ebookmaker import ParserFactory
 from ebookmaker import WriterFactory
+from ebookmaker import ZipWriter
 from ebookmaker.CommonCode import Options, path_from_file
 from ebookmaker.EbookMaker import config
-from ebookmaker.EbookMaker import DEPENDENCIES, BUILD_ORDER
+from ebookmaker.EbookMaker import DEPENDENCIES, BUILD_ORDER, job_dependencies
+from ebookmaker.mydocutils.gutenberg import parsers as gutenberg_parsers
+from ebookmaker.mydocutils.transforms import parts
+from ebookmaker.mydocutils.writers import xhtml1
 from ebookmaker.packagers import PackagerFactory
 from ebookmaker.parsers import BROKEN, webify_url
+from ebookmaker.parsers import CSSParser, HTMLParser, ImageParser
+from ebookmaker import writers
+from ebookmaker.writers import EpubWriter, HTMLWriter
 
 options = Options()
 
@@ -48,12 +69,563 @@ class TestLoad(unittest.TestCase):
         # check conversion to jpeg
         broken_parser.resize_image(16 * 1024, (66, 100), output_format='jpeg')
 
+    def test_image_cache(self):
+        ParserFactory.load_parsers()
+        options.image_cache = tempfile.mkdtemp()
+        try:
+            parser = ParserFactory.ParserFactory().create(BROKEN)
+            parser.pre_parse()
+            data = parser.resize_image(16 * 1024, (66, 100)).image_data
+            self.assertEqual(parser.resize_image(16 * 1024, (66, 100)).image_data, data)
+            self.assertEqual(len(parser.resized), 1)
+            # a new run gets it from the disk cache
+            parser.resized = {}
+            with mock.patch.object(ImageParser, 'resize_image_data') as resize:
+                self.assertEqual(parser.resize_image(16 * 1024, (66, 100)).image_data, data)
+            resize.assert_not_called()
+        finally:
+            shutil.rmtree(options.image_cache)
+            options.image_cache = None
+
+    def test_lazy_images(self):
+        ParserFactory.load_parsers()
+        ParserFactory.ParserFactory.clear_parser_cache()
+        path = os.path.join(os.path.dirname(__file__), 'files/43172/images/image.jpg')
+        parser = ParserFactory.ParserFactory.create(webify_url(path))
+        parser.pre_parse()
+        # only the path is kept
+        self.assertIsNone(parser._image_data)
+        self.assertEqual(parser.serialized_path(), path)
+        with open(path, 'rb') as fp:
+            self.assertEqual(parser.bytes_content(), fp.read())
+        parser._digest = None
+        with mock.patch('builtins.open', side_effect=open) as opened:
+            resized = parser.resize_image(16 * 1024, (100, 100))
+        # one read for the cache key and the resize
+        self.assertEqual([call.args[0] for call in opened.call_args_list].count(path), 1)
+        spilled = resized.serialized_path()
+        self.assertNotEqual(spilled, path)
+        self.assertEqual(len(resized.image_data), os.path.getsize(spilled))
+        ParserFactory.ParserFactory.clear_parser_cache()
+        self.assertFalse(os.path.exists(spilled))
+
+        # the txt job drops the parser cache and the spilled images with it
+        WriterFactory.load_writers()
+        parser = ParserFactory.ParserFactory.create(webify_url(path))
+        parser.pre_parse()
+        spilled = parser.resize_image(16 * 1024, (100, 100)).serialized_path()
+        self.assertTrue(os.path.exists(spilled))
+        job = CommonCode.Job('txt.utf-8')
+        job.ebook = 69030
+        job.url = os.path.join(os.path.dirname(__file__), 'files/69030/69030-0.txt')
+        job.outputdir = tempfile.mkdtemp()
+        try:
+            EbookMaker.run_job(job, {})
+        finally:
+            shutil.rmtree(job.outputdir)
+        self.assertEqual(ParserFactory.ParserFactory.parsers, {})
+        self.assertFalse(os.path.exists(spilled))
+
+    def test_probe_dimen(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'image')
+            for format_, size in (('png', (31, 17)), ('gif', (12, 40)), ('jpeg', (640, 480))):
+                Image.new('RGB', size, 'red').save(path, format_, exif=b'Exif\x00\x00' * 10)
+                os.utime(path, ns=(0, len(format_)))  # a new key for the memo
+                self.assertEqual(tuple(ImageParser.get_file_dimen(path)), size)
+            with open(path, 'wb') as fp:
+                fp.write(b'<svg xmlns="http://www.w3.org/2000/svg" width="120px" height="80"/>')
+            self.assertEqual(ImageParser.get_file_dimen(path), (120, 80))
+            # the parser does not decode the image
+            parser = ImageParser.Parser()
+            parser.attribs.url = webify_url(os.path.join(tmpdir, 'image.png'))
+            Image.new('RGB', (300, 200)).save(path + '.png')
+            parser.pre_parse()
+            with mock.patch.object(Image, 'open') as image_open:
+                self.assertEqual(tuple(parser.get_image_dimen()), (300, 200))
+            image_open.assert_not_called()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_cover_cache(self):
+        def draw(dc, cover_width, cover_height):
+            cover = mock.Mock()
+            cover.save.side_effect = lambda fp: fp.write(dc.title.encode('utf-8'))
+            return cover
+        dc = DublinCore.GutenbergDublinCore()
+        dc.title = 'Cover Test'
+        dc.add_author('Author, Test', 'cre')
+        dc.project_gutenberg_id = 99999
+        tmpdir = tempfile.mkdtemp()
+        options.image_cache = os.path.join(tmpdir, 'cache')
+        try:
+            with mock.patch.object(EbookMaker.Cover, 'draw', side_effect=draw) as cover_draw:
+                cover_url = EbookMaker.generate_cover(tmpdir, dc)
+                mtime = os.stat(cover_url).st_mtime_ns
+                # the next job reuses the cover file
+                self.assertEqual(EbookMaker.generate_cover(tmpdir, dc), cover_url)
+                self.assertEqual(os.stat(cover_url).st_mtime_ns, mtime)
+                # the next run gets it from the image cache
+                EbookMaker.last_cover = (None, None)
+                os.remove(cover_url)
+                EbookMaker.generate_cover(tmpdir, dc)
+                cover_draw.assert_called_once()
+                with open(cover_url, 'rb') as fp:
+                    self.assertEqual(fp.read(), b'Cover Test')
+                # a different title makes a new cover
+                dc.title = 'Other Cover'
+                EbookMaker.generate_cover(tmpdir, dc)
+                self.assertEqual(cover_draw.call_count, 2)
+        finally:
+            shutil.rmtree(tmpdir)
+            options.image_cache = None
+            EbookMaker.last_cover = (None, None)
+
+    def test_resize_fits(self):
+        noise = Image.effect_noise((300, 300), 60).convert('RGB')
+        for format_ in ('png', 'jpeg'):
+            buf = io.BytesIO()
+            noise.save(buf, format_)
+            dummy_to_png, data, dimen, comment = ImageParser.resize_image_data(
+                buf.getvalue(), 20 * 1024, (200, 200))
+            self.assertLessEqual(len(data), 20 * 1024)
+            self.assertLessEqual(max(dimen), 200)
+            if format_ == 'png':
+                # the next larger step would not fit
+                bigger = noise.resize((int(max(dimen) / 0.8),) * 2, Image.LANCZOS)
+                self.assertGreater(len(ImageParser.get_image_data(bigger, 'png')), 20 * 1024)
+            else:
+                self.assertIn('q=', comment)
+
+    def test_resize_png_gain(self):
+        # optimizing shrinks these pngs by a third, more than the first guess expects
+        gradient = Image.linear_gradient('L').convert('P', palette=Image.ADAPTIVE, colors=16)
+        for width in (800, 1200):
+            buf = io.BytesIO()
+            gradient.resize((width, width)).save(buf, 'png')
+            unsized_image = Image.open(buf)
+            for max_size in (980, 1170, 1360, 1560):
+                # the old loop: scale down in steps of 0.8 until it fits
+                scale = 1.0
+                data = ImageParser.get_image_data(unsized_image, 'png')
+                while len(data) > max_size and scale > 0.01:
+                    scale *= 0.8
+                    dummy_was, image = ImageParser.scale_image(unsized_image, scale)
+                    data = ImageParser.get_image_data(image, 'png')
+                self.assertEqual(ImageParser.resize_image_data(
+                    buf.getvalue(), max_size, (width, width))[1], data)
+
+    def test_resize_jpeg_draft(self):
+        buf = io.BytesIO()
+        Image.effect_noise((1200, 900), 40).convert('RGB').save(buf, 'jpeg')
+        with mock.patch.object(Image.Image, 'resize', autospec=True,
+                               side_effect=Image.Image.resize) as resize:
+            dummy_to_png, data, dimen, comment = ImageParser.resize_image_data(
+                buf.getvalue(), 1024 * 1024, (200, 200))
+        # decoded at 1/4 size, then scaled to the exact size
+        self.assertEqual(resize.call_args[0][0].size, (300, 225))
+        self.assertEqual(dimen, (200, 150))
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (200, 150))
+        self.assertIn('was 1200 x 900', comment)
+
+    def test_resize_images_pool(self):
+        requests = []
+        for color in ('red', 'green', 'blue'):
+            buf = io.BytesIO()
+            Image.new('RGB', (300, 200), color).save(buf, 'png')
+            parser = ImageParser.Parser()
+            parser.attribs.url = 'file:///%s.png' % color
+            parser.image_data = buf.getvalue()
+            requests.append((parser, 16 * 1024, (150, 150)))
+        serial = [p.image_data for p in ImageParser.resize_images(requests)]
+        for parser, dummy_size, dummy_dimen in requests:
+            parser.resized = {}
+        options.image_processes = 2
+        try:
+            pooled = ImageParser.resize_images(requests)
+        finally:
+            options.image_processes = 0
+        self.assertEqual([p.image_data for p in pooled], serial)
+        self.assertEqual([p.dimen for p in pooled], [(150, 100)] * 3)
+
+    def test_parse_cache(self):
+        ParserFactory.load_parsers()
+        options.parse_cache = tempfile.mkdtemp()
+        try:
+            url = webify_url(os.path.join(os.path.dirname(__file__),
+                                          'files/43172/43172-h/43172-h.htm'))
+            trees = []
+            logs = []
+            for dummy_pass in range(2):
+                ParserFactory.ParserFactory.clear_parser_cache()
+                parser = ParserFactory.ParserFactory.create(url)
+                with self.assertLogs(level='INFO') as log:
+                    parser.pre_parse()
+                trees.append(etree.tostring(parser.xhtml))
+                logs.append(log.output)
+            self.assertEqual(len(os.listdir(os.path.join(options.parse_cache, 'html'))), 1)
+            self.assertEqual(trees[0], trees[1])
+            # a cache hit logs what the parse logged
+            self.assertTrue(any('alt text' in line for line in logs[0]))
+            self.assertEqual(logs[0], logs[1])
+
+            # production logs more, a cache filled without it does not do
+            options.production = True
+            try:
+                for dummy_pass in range(2):
+                    ParserFactory.ParserFactory.clear_parser_cache()
+                    parser = ParserFactory.ParserFactory.create(url)
+                    with self.assertLogs(level='INFO') as log:
+                        parser.pre_parse()
+                    logs.append(log.output)
+            finally:
+                options.production = False
+            self.assertEqual(sum(len(files) for dummy_root, dummy_dirs, files
+                                 in os.walk(os.path.join(options.parse_cache, 'html'))), 2)
+            self.assertEqual(len([line for line in logs[2] if '[ALTTEXT]' in line]), 4)
+            self.assertEqual(logs[2], logs[3])
+        finally:
+            shutil.rmtree(options.parse_cache)
+            options.parse_cache = None
+
+    def test_tree_parse(self):
+        ParserFactory.load_parsers()
+        # 43172-h.htm has inline svg, which takes the soup path
+        url = webify_url(os.path.join(os.path.dirname(__file__),
+                                      'files/43172/43172-h/43172-nocover.htm'))
+        results = []
+        for use_tree in (True, False):
+            ParserFactory.ParserFactory.clear_parser_cache()
+            parser = ParserFactory.ParserFactory.create(url)
+            if use_tree:
+                with mock.patch.object(HTMLParser.Parser, '_parse_soup') as parse_soup:
+                    parser.pre_parse()
+                parse_soup.assert_not_called()
+            else:
+                with mock.patch.object(HTMLParser.Parser, '_parse_tree', return_value=None):
+                    parser.pre_parse()
+            results.append((etree.tostring(parser.xhtml), parser.added_classes))
+        ParserFactory.ParserFactory.clear_parser_cache()
+        # the soup path makes the same xhtml
+        self.assertEqual(results[0], results[1])
+
+        # the tree parse makes what the lxml soup makes, or leaves it to the soup
+        compared = 0
+        for path in glob.glob(os.path.join(os.path.dirname(__file__), 'files/*/*/*.htm*')):
+            ParserFactory.ParserFactory.clear_parser_cache()
+            parser = ParserFactory.ParserFactory.create(webify_url(path))
+            xhtml = parser._parse_tree()
+            if xhtml is not None:
+                soup = parser._parse_soup('lxml', {'exclude_encodings': ['us-ascii']})
+                self.assertEqual(etree.tostring(xhtml),
+                                 etree.tostring(parser._Parser__parse(soup)), path)
+                compared += 1
+        ParserFactory.ParserFactory.clear_parser_cache()
+        self.assertTrue(compared > 0)
+
+    def test_make_toc(self):
+        ParserFactory.load_parsers()
+        url = webify_url(os.path.join(os.path.dirname(__file__),
+                                      'files/43172/43172-h/43172-nocover.htm'))
+        parser = ParserFactory.ParserFactory.create(url)
+        xhtml = etree.fromstring(
+            '<html xmlns="http://www.w3.org/1999/xhtml"><body>'
+            '<h2>One<br/>Two</h2><p>a<br/>b<span class="pageno">7</span></p>'
+            '<hr/><p class="topic-title">Contents</p><h3>Three</h3><h3>Four</h3>'
+            '</body></html>')
+        toc = parser.make_toc(xhtml)
+        self.assertEqual([entry[1:] for entry in toc],
+                         [['One Two', 2], ['7', -1], ['Contents', 2], ['Three Four', 3]])
+        # breaks outside of headers are left alone
+        self.assertEqual(xpath(xhtml, '//xhtml:p/xhtml:br')[0].tail, 'b')
+        ParserFactory.ParserFactory.clear_parser_cache()
+
+    def test_normalized_xhtml(self):
+        ParserFactory.load_parsers()
+        url = webify_url(os.path.join(os.path.dirname(__file__),
+                                      'files/43172/43172-h/43172-nocover.htm'))
+        parser = ParserFactory.ParserFactory.create(url)
+        parser.parse()
+        job = CommonCode.Job('epub.images')
+        source = etree.tostring(parser.xhtml)
+        first = HTMLWriter.Writer.normalized_xhtml(job, parser, boilerplate=False)
+        second = HTMLWriter.Writer.normalized_xhtml(job, parser, boilerplate=False)
+        # every job gets its own copy, the spidered document is left alone
+        self.assertIsNot(first, second)
+        self.assertEqual(etree.tostring(first), etree.tostring(second))
+        self.assertEqual(etree.tostring(parser.xhtml), source)
+        for link in xpath(first, '//xhtml:a[@href]'):
+            self.assertTrue(link.get('href').startswith('file://'), link.get('href'))
+        ParserFactory.ParserFactory.clear_parser_cache()
+
+    def test_rst_doctree(self):
+        ParserFactory.load_parsers()
+        url = webify_url(os.path.join(os.path.dirname(__file__),
+                                      'files/33968/33968-rst/33968-rst.rst'))
+        parser = ParserFactory.ParserFactory.create(url)
+        parser.pre_parse()
+        doctree = parser.doctree
+        self.assertTrue(doctree)
+        job = mock.Mock(type='html.images')
+        # the source is parsed once, each format transforms a copy
+        with mock.patch('docutils.readers.standalone.Reader.read', side_effect=AssertionError):
+            html = etree.tostring(parser.rst2html(job))
+            self.assertIn(b'\\documentclass', parser.rst2xetex(mock.Mock(type='pdf.images')))
+            self.assertEqual(etree.tostring(parser.rst2html(job)), html)
+        self.assertIs(parser.doctree, doctree)
+        ParserFactory.ParserFactory.clear_parser_cache()
+
+    def test_fused_transforms(self):
+        ParserFactory.load_parsers()
+        url = webify_url(os.path.join(os.path.dirname(__file__),
+                                      'files/33968/33968-rst/33968-rst.rst'))
+        parser = ParserFactory.ParserFactory.create(url)
+        parser.pre_parse()
+        job = mock.Mock(type='html.images')
+        with mock.patch.object(parts, 'walk', wraps=parts.walk) as walk:
+            fused = etree.tostring(parser.rst2htmlish(job, xhtml1.Writer()))
+            fused_walks = [call for call in walk.call_args_list
+                           if call.args[0] is parser.document1]
+            walk.reset_mock()
+            separate = etree.tostring(parser.rst2htmlish(
+                job, xhtml1.Writer(), {'separate_transform_passes': 1}))
+            separate_walks = [call for call in walk.call_args_list
+                              if call.args[0] is parser.document1]
+        self.assertEqual(fused, separate)
+        self.assertEqual([type(t) for t in fused_walks[2].args[1]],
+                         [parts.FirstParagraphTransform, parts.BlockImageWrapper,
+                          parts.SetDefaults, parts.AlignTransform])
+        self.assertTrue(all(len(call.args[1]) == 1 for call in separate_walks))
+        self.assertEqual(sum(len(call.args[1]) for call in fused_walks), len(separate_walks))
+        ParserFactory.ParserFactory.clear_parser_cache()
+
+    def test_rst_settings(self):
+        ParserFactory.load_parsers()
+        parser = ParserFactory.ParserFactory.create(webify_url(os.path.join(
+            os.path.dirname(__file__), 'files/33968/33968-rst/33968-rst.rst')))
+        components = (standalone.Reader(), gutenberg_parsers.Parser(), xhtml1.Writer())
+        overrides = {'tab_width': 5, 'page_numbers': 1, 'get_resource': parser.get_resource}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config_file = os.path.join(tmpdir, 'docutils.conf')
+            with open(config_file, 'w') as fp:
+                fp.write('[general]\ntab_width: 3\n')
+            with mock.patch.dict(os.environ, {'DOCUTILSCONFIG': config_file}):
+                expected = frontend.OptionParser(
+                    components=components, defaults=overrides,
+                    read_config_files=1).get_default_values()
+                settings = parser.get_settings(components, overrides)
+                with mock.patch.object(frontend, 'OptionParser') as option_parser:
+                    again = parser.get_settings(components, overrides)
+                option_parser.assert_not_called()
+        # a new list of dependencies for every document
+        self.assertIsNot(again.record_dependencies, settings.record_dependencies)
+        for values in (settings, again, expected):
+            del values.record_dependencies
+        self.assertEqual(vars(again), vars(settings))
+        self.assertEqual(vars(settings), vars(expected))
+        self.assertEqual(settings.tab_width, 3)
+        self.assertIs(parser.get_resource('mydocutils.parsers', 'default_style.rst'),
+                      parser.get_resource('mydocutils.parsers', 'default_style.rst'))
+        ParserFactory.ParserFactory.clear_parser_cache()
+
+    def test_serialize_to(self):
+        ParserFactory.load_parsers()
+        url = webify_url(os.path.join(os.path.dirname(__file__),
+                                      'files/43172/43172-h/43172-nocover.htm'))
+        parser = ParserFactory.ParserFactory.create(url)
+        parser.parse()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            ocf = EpubWriter.OEBPSContainer(os.path.join(tmpdir, 'test.epub'))
+            for suffix in ('', '.xhtml'):
+                parser.attribs.url = url + suffix
+                self.assertEqual(ocf.add_stream('chunk' + suffix, parser.serialize_to),
+                                 len(parser.serialize()))
+            ocf.commit()
+            with zipfile.ZipFile(os.path.join(tmpdir, 'test.epub')) as epub:
+                self.assertEqual(epub.namelist()[0], 'mimetype')
+                for suffix in ('', '.xhtml'):
+                    parser.attribs.url = url + suffix
+                    self.assertEqual(epub.read('OEBPS/chunk' + suffix), parser.serialize())
+        finally:
+            shutil.rmtree(tmpdir)
+            ParserFactory.ParserFactory.clear_parser_cache()
+
+    def test_zip_threads(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            names = []
+            for i in range(20):
+                names.append(os.path.join(tmpdir, 'file%d.%s' % (i, ('txt', 'png')[i % 2])))
+                with open(names[-1], 'wb') as fp:
+                    fp.write(os.urandom(1000) + b'text ' * 2000 * i)
+            def write(archive, threads):
+                zip_ = ZipWriter.ZipWriter(archive, threads=threads,
+                                           levels=[('.txt', 9), ('*', 1)])
+                pooled = zip_.pool is not None
+                zip_.writestr('first', 'stored', zipfile.ZIP_STORED)
+                for name in names:
+                    zip_.write_file(name, os.path.basename(name), zipfile.ZIP_STORED
+                                    if name.endswith('.png') else None)
+                zip_.close()
+                with open(archive, 'rb') as fp:
+                    return pooled, fp.read()
+
+            archives = [os.path.join(tmpdir, 'test%d.zip' % i) for i in range(3)]
+            self.assertEqual(write(archives[0], 0), (False, write(archives[1], 3)[1]))
+            # the zipfile internals the pool needs work with the pinned pythons
+            self.assertEqual(write(archives[1], 3)[0], ZipWriter.pool_supported())
+            # any other python writes one member after another
+            ZipWriter.pool_supported.cache_clear()
+            try:
+                with mock.patch.object(ZipWriter, 'ZIPFILE_PYTHONS', ()):
+                    self.assertEqual(write(archives[2], 3), write(archives[0], 0))
+            finally:
+                ZipWriter.pool_supported.cache_clear()
+            with zipfile.ZipFile(archives[1]) as zip_:
+                self.assertIsNone(zip_.testzip())
+                self.assertEqual(zip_.namelist()[0], 'first')
+                self.assertEqual(zip_.getinfo('first').compress_type, zipfile.ZIP_STORED)
+                self.assertEqual(zip_.getinfo('file1.png').compress_type, zipfile.ZIP_STORED)
+                self.assertEqual(zip_.getinfo('file2.txt').compress_type, zipfile.ZIP_DEFLATED)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_zip_level_streamed(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            text = b'text ' * 20000
+            src = os.path.join(tmpdir, 'src.txt')
+            with open(src, 'wb') as fp:
+                fp.write(text)
+            def sizes(levels):
+                archive = os.path.join(tmpdir, 'test.epub')
+                with mock.patch.object(options, 'zip_levels', levels, create=True), \
+                     mock.patch.object(options, 'zip_threads', 0, create=True):
+                    ocf = EpubWriter.OEBPSContainer(archive)
+                ocf.add_stream('stream.txt', lambda fp: fp.write(text))
+                ocf.add_file('file.txt', src)
+                ocf.commit()
+                with zipfile.ZipFile(archive) as epub:
+                    self.assertIsNone(epub.testzip())
+                    return [epub.getinfo('OEBPS/' + name).compress_size
+                            for name in ('stream.txt', 'file.txt')]
+
+            default = sizes([])
+            self.assertTrue(all(size < len(text) // 10 for size in default))
+            # level 0 deflate does not shrink anything
+            stored = sizes([('.txt', 0)])
+            if ZipWriter.pinned_python():
+                self.assertTrue(all(size >= len(text) for size in stored))
+            # any other python streams with the default level
+            ZipWriter.stream_level_supported.cache_clear()
+            try:
+                with mock.patch.object(ZipWriter, 'ZIPFILE_PYTHONS', ()):
+                    self.assertEqual(sizes([('.txt', 0)]), default)
+            finally:
+                ZipWriter.stream_level_supported.cache_clear()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_copy_aux_file(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmpdir, 'src.png')
+            Image.new('RGB', (30, 20), 'red').save(src)
+            with open(src, 'rb') as fp:
+                data = fp.read()
+            parser = ImageParser.Parser()
+            parser.attribs.url = webify_url(src)
+            parser.pre_parse()
+            for hardlink in (False, True):
+                options.hardlink_aux_files = hardlink
+                dest = os.path.join(tmpdir, 'dest%d.png' % hardlink)
+                writers.BaseWriter.copy_aux_file(parser, dest)
+                self.assertEqual(os.path.samefile(src, dest), hardlink)
+                # the next job finds it there
+                with mock.patch.object(writers, 'copy_file') as copy_file, \
+                     mock.patch.object(os, 'link') as link:
+                    writers.BaseWriter.copy_aux_file(parser, dest)
+                copy_file.assert_not_called()
+                link.assert_not_called()
+                # a changed file is replaced, not written into
+                parser.image_data = b'changed'
+                writers.BaseWriter.copy_aux_file(parser, dest)
+                parser.image_data = None
+                with open(dest, 'rb') as fp:
+                    self.assertEqual(fp.read(), b'changed')
+                with open(src, 'rb') as fp:
+                    self.assertEqual(fp.read(), data)
+        finally:
+            options.hardlink_aux_files = False
+            shutil.rmtree(tmpdir)
+
+    def test_css_cache(self):
+        css_text = 'P.Big { font-size: 2em } H1 { float: left }'
+        sheet = CSSParser.shared_sheet(css_text)
+        self.assertIs(CSSParser.shared_sheet(css_text), sheet)
+        self.assertEqual([rule.selectorText for rule in sheet], ['p.Big', 'h1'])
+        with mock.patch.object(CSSParser, 'new_sheet') as new_sheet:
+            self.assertEqual(CSSParser.sheet_text(css_text), sheet.cssText)
+            self.assertEqual(CSSParser.sheet_text(css_text), sheet.cssText)
+        new_sheet.assert_not_called()
+        # fixed sheets are parsed anew, the shared sheet is not changed
+        def fix(sheet):
+            sheet.deleteRule(0)
+        self.assertEqual(CSSParser.sheet_text(css_text, fix, 'drop first'),
+                         b'h1 {\n    float: left\n    }')
+        self.assertEqual(len(CSSParser.shared_sheet(css_text).cssRules), 2)
+
+    def test_css_rewriter(self):
+        sheet = CSSParser.new_sheet(
+            'P.Big, Center B { font-size: 2em } .i { background: url(i.png) } '
+            '@media handheld { p { margin: 0 } }')
+        rewriter = CSSParser.CSSRewriter(
+            selector_fixes=[str.upper, str.lower],
+            style_fixes=[CSSParser.drop_images],
+            media_fixes=[lambda rule: setattr(rule.media, 'mediaText', 'all')],
+            append=[('a', 'color: red')],
+            url_fix=lambda url: 'x/' + url)
+        with mock.patch.object(rewriter, 'fix_selectors', wraps=rewriter.fix_selectors) as fix:
+            rewriter.apply(sheet)
+        self.assertEqual(fix.call_count, 2)
+        self.assertEqual([rule.cssText for rule in sheet], [
+            'p.big, center b {\n    font-size: 2em\n    }',
+            '@media all {\n    p {\n        margin: 0\n        }\n    }',
+            'a {\n    color: red\n    }'])
+        # the html5 writer fixes in one pass
+        sheet = CSSParser.new_sheet('body, font { margin: 0; color: red; speak: none }')
+        HTMLWriter.Writer.html5_css_rewriter({'font'}).apply(sheet)
+        self.assertEqual([rule.selectorText for rule in sheet if rule.type == rule.STYLE_RULE],
+                         ['body', '.pagedjs_page_content > div', 'span.xhtml_font', 'body', 'a'])
+
+    def test_chunk_template(self):
+        xhtml = etree.fromstring(
+            '<html xmlns="http://www.w3.org/1999/xhtml"><head><title>T</title></head>'
+            '<body class="b"><div class="chapter"><p>1</p><p>2</p></div>\n</body></html>')
+        template = HTMLChunker.HTMLChunker.make_template(xhtml)
+        self.assertEqual(etree.tostring(template),
+                         b'<html xmlns="http://www.w3.org/1999/xhtml"><head><title>T</title></head>'
+                         b'<body class="b"><div class="chapter"/></body></html>')
+        # the document itself is not touched
+        self.assertEqual(len(xpath(xhtml, '//xhtml:p')), 2)
+
     def test_writers(self):
         WriterFactory.load_writers()
 
     def test_packagers(self):
         PackagerFactory.load_packagers()
 
+    def test_job_dependencies(self):
+        job_queue = [CommonCode.Job(job_type) for job_type in
+                     ['epub.images', 'html.images', 'kindle.images', 'pdf.images', 'txt']]
+        deps = job_dependencies(job_queue)
+        self.assertEqual(deps[0], set())
+        self.assertEqual(deps[2], {0})
+        self.assertEqual(deps[3], {1})
+        self.assertEqual(deps[4], set())
+
     def test_dirs(self):
         print(path_from_file('cache/epub/1234/test'))
         self.assertTrue(path_from_file('cache/epub/1234/test').endswith(
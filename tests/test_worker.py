@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+run this with
+python -m unittest -v tests.test_worker
+'''
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from ebookmaker import ParserFactory, WriterFactory
+from ebookmaker import Worker
+from ebookmaker.CommonCode import Options
+from ebookmaker.packagers import PackagerFactory
+from ebookmaker.parsers import ImageParser
+
+options = Options()
+
+class TestWorker(unittest.TestCase):
+
+    def setUp(self):
+        options.extension_packages = []
+        ParserFactory.load_parsers()
+        WriterFactory.load_writers()
+        PackagerFactory.load_packagers()
+        self.sample_dir = os.path.join(os.path.dirname(__file__), 'files')
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def request(self, *args):
+        return Worker.do_request(json.dumps({'args': list(args)}))
+
+    def test_two_books(self):
+        reply = self.request(
+            '--make=epub.images', '--output-dir=%s' % self.out_dir,
+            os.path.join(self.sample_dir, '43172/43172-h/43172-h.htm'))
+        self.assertEqual(reply['status'], 0)
+        self.assertEqual(ParserFactory.ParserFactory.parsers, {})
+        self.assertFalse(hasattr(options, 'ebook'))
+
+        reply = self.request(
+            '--make=txt.utf-8', '--ebook=69030', '--output-dir=%s' % self.out_dir,
+            os.path.join(self.sample_dir, '69030/69030-0.txt'))
+        self.assertEqual(reply['status'], 0)
+        self.assertEqual(sorted(os.listdir(self.out_dir)),
+                         ['43172-images-epub.epub', '69030-0.txt'])
+
+    def test_incremental(self):
+        args = ['--incremental', '--make=epub.images', '--output-dir=%s' % self.out_dir,
+                os.path.join(self.sample_dir, '43172/43172-h/43172-h.htm')]
+        epub = os.path.join(self.out_dir, '43172-images-epub.epub')
+        self.assertEqual(self.request(*args)['status'], 0)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.out_dir, '.43172-images-epub.epub.manifest')))
+        mtime = os.stat(epub).st_mtime_ns
+
+        self.assertEqual(self.request(*args)['status'], 0)
+        self.assertEqual(os.stat(epub).st_mtime_ns, mtime)
+
+        # a changed option rebuilds
+        self.assertEqual(self.request('--title=Other', *args)['status'], 0)
+        self.assertNotEqual(os.stat(epub).st_mtime_ns, mtime)
+
+    def test_metrics(self):
+        reply = self.request(
+            '--metrics', '--make=epub.images', '--output-dir=%s' % self.out_dir,
+            os.path.join(self.sample_dir, '43172/43172-h/43172-h.htm'))
+        self.assertEqual(reply['status'], 0)
+        with open(os.path.join(self.out_dir, 'ebookmaker.metrics.jsonl')) as fp:
+            metrics = [json.loads(line) for line in fp]
+        stages = {(m['type'], m['stage']): m for m in metrics}
+        for stage in ('get_dc', 'spider', 'write', 'resize_images', 'transform', 'chunk',
+                      'serialize', 'zip', 'job'):
+            self.assertIn(('epub.images', stage), stages)
+        self.assertEqual(stages[('epub.images', 'resize_images')]['images'], 2)
+        self.assertTrue(stages[('epub.images', 'zip')]['bytes'] > 0)
+
+    def test_no_metrics(self):
+        # without --metrics the images are not read just to be counted
+        with mock.patch.object(ImageParser.Parser, 'bytes_content') as bytes_content:
+            reply = self.request(
+                '--make=epub.images', '--output-dir=%s' % self.out_dir,
+                os.path.join(self.sample_dir, '43172/43172-h/43172-h.htm'))
+        self.assertEqual(reply['status'], 0)
+        bytes_content.assert_not_called()
+        self.assertFalse(os.path.exists(os.path.join(self.out_dir, 'ebookmaker.metrics.jsonl')))
+
+    def test_bad_request(self):
+        self.assertEqual(Worker.do_request('not json')['status'], 2)
+        reply = self.request('--no-such-option')
+        self.assertEqual(reply['status'], 2)
+        self.assertIn('EbookMaker: error:', reply['error'])
+
+    def test_help(self):
+        stdin = io.StringIO(json.dumps({'args': ['--help']}) + '\n')
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            Worker.serve_stream(stdin, stdout)
+        # one JSON line and nothing else
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        reply = json.loads(lines[0])
+        self.assertEqual(reply['status'], 0)
+        self.assertIn('usage: EbookMaker', reply['output'])